@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Nix diagnostics extraction benchmark
+
+Builds a synthetic build log (compiler chatter with Nix error traces mixed
+in, many of them repeated) and compares the server's streaming
+_DiagnosticsScanner, fed in pipe-sized chunks, with the previous
+whole-string extractor (stderr + stdout concatenated, splitlines, eight-line
+lookahead per error). Peak allocations are measured with tracemalloc in a
+separate pass so they do not skew the timings.
+
+    python3 .cursor/mcp/bench-diagnostics.py
+    python3 .cursor/mcp/bench-diagnostics.py --megabytes 100 --error-every 5000
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import re
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SERVER_PATH = Path(__file__).resolve().parent / "nix-ops-server.py"
+CHUNK_CHARS = 65536
+
+ERROR_BLOCK = """error:
+       … while evaluating the attribute 'config.system.build.toplevel'
+         at /nix/store/0123456789abcdfghijklmnpqrsvwxyz-source/nixos/modules/system/activation/top-level.nix:71:12:
+           70|
+           71|   toplevel = baseSystemAssertWarn;
+       … while calling the 'throw' builtin
+         at /nix/store/0123456789abcdfghijklmnpqrsvwxyz-source/lib/modules.nix:{n}:7:
+
+       error: attribute 'option{n}' missing
+       at /repo/hosts/pix{h}.nix:{n}:5:
+"""
+
+
+def _load_server() -> Any:
+    spec = importlib.util.spec_from_file_location("nix_ops_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _legacy_extract(output: str) -> List[Dict[str, Any]]:
+    """The extractor the scanner replaced, kept here as the baseline."""
+    error_pattern = re.compile(r"error:\s*(.+)")
+    path_pattern = re.compile(r"(/[^:\s]+\.nix):(\d+):(\d+)")
+    diagnostics: List[Dict[str, Any]] = []
+    lines = output.splitlines()
+    for idx, line in enumerate(lines):
+        error_match = error_pattern.search(line)
+        if not error_match:
+            continue
+        location: Optional[Dict[str, Any]] = None
+        for j in range(idx, min(idx + 8, len(lines))):
+            loc_match = path_pattern.search(lines[j])
+            if loc_match:
+                location = {"file": loc_match.group(1), "line": int(loc_match.group(2)), "column": int(loc_match.group(3))}
+                break
+        item: Dict[str, Any] = {"message": error_match.group(1).strip()}
+        if location:
+            item["location"] = location
+        diagnostics.append(item)
+    return diagnostics
+
+
+def _make_log(megabytes: int, error_every: int, distinct: int) -> Tuple[str, str]:
+    """Return (stderr, stdout) totalling roughly `megabytes` MB."""
+    target = megabytes * 1_000_000
+    parts: List[str] = []
+    size = 0
+    n = 0
+    while size < target:
+        for i in range(error_every):
+            line = f"gcc -O2 -c src/module_{n % 977}/file_{i}.c -o build/file_{i}.o -Iinclude -DNDEBUG\n"
+            parts.append(line)
+            size += len(line)
+        block = ERROR_BLOCK.format(n=n % distinct, h=n % 4)
+        parts.append(block)
+        size += len(block)
+        n += 1
+    half = len(parts) // 2
+    return "".join(parts[:half]), "".join(parts[half:])
+
+
+def _run_legacy(stderr: str, stdout: str) -> List[Dict[str, Any]]:
+    return _legacy_extract(stderr + "\n" + stdout)
+
+
+def _run_scanner(server: Any) -> Callable[[str, str], List[Dict[str, Any]]]:
+    def run(stderr: str, stdout: str) -> List[Dict[str, Any]]:
+        merged = server._DiagnosticsScanner()
+        for text in (stderr, stdout):
+            scanner = server._DiagnosticsScanner()
+            for start in range(0, len(text), CHUNK_CHARS):
+                scanner.feed(text[start : start + CHUNK_CHARS])
+            merged.extend(scanner.close())
+        return merged.diagnostics()
+
+    return run
+
+
+def bench(name: str, run: Callable[[str, str], List[Dict[str, Any]]], stderr: str, stdout: str) -> Dict[str, Any]:
+    started = time.perf_counter()
+    diagnostics = run(stderr, stdout)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    run(stderr, stdout)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    megabytes = (len(stderr) + len(stdout)) / 1e6
+    return {
+        "extractor": name,
+        "megabytes": round(megabytes, 1),
+        "seconds": round(seconds, 3),
+        "mbPerSec": round(megabytes / seconds, 1) if seconds else None,
+        "peakMB": round(peak / 1e6, 1),
+        "diagnostics": len(diagnostics),
+        "occurrences": sum(item.get("occurrences", 1) for item in diagnostics),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--megabytes", type=int, default=100)
+    parser.add_argument("--error-every", type=int, default=2000, help="build lines between error traces")
+    parser.add_argument("--distinct", type=int, default=50, help="distinct error messages before repeats")
+    args = parser.parse_args()
+
+    server = _load_server()
+    stderr, stdout = _make_log(args.megabytes, args.error_every, args.distinct)
+    header = f"{'extractor':>10} {'MB':>7} {'secs':>8} {'MB/s':>8} {'peak MB':>8} {'diags':>7} {'errors':>7}"
+    print(header)
+    for name, run in (("legacy", _run_legacy), ("scanner", _run_scanner(server))):
+        row = bench(name, run, stderr, stdout)
+        print(
+            f"{row['extractor']:>10} {row['megabytes']:>7} {row['seconds']:>8} {str(row['mbPerSec']):>8} "
+            f"{row['peakMB']:>8} {row['diagnostics']:>7} {row['occurrences']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
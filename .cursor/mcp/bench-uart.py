@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+UART capture throughput benchmark
+
+Drives the server's _capture_uart against a local pseudo-terminal fed by a
+flood generator, so the read loop can be measured without hardware. Each
+generated line carries a sequence number; gaps in the captured sequence are
+reported as dropped data.
+
+    python3 .cursor/mcp/bench-uart.py
+    python3 .cursor/mcp/bench-uart.py --baud 115200 921600 3000000 --seconds 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+SERVER_PATH = Path(__file__).resolve().parent / "nix-ops-server.py"
+SEQ_PATTERN = re.compile(rb"^SEQ (\d{8}) ", re.MULTILINE)
+PAYLOAD = b"x" * 100
+
+
+def _load_server() -> Any:
+    spec = importlib.util.spec_from_file_location("nix_ops_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _flood(master_fd: int, rate: float, stop: threading.Event) -> None:
+    """Write sequence-numbered lines at `rate` bytes/s (unpaced if rate <= 0)."""
+    seq = 0
+    started = time.monotonic()
+    written = 0
+    while not stop.is_set():
+        batch = b"".join(b"SEQ %08d " % (seq + i) + PAYLOAD + b"\n" for i in range(32))
+        seq += 32
+        try:
+            os.write(master_fd, batch)
+        except OSError:
+            return
+        written += len(batch)
+        if rate > 0:
+            ahead = written / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _dropped_lines(data: bytes) -> int:
+    seqs = [int(m.group(1)) for m in SEQ_PATTERN.finditer(data)]
+    return sum(b - a - 1 for a, b in zip(seqs, seqs[1:]) if b > a + 1)
+
+
+def bench(server: Any, baud_rate: int, seconds: int, max_bytes: int, unpaced: bool) -> Dict[str, Any]:
+    master_fd, slave_fd = os.openpty()
+    device = os.ttyname(slave_fd)
+    stop = threading.Event()
+    # 8N1: ten bits on the wire per byte.
+    rate = 0.0 if unpaced else baud_rate / 10
+    writer = threading.Thread(target=_flood, args=(master_fd, rate, stop), daemon=True)
+    writer.start()
+    cpu_start = time.thread_time()
+    wall_start = time.monotonic()
+    try:
+        result = server._capture_uart(device, baud_rate=baud_rate, seconds=seconds, max_bytes=max_bytes)
+    finally:
+        stop.set()
+    wall = time.monotonic() - wall_start
+    cpu = time.thread_time() - cpu_start
+    os.close(slave_fd)
+    os.close(master_fd)
+    writer.join(1)
+
+    data = result["stdout"].encode("utf-8")
+    megabytes = result["bytesRead"] / 1e6
+    return {
+        "baudRate": baud_rate,
+        "offeredBytesPerSec": "unpaced" if unpaced else int(rate),
+        "bytesRead": result["bytesRead"],
+        "seconds": round(wall, 3),
+        "bytesPerSec": int(result["bytesRead"] / wall) if wall else 0,
+        "droppedLines": _dropped_lines(data),
+        "cpuMsPerMB": round(cpu * 1000 / megabytes, 1) if megabytes else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--baud", type=int, nargs="+", default=None, help="baud rates (default: all supported >= 115200)")
+    parser.add_argument("--seconds", type=int, default=2)
+    parser.add_argument("--max-bytes", type=int, default=262144)
+    parser.add_argument("--unpaced", action="store_true", help="write as fast as the pty accepts instead of at line rate")
+    args = parser.parse_args()
+
+    server = _load_server()
+    rates = args.baud or [rate for rate in sorted(server._UART_BAUD_MAP) if rate >= 115200]
+    header = f"{'baud':>9} {'offered B/s':>12} {'read B':>9} {'secs':>6} {'B/s':>10} {'dropped':>8} {'cpu ms/MB':>10}"
+    print(header)
+    for baud_rate in rates:
+        row = bench(server, baud_rate, args.seconds, args.max_bytes, args.unpaced)
+        print(
+            f"{row['baudRate']:>9} {row['offeredBytesPerSec']:>12} {row['bytesRead']:>9} {row['seconds']:>6} "
+            f"{row['bytesPerSec']:>10} {row['droppedLines']:>8} {str(row['cpuMsPerMB']):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,22 +8,79 @@ firmware partition inspection, and guarded deploy commands.
 
 from __future__ import annotations
 
+import array
+import atexit
+import bisect
+import codecs
+import contextvars
 import datetime as dt
 import glob
+import grp
+import gzip
+import hashlib
+import io
 import json
+import mmap
 import os
+import platform
+import pwd
 import re
 import select
+import shlex
+import shutil
+import signal
+import socket
 import subprocess
 import sys
+import tempfile
 import termios
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 
 DEFAULT_CONFIG = ".cursor/mcp/nix-ops.config.json"
 DEFAULT_AUDIT_LOG = ".cursor/mcp/audit.log"
 DEFAULT_UART_CACHE_LOG = ".cursor/mcp/uart-cache.log"
+DEFAULT_UART_CACHE_DIR = ".cursor/mcp/uart-cache"
+DEFAULT_UART_CACHE_SEGMENT_BYTES = 8 * 1024 * 1024
+DEFAULT_UART_CACHE_SEGMENT_MAX_AGE_HOURS = 24
+DEFAULT_UART_CACHE_MAX_TOTAL_BYTES = 256 * 1024 * 1024
+DEFAULT_UART_CACHE_MAX_AGE_DAYS = 90
+DEFAULT_UART_CACHE_DECOMPRESSED_SEGMENTS = 4
+DEFAULT_UART_RING_BYTES = 1024 * 1024
+DEFAULT_UART_BACKGROUND_FLUSH_SECONDS = 5.0
+DEFAULT_UART_TRIGGER_CARRY_CHARS = 4096
+DEFAULT_OUTPUT_SPOOL_DIR = ".cursor/mcp/output-spool"
+DEFAULT_OUTPUT_HEAD_BYTES = 64 * 1024
+DEFAULT_OUTPUT_TAIL_BYTES = 256 * 1024
+DEFAULT_OUTPUT_SPOOL_KEEP = 32
+DEFAULT_OUTPUT_SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_JOB_HISTORY = 50
+DEFAULT_EVAL_CACHE_PATH = ".cursor/mcp/eval-cache.json"
+DEFAULT_EVAL_CACHE_MAX_ENTRIES = 512
+DEFAULT_EVAL_CONCURRENCY = 4
+DEFAULT_DIFF_CACHE_DIR = ".cursor/mcp/diff-cache"
+DEFAULT_DIFF_CACHE_KEEP = 256
+DEFAULT_BUILD_TELEMETRY_TOP = 20
+DEFAULT_DIAGNOSTICS_MAX = 200
+DEFAULT_BUILDER_STATS_PATH = ".cursor/mcp/builder-stats.json"
+DEFAULT_BUILDER_PROBE_SECONDS = 30
+DEFAULT_BUILDER_MIN_FREE_GIB = 10
+DEFAULT_EVAL_REPL_IDLE_SECONDS = 600
+DEFAULT_EVAL_REPL_MAX_RELOADS = 10
+DEFAULT_AUDIT_LOG_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_AUDIT_LOG_MAX_AGE_DAYS = 30
+DEFAULT_AUDIT_LOG_KEEP = 5
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_SSH_CONTROL_IDLE_SECONDS = 300
+DEFAULT_SSH_CONTROL_CHECK_SECONDS = 30
+DEFAULT_FLEET_CONCURRENCY = 4
+DEFAULT_SCAN_SAMPLES = 3
+DEFAULT_SCAN_TIMEOUT_SECONDS = 2.0
 
 _DEBUG = os.environ.get("NIX_OPS_MCP_DEBUG", "").lower() in ("1", "true", "yes")
 
@@ -134,12 +191,18 @@ def _read_message() -> Optional[Dict[str, Any]]:
         _debug("read_message: unrecognized line, skipping")
 
 
+# Tool calls run on worker threads, so responses can be written out of order;
+# the lock keeps each framed message contiguous on stdout.
+_WRITE_LOCK = threading.Lock()
+
+
 def _write_message(payload: Dict[str, Any]) -> None:
     raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=True).encode("utf-8")
-    out = sys.stdout.buffer
-    out.write(raw)
-    out.write(b"\n")
-    out.flush()
+    with _WRITE_LOCK:
+        out = sys.stdout.buffer
+        out.write(raw)
+        out.write(b"\n")
+        out.flush()
 
 
 def _jsonrpc_result(request_id: Any, result: Any) -> Dict[str, Any]:
@@ -155,9 +218,149 @@ def _jsonrpc_error(request_id: Any, code: int, message: str, data: Any = None) -
 
 _NOTIFICATION = object()
 
+# JSON-RPC id of the tool call running in the current context. Set by the
+# dispatcher so subprocesses spawned by a handler can be tied back to it.
+_CURRENT_REQUEST: contextvars.ContextVar[Any] = contextvars.ContextVar("nix_ops_current_request", default=None)
+
+
+def _kill_process_group(proc: subprocess.Popen, sig: int = signal.SIGTERM) -> None:
+    if proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        try:
+            proc.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+
+class _RequestRegistry:
+    """In-flight tool calls and the subprocesses they spawned.
+
+    `notifications/cancelled` marks the request as cancelled and kills its
+    process groups; the dispatcher then drops the response as the spec asks.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._procs: Dict[Any, List[subprocess.Popen]] = {}
+        self._cancelled: set = set()
+
+    def begin(self, request_id: Any) -> None:
+        with self._lock:
+            self._procs.setdefault(request_id, [])
+            self._cancelled.discard(request_id)
+
+    def finish(self, request_id: Any) -> bool:
+        """Forget a request; returns True if it was cancelled meanwhile."""
+        with self._lock:
+            self._procs.pop(request_id, None)
+            if request_id in self._cancelled:
+                self._cancelled.discard(request_id)
+                return True
+            return False
+
+    def attach(self, proc: subprocess.Popen) -> None:
+        request_id = _CURRENT_REQUEST.get()
+        if request_id is None:
+            return
+        with self._lock:
+            if request_id in self._cancelled:
+                _kill_process_group(proc)
+                return
+            self._procs.setdefault(request_id, []).append(proc)
+
+    def detach(self, proc: subprocess.Popen) -> None:
+        request_id = _CURRENT_REQUEST.get()
+        if request_id is None:
+            return
+        with self._lock:
+            procs = self._procs.get(request_id)
+            if procs and proc in procs:
+                procs.remove(proc)
+
+    def is_cancelled(self, request_id: Any) -> bool:
+        with self._lock:
+            return request_id in self._cancelled
+
+    def cancel(self, request_id: Any) -> int:
+        with self._lock:
+            if request_id not in self._procs:
+                return 0
+            self._cancelled.add(request_id)
+            procs = list(self._procs.get(request_id, []))
+        for proc in procs:
+            _kill_process_group(proc)
+        _debug(f"cancel: request={request_id} killed={len(procs)}")
+        return len(procs)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._procs)
+
+
+_REQUESTS = _RequestRegistry()
+
+# Progress reporter of the tool call running in the current context; only set
+# when the client sent `_meta.progressToken` with tools/call.
+_CURRENT_PROGRESS: contextvars.ContextVar[Any] = contextvars.ContextVar("nix_ops_current_progress", default=None)
+
+# Latest-phase detection for nix / nixos-rebuild output, first match wins.
+_NIX_PHASE_PATTERNS: List[Tuple[re.Pattern, str]] = [
+    (re.compile(r"^building '/nix/store/[0-9a-z]{32}-(.+?)\.drv'"), "building {0}"),
+    (re.compile(r"^these (\d+) derivations will be built"), "planning: {0} derivations to build"),
+    (re.compile(r"^these (\d+) paths will be fetched"), "planning: {0} paths to fetch"),
+    (re.compile(r"^copying path '/nix/store/[0-9a-z]{32}-([^']+)'"), "fetching {0}"),
+    (re.compile(r"^copying (\d+) paths"), "copying {0} paths"),
+    (re.compile(r"^checking (?:flake output|NixOS configuration|derivation) '?([^']+)'?"), "checking {0}"),
+    (re.compile(r"^evaluating (?:derivation )?'?([^']+)'?"), "evaluating {0}"),
+    (re.compile(r"^(?:activating the configuration|setting up /etc|reloading user units|restarting sysinit-reactivation|updating GRUB|switching to)"), "activating"),
+    (re.compile(r"^host (\S+) (built|failed)"), "host {0} {1}"),
+    (re.compile(r"^error:"), "error"),
+]
+
+
+class _ProgressReporter:
+    """Emits `notifications/progress` for one tool call, at most every `interval` seconds.
+
+    `progress` is the number of output lines seen so far, so it only grows;
+    `message` carries the latest recognised phase.
+    """
+
+    def __init__(self, token: Any, interval: float = 0.5) -> None:
+        self.token = token
+        self.interval = interval
+        self.phase = "running"
+        self.lines = {"stdout": 0, "stderr": 0}
+        self._lock = threading.Lock()
+        self._last_sent = 0.0
+
+    def line(self, stream: str, text: str) -> None:
+        with self._lock:
+            self.lines[stream] += 1
+            for pattern, template in _NIX_PHASE_PATTERNS:
+                match = pattern.search(text)
+                if match:
+                    self.phase = template.format(*match.groups())
+                    break
+            now = time.monotonic()
+            if now - self._last_sent < self.interval:
+                return
+            self._last_sent = now
+            params = {
+                "progressToken": self.token,
+                "progress": self.lines["stdout"] + self.lines["stderr"],
+                "message": f"{self.phase} ({self.lines['stdout']} stdout / {self.lines['stderr']} stderr lines)",
+            }
+        try:
+            _write_message({"jsonrpc": "2.0", "method": "notifications/progress", "params": params})
+        except (BrokenPipeError, ValueError, OSError) as exc:
+            _debug(f"progress: write failed: {exc}")
+
 
 def _tool_result(payload: Dict[str, Any]) -> Dict[str, Any]:
-    text = json.dumps(payload, indent=2, ensure_ascii=True)
+    text = json.dumps(payload, separators=(",", ":"), ensure_ascii=True)
     return {"content": [{"type": "text", "text": text}]}
 
 
@@ -174,6 +377,10 @@ def _load_config() -> Dict[str, Any]:
             "allowMutations": False,
             "approvalSalt": "",
             "uartCacheLog": DEFAULT_UART_CACHE_LOG,
+            "uartCacheDir": DEFAULT_UART_CACHE_DIR,
+            "maxWorkers": DEFAULT_MAX_WORKERS,
+            "sshControlMaster": True,
+            "sshControlIdleSeconds": DEFAULT_SSH_CONTROL_IDLE_SECONDS,
         }
     with config_path.open("r", encoding="utf-8") as handle:
         data = json.load(handle)
@@ -183,30 +390,652 @@ def _load_config() -> Dict[str, Any]:
     data.setdefault("allowMutations", False)
     data.setdefault("approvalSalt", "")
     data.setdefault("uartCacheLog", DEFAULT_UART_CACHE_LOG)
+    data.setdefault("uartCacheDir", DEFAULT_UART_CACHE_DIR)
+    data.setdefault("maxWorkers", DEFAULT_MAX_WORKERS)
+    data.setdefault("sshControlMaster", True)
+    data.setdefault("sshControlIdleSeconds", DEFAULT_SSH_CONTROL_IDLE_SECONDS)
     return data
 
 
+_AUDIT_LOCK = threading.Lock()
+_AUDIT_AGE_CHECKED: Dict[str, float] = {}
+
+
+def _rotate_audit_log(log_path: Path, config: Dict[str, Any]) -> None:
+    """Gzip audit.log aside once it is too big or its first record too old.
+
+    Size is checked on every append (one stat); age only hourly, since it
+    means reading the first record. Only `auditLogKeep` archives are kept.
+    """
+    try:
+        size = log_path.stat().st_size
+    except FileNotFoundError:
+        return
+    rotate = size >= int(config.get("auditLogMaxBytes", DEFAULT_AUDIT_LOG_MAX_BYTES))
+    now = time.monotonic()
+    if not rotate and now - _AUDIT_AGE_CHECKED.get(str(log_path), -3600.0) >= 3600:
+        _AUDIT_AGE_CHECKED[str(log_path)] = now
+        max_age = dt.timedelta(days=float(config.get("auditLogMaxAgeDays", DEFAULT_AUDIT_LOG_MAX_AGE_DAYS)))
+        with log_path.open("r", encoding="utf-8") as handle:
+            try:
+                first_ts = json.loads(handle.readline()).get("ts")
+                rotate = bool(first_ts) and _utcnow() - _parse_ts(first_ts) > max_age
+            except (json.JSONDecodeError, AttributeError, ValueError):
+                pass
+    if not rotate:
+        return
+    archive = log_path.with_name(f"{log_path.name}.{_utcnow().strftime('%Y%m%dT%H%M%S%fZ')}.gz")
+    with log_path.open("rb") as src, gzip.open(archive, "wb") as dst:
+        while True:
+            chunk = src.read(1 << 20)
+            if not chunk:
+                break
+            dst.write(chunk)
+    log_path.unlink()
+    archives = sorted(log_path.parent.glob(f"{log_path.name}.*.gz"))
+    keep = int(config.get("auditLogKeep", DEFAULT_AUDIT_LOG_KEEP))
+    for old in archives[: max(0, len(archives) - keep)]:
+        old.unlink(missing_ok=True)
+    _debug(f"audit: rotated {log_path} -> {archive.name}")
+
+
 def _append_audit(event: Dict[str, Any], config: Dict[str, Any]) -> None:
-    log_path = Path(config.get("auditLog", DEFAULT_AUDIT_LOG))
-    if not log_path.is_absolute():
-        log_path = Path(config.get("repoRoot", Path.cwd())) / log_path
+    log_path = _repo_path(config, "auditLog", DEFAULT_AUDIT_LOG)
     log_path.parent.mkdir(parents=True, exist_ok=True)
     record = {
         "ts": _utcnow().isoformat(),
         **event,
     }
-    with log_path.open("a", encoding="utf-8") as handle:
-        handle.write(json.dumps(record, ensure_ascii=True) + "\n")
+    with _AUDIT_LOCK:
+        _rotate_audit_log(log_path, config)
+        with log_path.open("a", encoding="utf-8") as handle:
+            handle.write(json.dumps(record, ensure_ascii=True) + "\n")
+
+
+def _repo_path(config: Dict[str, Any], key: str, default: str) -> Path:
+    path = Path(config.get(key, default))
+    if not path.is_absolute():
+        path = Path(config.get("repoRoot", Path.cwd())) / path
+    return path
+
+
+_INDEX_ENTRY = array.array("Q").itemsize
+
+try:
+    from re import _parser as _sre_parse  # Python >= 3.11
+except ImportError:  # pragma: no cover - older interpreters
+    import sre_parse as _sre_parse  # type: ignore[no-redef]
+
+# Line bodies are stored verbatim, so any literal except a line break can be
+# searched for byte-for-byte in the mmap'd segment.
+_LINE_BREAKS = frozenset(map(ord, "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"))
+
+
+def _required_literal(matcher: re.Pattern) -> Optional[bytes]:
+    """Longest literal run every match of a top-level regex must contain.
+
+    Only plain concatenations are analysed; alternations, classes and
+    case-insensitive patterns return None and take the regex-only path.
+    """
+    if matcher.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = _sre_parse.parse(matcher.pattern, matcher.flags)
+    except Exception:
+        return None
+    best: List[int] = []
+    run: List[int] = []
+    for op, arg in parsed:
+        if op is _sre_parse.LITERAL and arg not in _LINE_BREAKS:
+            run.append(arg)
+            continue
+        if len(run) > len(best):
+            best = run
+        run = []
+    if len(run) > len(best):
+        best = run
+    literal = "".join(map(chr, best)).encode("utf-8")
+    return literal if len(literal) >= 2 else None
+
+
+def _parse_ts(value: Any) -> dt.datetime:
+    parsed = dt.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return parsed
+
+
+def _cache_ts(value: Any) -> Optional[dt.datetime]:
+    """Like _parse_ts for stored values: unparseable stamps never filter anything out."""
+    if not value:
+        return None
+    try:
+        return _parse_ts(value)
+    except ValueError:
+        return None
+
+
+# Capture header fields copied into the .tix index and onto every line a
+# reader returns; everything else in the header stays in the segment.
+_CAPTURE_LINE_FIELDS = ("ts", "device", "baudRate", "emptyCapture")
+
+
+class _UartCacheStore:
+    """Segmented UART line cache with sidecar line-offset and capture indexes.
 
+    Each capture is stored once in a `seg-<firstLine>.ucap` segment as a
+    JSON header line (ts, device, baudRate, seconds, maxBytes, bytesRead,
+    lineCount, bodyBytes) followed by its console lines verbatim, each
+    terminated by a newline. Per-line metadata is never repeated.
 
-def _uart_cache_path(config: Dict[str, Any]) -> Path:
-    cache_path = Path(config.get("uartCacheLog", DEFAULT_UART_CACHE_LOG))
-    if not cache_path.is_absolute():
-        cache_path = Path(config.get("repoRoot", Path.cwd())) / cache_path
-    return cache_path
+    `seg-<firstLine>.idx` holds the byte offset of every console line as
+    native uint64. Line numbers are global and derived from the segment
+    name plus the index size, so a range read stats the segment list, seeks
+    into one index and then into the data file - memory stays flat no matter
+    how large the cache grows. A new segment starts once the current one
+    passes `uartCacheSegmentBytes`; captures are never split across segments.
+
+    `seg-<firstLine>.tix` lists the captures in the segment (captureId = its
+    first line number, line span, header offset, timestamp, device). Readers
+    attach capture metadata from it, and searches consult it first so time,
+    capture and device filters skip whole segments and captures without
+    touching their data.
+
+    The active segment also rolls once its first capture is older than
+    `segment_max_age`. Sealed segments are gzipped (`.ucap.gz`; offsets in
+    the index still refer to the uncompressed body) and read back through a
+    small LRU of decompressed segments. Retention drops the oldest sealed
+    segments beyond `max_total_bytes` or `max_age`; line numbers of what
+    remains never change, the cache just starts at a later line.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        segment_bytes: int = DEFAULT_UART_CACHE_SEGMENT_BYTES,
+        legacy_log: Optional[Path] = None,
+        *,
+        compress: bool = True,
+        segment_max_age: Optional[dt.timedelta] = None,
+        max_total_bytes: Optional[int] = None,
+        max_age: Optional[dt.timedelta] = None,
+        decompressed_segments: int = DEFAULT_UART_CACHE_DECOMPRESSED_SEGMENTS,
+    ) -> None:
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.legacy_log = legacy_log
+        self.compress = compress
+        self.segment_max_age = segment_max_age
+        self.max_total_bytes = max_total_bytes
+        self.max_age = max_age
+        self.decompressed_segments = max(1, decompressed_segments)
+        self._lock = threading.Lock()
+        self._migrated = False
+        self._lru: "OrderedDict[Path, bytes]" = OrderedDict()
+        self._lru_lock = threading.Lock()
+
+    # Segment bookkeeping -------------------------------------------------
+
+    def _sidecar(self, first: int, suffix: str) -> Path:
+        return self.root / f"seg-{first:012d}{suffix}"
+
+    def _segments(self) -> List[Tuple[int, Path, Path]]:
+        if not self.root.is_dir():
+            return []
+        found: Dict[int, Path] = {}
+        for data_path in self.root.glob("seg-*.ucap*"):
+            if data_path.suffix not in (".ucap", ".gz"):
+                continue
+            try:
+                first = int(data_path.name.split(".", 1)[0].split("-", 1)[1])
+            except (IndexError, ValueError):
+                continue
+            # Mid-seal both files exist briefly; the plain one is authoritative.
+            if first not in found or data_path.suffix == ".ucap":
+                found[first] = data_path
+        return [(first, found[first], self._sidecar(first, ".idx")) for first in sorted(found)]
+
+    def _read_data(self, data_path: Path) -> Any:
+        """Open a segment for reading: a real file, or the LRU copy of a sealed one."""
+        if data_path.suffix != ".gz":
+            try:
+                return data_path.open("rb")
+            except FileNotFoundError:
+                # Sealed between listing and opening.
+                data_path = data_path.with_name(data_path.name + ".gz")
+        return io.BytesIO(self._decompressed(data_path))
+
+    def _decompressed(self, data_path: Path) -> bytes:
+        with self._lru_lock:
+            cached = self._lru.get(data_path)
+            if cached is not None:
+                self._lru.move_to_end(data_path)
+                return cached
+        with gzip.open(data_path, "rb") as handle:
+            body = handle.read()
+        with self._lru_lock:
+            self._lru[data_path] = body
+            while len(self._lru) > self.decompressed_segments:
+                self._lru.popitem(last=False)
+        return body
+
+    def _seal(self, first: int, data_path: Path) -> None:
+        if not self.compress or data_path.suffix != ".ucap" or not data_path.exists():
+            return
+        sealed = data_path.with_name(data_path.name + ".gz")
+        tmp = sealed.with_name(sealed.name + ".tmp")
+        with data_path.open("rb") as src, gzip.open(tmp, "wb", compresslevel=6) as dst:
+            while True:
+                chunk = src.read(1 << 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        tmp.rename(sealed)
+        data_path.unlink()
+        _debug(f"uart_cache: sealed seg-{first:012d} ({sealed.stat().st_size} bytes compressed)")
+
+    def _apply_retention(self) -> None:
+        segments = self._segments()
+        sealed = segments[:-1]
+        total = sum(p.stat().st_size + idx.stat().st_size for _, p, idx in segments if p.exists() and idx.exists())
+        now = _utcnow()
+        for first, data_path, idx_path in sealed:
+            too_big = self.max_total_bytes is not None and total > self.max_total_bytes
+            too_old = False
+            if self.max_age is not None:
+                entries = self.captures(data_path, idx_path, first, locked=True)
+                last_ts = _cache_ts(entries[-1].get("lastTs")) if entries else None
+                too_old = last_ts is not None and now - last_ts > self.max_age
+            if not (too_big or too_old):
+                break
+            size = data_path.stat().st_size + idx_path.stat().st_size
+            for path in (data_path, idx_path, self._sidecar(first, ".tix")):
+                path.unlink(missing_ok=True)
+            with self._lru_lock:
+                self._lru.pop(data_path, None)
+            total -= size
+            _debug(f"uart_cache: retention dropped seg-{first:012d} ({'size' if too_big else 'age'})")
+
+    def maintain(self) -> None:
+        """Seal any unsealed old segments and apply retention (e.g. after a config change)."""
+        with self._lock:
+            self._ensure_migrated()
+            for first, data_path, _ in self._segments()[:-1]:
+                self._seal(first, data_path)
+            self._apply_retention()
+
+    @staticmethod
+    def _line_count(idx_path: Path) -> int:
+        try:
+            return idx_path.stat().st_size // _INDEX_ENTRY
+        except FileNotFoundError:
+            return 0
+
+    def _ensure_migrated(self) -> None:
+        """Convert the original single-file `uart-cache.log` once, then set it aside.
+
+        It stores one JSON object per line, and lines of one capture share ts
+        and device. Line numbers are preserved because captures are
+        re-appended in order.
+        """
+        if self._migrated:
+            return
+        self._migrated = True
+        if self._segments() or self.legacy_log is None or not self.legacy_log.is_file():
+            return
+        self._import_legacy_log(self.legacy_log)
+        self.legacy_log.rename(self.legacy_log.with_name(self.legacy_log.name + ".migrated"))
+        _debug(f"uart_cache: migrated {self.legacy_log} into {self.root}")
+
+    def _import_legacy_log(self, source: Path) -> None:
+        group: List[Dict[str, Any]] = []
+
+        def flush() -> None:
+            header = {k: group[0][k] for k in ("ts", "device", "baudRate", "seconds", "maxBytes", "bytesRead") if k in group[0]}
+            if group[0].get("emptyCapture"):
+                header["emptyCapture"] = True
+            self._append_locked(header, [str(r.get("line", "")) for r in group])
+
+        with source.open("r", encoding="utf-8") as handle:
+            for raw in handle:
+                raw = raw.strip()
+                if not raw:
+                    continue
+                try:
+                    parsed = json.loads(raw)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(parsed, dict):
+                    continue
+                if group and (parsed.get("ts"), parsed.get("device")) != (group[0].get("ts"), group[0].get("device")):
+                    flush()
+                    group = []
+                group.append(parsed)
+        if group:
+            flush()
+
+    def first_line(self) -> int:
+        segments = self._segments()
+        return segments[0][0] if segments else 1
+
+    def total_lines(self) -> int:
+        with self._lock:
+            self._ensure_migrated()
+        segments = self._segments()
+        if not segments:
+            return 0
+        first, _, idx_path = segments[-1]
+        return first + self._line_count(idx_path) - segments[0][0]
+
+    # Writing -------------------------------------------------------------
+
+    def _append_locked(self, header: Dict[str, Any], lines: List[str]) -> int:
+        self.root.mkdir(parents=True, exist_ok=True)
+        segments = self._segments()
+        if segments:
+            seg_first, data_path, idx_path = segments[-1]
+            next_line = seg_first + self._line_count(idx_path)
+            if data_path.suffix == ".gz" or self._should_roll(seg_first, data_path):
+                self._seal(seg_first, data_path)
+                seg_first = next_line
+                data_path = self._sidecar(seg_first, ".ucap")
+                idx_path = self._sidecar(seg_first, ".idx")
+                self._apply_retention()
+        else:
+            seg_first = next_line = 1
+            data_path = self._sidecar(seg_first, ".ucap")
+            idx_path = self._sidecar(seg_first, ".idx")
+
+        body = [line.encode("utf-8", errors="replace") + b"\n" for line in lines]
+        header = {**header, "captureId": next_line, "lineCount": len(body), "bodyBytes": sum(map(len, body))}
+        offsets = array.array("Q")
+        with data_path.open("ab") as data:
+            data.seek(0, os.SEEK_END)
+            header_offset = data.tell()
+            data.write(json.dumps(header, ensure_ascii=True).encode("utf-8") + b"\n")
+            position = data.tell()
+            for encoded in body:
+                offsets.append(position)
+                position += len(encoded)
+            data.write(b"".join(body))
+        # The index is written after the data, so a torn write leaves at most
+        # unreferenced bytes at the end of the segment, never a dangling offset.
+        with idx_path.open("ab") as idx:
+            offsets.tofile(idx)
+        with self._sidecar(seg_first, ".tix").open("a", encoding="utf-8") as tix:
+            tix.write(json.dumps(self._capture_entry(header, header_offset), ensure_ascii=True) + "\n")
+        return next_line
+
+    def _should_roll(self, first: int, data_path: Path) -> bool:
+        if data_path.stat().st_size >= self.segment_bytes:
+            return True
+        if self.segment_max_age is None:
+            return False
+        try:
+            with self._sidecar(first, ".tix").open("r", encoding="utf-8") as tix:
+                opened = _cache_ts(json.loads(tix.readline()).get("firstTs"))
+        except (OSError, json.JSONDecodeError, AttributeError):
+            return False
+        return opened is not None and _utcnow() - opened > self.segment_max_age
+
+    def append_capture(self, header: Dict[str, Any], lines: List[str]) -> int:
+        """Append one capture; returns the line number of its first line."""
+        with self._lock:
+            self._ensure_migrated()
+            return self._append_locked(header, lines)
+
+    @staticmethod
+    def _capture_entry(header: Dict[str, Any], header_offset: int) -> Dict[str, Any]:
+        entry = {
+            "captureId": header["captureId"],
+            "firstLine": header["captureId"],
+            "lineCount": header["lineCount"],
+            "headerOffset": header_offset,
+            "firstTs": header.get("startedAt", header.get("ts")),
+            "lastTs": header.get("ts"),
+        }
+        for key in _CAPTURE_LINE_FIELDS + ("startedAt", "lineMs"):
+            if key in header:
+                entry[key] = header[key]
+        return entry
+
+    def captures(self, data_path: Path, idx_path: Path, first: int, *, locked: bool = False) -> List[Dict[str, Any]]:
+        """Capture/time index of one segment, rebuilt from the headers if missing or stale."""
+        count = self._line_count(idx_path)
+        tix_path = self._sidecar(first, ".tix")
+        entries: List[Dict[str, Any]] = []
+        if tix_path.exists():
+            with tix_path.open("r", encoding="utf-8") as handle:
+                for raw in handle:
+                    try:
+                        entries.append(json.loads(raw))
+                    except json.JSONDecodeError:
+                        entries = []
+                        break
+        if sum(int(e.get("lineCount", 0)) for e in entries) == count:
+            return entries
+        entries = []
+        indexed_end = first + count
+        with self._read_data(data_path) as data:
+            while True:
+                header_offset = data.tell()
+                raw = data.readline()
+                if not raw:
+                    break
+                try:
+                    header = json.loads(raw)
+                except json.JSONDecodeError:
+                    break
+                # Stop at a capture whose index append never landed.
+                if header.get("captureId", indexed_end) + header.get("lineCount", 0) > indexed_end:
+                    break
+                entries.append(self._capture_entry(header, header_offset))
+                data.seek(int(header.get("bodyBytes", 0)), os.SEEK_CUR)
+        if not locked:
+            self._lock.acquire()
+        try:
+            with tix_path.open("w", encoding="utf-8") as tix:
+                for entry in entries:
+                    tix.write(json.dumps(entry, ensure_ascii=True) + "\n")
+        finally:
+            if not locked:
+                self._lock.release()
+        return entries
+
+    @staticmethod
+    def _record(entry: Dict[str, Any], raw: bytes) -> Dict[str, Any]:
+        record = {key: entry[key] for key in _CAPTURE_LINE_FIELDS if key in entry}
+        record["line"] = raw.rstrip(b"\n").decode("utf-8", errors="replace")
+        return record
+
+    @staticmethod
+    def _stamp(entry: Dict[str, Any], record: Dict[str, Any], line_number: int) -> Dict[str, Any]:
+        """Add the line's own arrival time for captures that recorded one."""
+        line_ms = entry.get("lineMs")
+        started = _cache_ts(entry.get("startedAt"))
+        index = line_number - entry["firstLine"]
+        if line_ms and started is not None and 0 <= index < len(line_ms):
+            record["offsetMs"] = line_ms[index]
+            record["lineTs"] = (started + dt.timedelta(milliseconds=line_ms[index])).isoformat()
+        return record
+
+    def capture_entries(self, device: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Capture index entries across all segments, oldest first."""
+        with self._lock:
+            self._ensure_migrated()
+        entries: List[Dict[str, Any]] = []
+        for first, data_path, idx_path in self._segments():
+            for entry in self.captures(data_path, idx_path, first):
+                if device and entry.get("device") != device:
+                    continue
+                entries.append(entry)
+        return entries
+
+    # Reading -------------------------------------------------------------
+
+    def iter_range(self, start_line: int, end_line: int) -> Any:
+        """Yield (lineNumber, record, captureId) for the inclusive range, seeking via the index."""
+        with self._lock:
+            self._ensure_migrated()
+        for first, data_path, idx_path in self._segments():
+            count = self._line_count(idx_path)
+            last = first + count - 1
+            if count == 0 or last < start_line:
+                continue
+            if first > end_line:
+                break
+            lo = max(start_line, first)
+            hi = min(end_line, last)
+            entries = self.captures(data_path, idx_path, first)
+            starts = [e["firstLine"] for e in entries]
+            with idx_path.open("rb") as idx:
+                idx.seek((lo - first) * _INDEX_ENTRY)
+                offsets = array.array("Q")
+                offsets.fromfile(idx, hi - lo + 1)
+            with self._read_data(data_path) as data:
+                for line_number, offset in zip(range(lo, hi + 1), offsets):
+                    entry = entries[bisect.bisect_right(starts, line_number) - 1]
+                    data.seek(offset)
+                    record = self._stamp(entry, self._record(entry, data.readline()), line_number)
+                    yield line_number, record, entry["captureId"]
+
+    def search(
+        self,
+        matcher: re.Pattern,
+        *,
+        device: Optional[str] = None,
+        since: Optional[dt.datetime] = None,
+        until: Optional[dt.datetime] = None,
+        capture_id: Optional[int] = None,
+        stats: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        """Yield (lineNumber, record, captureId) for matching lines, in order.
+
+        The caller stops iterating at its limit, so a query reads no further
+        than its last match. Each segment's capture index narrows the scan to
+        line spans that satisfy the filters; inside a span the mmap'd (or
+        decompressed) body is searched for the pattern's required literal
+        before any line is decoded.
+        """
+        stats = stats if stats is not None else {}
+        stats.update({"segmentsScanned": 0, "capturesScanned": 0, "linesDecoded": 0})
+        literal = _required_literal(matcher)
+        stats["prefilterLiteral"] = literal.decode("utf-8") if literal else None
+        with self._lock:
+            self._ensure_migrated()
+        for first, data_path, idx_path in self._segments():
+            count = self._line_count(idx_path)
+            if count == 0:
+                continue
+            if capture_id is not None and not first <= capture_id < first + count:
+                continue
+            spans: List[Dict[str, Any]] = []
+            for entry in self.captures(data_path, idx_path, first):
+                if capture_id is not None and entry["captureId"] != capture_id:
+                    continue
+                if device and entry.get("device") != device:
+                    continue
+                last_ts = _cache_ts(entry.get("lastTs"))
+                first_ts = _cache_ts(entry.get("firstTs"))
+                if since and last_ts and last_ts < since:
+                    continue
+                if until and first_ts and first_ts > until:
+                    continue
+                spans.append(entry)
+            if not spans:
+                continue
+            stats["segmentsScanned"] += 1
+            stats["capturesScanned"] += len(spans)
+            offsets = array.array("Q")
+            with idx_path.open("rb") as idx:
+                offsets.fromfile(idx, count)
+            if data_path.suffix == ".gz":
+                stats["compressedSegments"] = stats.get("compressedSegments", 0) + 1
+                body = self._decompressed(data_path)
+                for entry in spans:
+                    yield from self._scan_span(body, offsets, first, entry, matcher, literal, since, until, stats)
+                continue
+            try:
+                data = data_path.open("rb")
+            except FileNotFoundError:
+                body = self._decompressed(data_path.with_name(data_path.name + ".gz"))
+                for entry in spans:
+                    yield from self._scan_span(body, offsets, first, entry, matcher, literal, since, until, stats)
+                continue
+            with data:
+                if os.fstat(data.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for entry in spans:
+                        yield from self._scan_span(mm, offsets, first, entry, matcher, literal, since, until, stats)
+
+    def _scan_span(
+        self,
+        mm: Any,
+        offsets: array.array,
+        first: int,
+        entry: Dict[str, Any],
+        matcher: re.Pattern,
+        literal: Optional[bytes],
+        since: Optional[dt.datetime],
+        until: Optional[dt.datetime],
+        stats: Dict[str, Any],
+    ) -> Any:
+        if entry.get("emptyCapture"):
+            return
+        if since or until:
+            ts = _cache_ts(entry.get("ts"))
+            if ts and ((since and ts < since) or (until and ts > until)):
+                return
+        lo = entry["firstLine"] - first
+        hi = lo + entry["lineCount"] - 1
+        # A capture's body is contiguous and ends with its last line's newline.
+        end = mm.find(b"\n", offsets[hi]) + 1
+        pos = offsets[lo]
+        while pos < end:
+            if literal is not None:
+                hit = mm.find(literal, pos, end)
+                if hit < 0:
+                    return
+                # Snap back to the start of the line containing the hit.
+                local = bisect.bisect_right(offsets, hit, lo, hi + 1) - 1
+                pos = offsets[local]
+            else:
+                local = bisect.bisect_right(offsets, pos, lo, hi + 1) - 1
+            line_end = mm.find(b"\n", pos, end) + 1
+            raw = mm[pos:line_end]
+            stats["linesDecoded"] += 1
+            pos = line_end
+            record = self._record(entry, raw)
+            if matcher.search(record["line"]):
+                yield first + local, self._stamp(entry, record, first + local), entry["captureId"]
+
+
+def _uart_cache_store(config: Dict[str, Any]) -> _UartCacheStore:
+    # A null/0 limit in config disables that rotation or retention rule.
+    def hours(key: str, default: float) -> Optional[dt.timedelta]:
+        value = config.get(key, default)
+        return dt.timedelta(hours=float(value)) if value else None
+
+    def days(key: str, default: float) -> Optional[dt.timedelta]:
+        value = config.get(key, default)
+        return dt.timedelta(days=float(value)) if value else None
+
+    max_total = config.get("uartCacheMaxTotalBytes", DEFAULT_UART_CACHE_MAX_TOTAL_BYTES)
+    return _UartCacheStore(
+        _repo_path(config, "uartCacheDir", DEFAULT_UART_CACHE_DIR),
+        int(config.get("uartCacheSegmentBytes", DEFAULT_UART_CACHE_SEGMENT_BYTES)),
+        legacy_log=_repo_path(config, "uartCacheLog", DEFAULT_UART_CACHE_LOG),
+        compress=str(config.get("uartCacheCompression", "gzip")).lower() == "gzip",
+        segment_max_age=hours("uartCacheSegmentMaxAgeHours", DEFAULT_UART_CACHE_SEGMENT_MAX_AGE_HOURS),
+        max_total_bytes=int(max_total) if max_total else None,
+        max_age=days("uartCacheMaxAgeDays", DEFAULT_UART_CACHE_MAX_AGE_DAYS),
+        decompressed_segments=int(config.get("uartCacheDecompressedSegments", DEFAULT_UART_CACHE_DECOMPRESSED_SEGMENTS)),
+    )
 
 
 def _append_uart_cache_capture(
+    store: _UartCacheStore,
     *,
     device: str,
     baud_rate: int,
@@ -214,65 +1043,243 @@ def _append_uart_cache_capture(
     max_bytes: int,
     bytes_read: int,
     stdout_text: str,
-    config: Dict[str, Any],
+    started_at: Optional[str] = None,
+    line_ms: Optional[List[int]] = None,
 ) -> int:
-    cache_path = _uart_cache_path(config)
-    cache_path.parent.mkdir(parents=True, exist_ok=True)
-    capture_ts = _utcnow().isoformat()
-
-    lines = stdout_text.splitlines()
-    records: List[Dict[str, Any]] = []
-    if lines:
-        for line in lines:
-            records.append(
-                {
-                    "ts": capture_ts,
-                    "device": device,
-                    "baudRate": baud_rate,
-                    "seconds": seconds,
-                    "maxBytes": max_bytes,
-                    "bytesRead": bytes_read,
-                    "line": line,
-                }
-            )
-    else:
-        records.append(
-            {
-                "ts": capture_ts,
-                "device": device,
-                "baudRate": baud_rate,
-                "seconds": seconds,
-                "maxBytes": max_bytes,
-                "bytesRead": bytes_read,
-                "line": "",
-                "emptyCapture": True,
-            }
+    header: Dict[str, Any] = {
+        "ts": _utcnow().isoformat(),
+        "device": device,
+        "baudRate": baud_rate,
+        "seconds": seconds,
+        "maxBytes": max_bytes,
+        "bytesRead": bytes_read,
+    }
+    lines = _split_uart_lines(stdout_text)
+    if started_at:
+        header["startedAt"] = started_at
+        # Per-line arrival offsets only make sense if they line up 1:1.
+        if line_ms is not None and len(line_ms) == len(lines):
+            header["lineMs"] = line_ms
+    if not lines:
+        # Empty captures still occupy one line so they stay visible in ranges.
+        header["emptyCapture"] = True
+        lines = [""]
+    store.append_capture(header, lines)
+    return len(lines)
+
+
+class _StreamCapture:
+    """One command stream held as a head and tail window, spilled to disk when larger.
+
+    Output that fits in `head_chars + tail_chars` stays in memory and is
+    returned verbatim. Past that, everything captured so far (and every later
+    line) goes to `path`, while memory keeps only the first `head_chars` and
+    the last `tail_chars`, so a chatty build costs a bounded amount of RSS.
+    """
+
+    def __init__(self, path: Path, head_chars: int, tail_chars: int) -> None:
+        self.path = path
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.total_bytes = 0
+        self._lines: Optional[List[str]] = []
+        self._size = 0
+        self._head: List[str] = []
+        self._head_size = 0
+        self._tail: deque = deque()
+        self._tail_size = 0
+        self._file: Optional[io.TextIOWrapper] = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._lines is None
+
+    def append(self, line: str) -> None:
+        self.total_bytes += len(line.encode("utf-8", errors="replace"))
+        if self._lines is not None:
+            self._lines.append(line)
+            self._size += len(line)
+            if self._size <= self.head_chars + self.tail_chars:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("w", encoding="utf-8", errors="replace")
+            buffered, self._lines = self._lines, None
+            for pending in buffered:
+                self._window(pending)
+            self._file.write("".join(buffered))
+            return
+        self._window(line)
+        self._file.write(line)
+
+    def _window(self, line: str) -> None:
+        if self._head_size < self.head_chars:
+            piece = line[: self.head_chars - self._head_size]
+            self._head.append(piece)
+            self._head_size += len(piece)
+        if len(line) >= self.tail_chars:
+            self._tail.clear()
+            line = line[-self.tail_chars :]
+            self._tail_size = 0
+        self._tail.append(line)
+        self._tail_size += len(line)
+        while self._tail_size - len(self._tail[0]) >= self.tail_chars:
+            self._tail_size -= len(self._tail.popleft())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def text(self, handle: str, stream: str) -> str:
+        if self._lines is not None:
+            return "".join(self._lines)
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        return (
+            f"{head}\n... [{self.total_bytes} bytes total; middle elided, "
+            f"page with output_page(handle={handle!r}, stream={stream!r})] ...\n{tail}"
         )
 
-    with cache_path.open("a", encoding="utf-8") as handle:
-        for record in records:
-            handle.write(json.dumps(record, ensure_ascii=True) + "\n")
 
-    return len(records)
+class _OutputSpool:
+    """Spill directory for command output, pruned to the newest handles.
 
+    Each spilled command gets a handle `out-<UTC>-<n>` with one file per
+    stream (`<handle>.stdout.log`, `<handle>.stderr.log`).
+    """
 
-def _read_uart_cache_entries(config: Dict[str, Any]) -> List[Dict[str, Any]]:
-    cache_path = _uart_cache_path(config)
-    if not cache_path.exists():
-        return []
-    entries: List[Dict[str, Any]] = []
-    with cache_path.open("r", encoding="utf-8") as handle:
-        for raw in handle:
-            line = raw.strip()
-            if not line:
-                continue
-            try:
-                parsed = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            if isinstance(parsed, dict):
-                entries.append(parsed)
-    return entries
+    def __init__(self) -> None:
+        self.root = Path(tempfile.gettempdir()) / "nix-ops-mcp-output"
+        self.head_chars = DEFAULT_OUTPUT_HEAD_BYTES
+        self.tail_chars = DEFAULT_OUTPUT_TAIL_BYTES
+        self.keep = DEFAULT_OUTPUT_SPOOL_KEEP
+        self.max_bytes = DEFAULT_OUTPUT_SPOOL_MAX_BYTES
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        self.root = _repo_path(config, "outputSpoolDir", DEFAULT_OUTPUT_SPOOL_DIR)
+        self.head_chars = int(config.get("outputHeadBytes", DEFAULT_OUTPUT_HEAD_BYTES))
+        self.tail_chars = int(config.get("outputTailBytes", DEFAULT_OUTPUT_TAIL_BYTES))
+        self.keep = int(config.get("outputSpoolKeep", DEFAULT_OUTPUT_SPOOL_KEEP))
+        self.max_bytes = int(config.get("outputSpoolMaxBytes", DEFAULT_OUTPUT_SPOOL_MAX_BYTES))
+
+    def new_handle(self) -> str:
+        with self._lock:
+            self._counter += 1
+            return f"out-{_utcnow().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self._counter}"
+
+    def capture(self, handle: str, stream: str) -> _StreamCapture:
+        return _StreamCapture(self.path(handle, stream), self.head_chars, self.tail_chars)
+
+    def path(self, handle: str, stream: str) -> Path:
+        if not re.fullmatch(r"out-[0-9TZ]+-\d+-\d+", handle) or stream not in ("stdout", "stderr"):
+            raise ValueError(f"Invalid output handle/stream: {handle!r} {stream!r}")
+        return self.root / f"{handle}.{stream}.log"
+
+    def prune(self, written: Optional[str] = None) -> None:
+        """Drop the oldest handles beyond `keep` or `max_bytes`.
+
+        The newest handle and `written` (the one just handed out in a result)
+        are never dropped, even when alone they exceed `max_bytes`; their
+        size still counts, so older handles make room.
+        """
+        with self._lock:
+            if not self.root.exists():
+                return
+            handles: Dict[str, List[Path]] = {}
+            for path in self.root.glob("out-*.log"):
+                handles.setdefault(path.name.split(".", 1)[0], []).append(path)
+
+            def mtime(paths: List[Path]) -> float:
+                return max(p.stat().st_mtime for p in paths)
+
+            ordered = sorted(handles.items(), key=lambda item: mtime(item[1]), reverse=True)
+            total = 0
+            for index, (name, paths) in enumerate(ordered):
+                total += sum(p.stat().st_size for p in paths)
+                if index == 0 or name == written:
+                    continue
+                if index >= self.keep or total > self.max_bytes:
+                    for path in paths:
+                        path.unlink(missing_ok=True)
+
+    def page(self, handle: str, stream: str, offset: int, max_bytes: int) -> Dict[str, Any]:
+        path = self.path(handle, stream)
+        if not path.exists():
+            return {"error": f"No spilled {stream} for handle {handle} (never spilled, or pruned).", "handle": handle}
+        total = path.stat().st_size
+        if offset < 0:
+            offset = max(0, total + offset)
+        with path.open("rb") as handle_file:
+            handle_file.seek(offset)
+            data = handle_file.read(max_bytes)
+        return {
+            "handle": handle,
+            "stream": stream,
+            "offset": offset,
+            "nextOffset": offset + len(data),
+            "totalBytes": total,
+            "eof": offset + len(data) >= total,
+            "data": data.decode("utf-8", errors="replace"),
+        }
+
+
+_OUTPUT_SPOOL = _OutputSpool()
+
+
+# Bytes per pipe read; also the longest run of output held without a newline.
+_DRAIN_CHUNK = 65536
+
+
+def _drain_stream(
+    pipe: Any,
+    stream: str,
+    sink: _StreamCapture,
+    progress: Optional[_ProgressReporter],
+    line_filter: Optional[Callable[[str], Optional[str]]] = None,
+    scanner: Optional[_DiagnosticsScanner] = None,
+) -> None:
+    """Read a binary pipe in chunks and hand it on line by line.
+
+    Decoding is incremental UTF-8 with universal newlines (as text-mode pipes
+    did). A line longer than `_DRAIN_CHUNK` is passed on in fragments, so a
+    single huge line is never held in memory whole.
+    """
+
+    def emit(line: str) -> None:
+        if line_filter is not None:
+            filtered = line_filter(line)
+            if filtered is None:
+                return
+            line = filtered
+        sink.append(line)
+        if scanner is not None:
+            scanner.feed(line)
+        if progress is not None:
+            progress.line(stream, line.rstrip("\n"))
+
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True)
+    pending = ""
+    try:
+        while True:
+            data = pipe.read1(_DRAIN_CHUNK)
+            pending += decoder.decode(data, final=not data)
+            start = 0
+            end = pending.find("\n")
+            while end >= 0:
+                emit(pending[start : end + 1])
+                start = end + 1
+                end = pending.find("\n", start)
+            pending = pending[start:]
+            if pending and (not data or len(pending) >= _DRAIN_CHUNK):
+                emit(pending)
+                pending = ""
+            if not data:
+                break
+    finally:
+        pipe.close()
+        sink.close()
 
 
 def _run_command(
@@ -281,80 +1288,1605 @@ def _run_command(
     cwd: str,
     timeout: int = 300,
     env: Optional[Dict[str, str]] = None,
+    stderr_filter: Optional[Callable[[str], Optional[str]]] = None,
+    diagnostics: Tuple[str, ...] = (),
 ) -> Dict[str, Any]:
+    """Run `cmd`, streaming both pipes into bounded captures.
+
+    `stderr_filter`, if given, sees every stderr line first and returns the
+    text to capture in its place (or None to drop it). For each stream named
+    in `diagnostics` the lines are also run through a `_DiagnosticsScanner`
+    as they arrive, so the result's `diagnostics` cover output that was
+    spilled out of the in-memory window too.
+    """
     start = _utcnow()
-    proc = subprocess.run(
+    progress = _CURRENT_PROGRESS.get()
+    # Own process group so cancellation/timeouts take down nix's children too.
+    proc = subprocess.Popen(
         cmd,
         cwd=cwd,
         env=env,
-        capture_output=True,
-        text=True,
-        timeout=timeout,
-        check=False,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
     )
+    _REQUESTS.attach(proc)
+    # Both pipes are read in chunks as output arrives (so progress can be
+    # reported while a build runs) on one thread each, so neither can fill
+    # up and stall the child.
+    handle = _OUTPUT_SPOOL.new_handle()
+    stdout = _OUTPUT_SPOOL.capture(handle, "stdout")
+    stderr = _OUTPUT_SPOOL.capture(handle, "stderr")
+    scanners = {stream: _DiagnosticsScanner() for stream in diagnostics}
+    readers = [
+        threading.Thread(
+            target=_drain_stream,
+            args=(proc.stdout, "stdout", stdout, progress, None, scanners.get("stdout")),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=_drain_stream,
+            args=(proc.stderr, "stderr", stderr, progress, stderr_filter, scanners.get("stderr")),
+            daemon=True,
+        ),
+    ]
+    for reader in readers:
+        reader.start()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(proc, signal.SIGKILL)
+        proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        _REQUESTS.detach(proc)
     end = _utcnow()
-    return {
+    result = {
         "command": cmd,
         "cwd": cwd,
         "exitCode": proc.returncode,
-        "stdout": proc.stdout,
-        "stderr": proc.stderr,
+        "stdout": stdout.text(handle, "stdout"),
+        "stderr": stderr.text(handle, "stderr"),
         "startedAt": start.isoformat(),
         "finishedAt": end.isoformat(),
         "durationSeconds": round((end - start).total_seconds(), 3),
     }
+    if stdout.spilled or stderr.spilled:
+        result["outputHandle"] = handle
+        result["outputBytes"] = {"stdout": stdout.total_bytes, "stderr": stderr.total_bytes}
+        result["truncated"] = [name for name, cap in (("stdout", stdout), ("stderr", stderr)) if cap.spilled]
+        _OUTPUT_SPOOL.prune(handle)
+    if scanners:
+        # Streams are scanned separately so traces never interleave, then
+        # merged in the order they were asked for.
+        merged = _DiagnosticsScanner()
+        for stream in diagnostics:
+            merged.extend(scanners[stream].close())
+        result["diagnostics"] = merged.diagnostics()
+        dropped = merged.dropped + sum(scanner.dropped for scanner in scanners.values())
+        if dropped:
+            result["diagnosticsDropped"] = dropped
+    return result
+
+
+# `nix --log-format internal-json` activity and result type ids
+# (ActivityType / ResultType in nix's logging.hh).
+_NIX_ACT_COPY_PATH = 100
+_NIX_ACT_FILE_TRANSFER = 101
+_NIX_ACT_BUILD = 105
+_NIX_ACT_SUBSTITUTE = 108
+_NIX_RES_SET_PHASE = 104
+_NIX_RES_PROGRESS = 105
+# "builder for '…' failed" up to nix 2.25, "Cannot build '…'." from 2.26 on.
+_NIX_BUILD_FAILED = re.compile(r"(?:builder for|Cannot build) '(/nix/store/[^']+\.drv)'")
+_NIX_DEPS_FAILED = re.compile(r"dependenc(?:y|ies) of derivation '(/nix/store/[^']+\.drv)' failed to build")
+_STORE_NAME = re.compile(r"^(?:/nix/store/)?[0-9a-z]{32}-(.+?)(?:\.drv)?$")
+
+
+def _store_name(path: str) -> str:
+    match = _STORE_NAME.match(path)
+    return match.group(1) if match else path
+
+
+def _store_basename(path: str) -> str:
+    return path.rsplit("/", 1)[-1]
+
+
+class _BuildTelemetry:
+    """Incremental parser for `nix --log-format internal-json` on stderr.
+
+    Used as the `stderr_filter` of `_run_command`: every `@nix` record is
+    folded into per-derivation timings as it arrives, and what the default
+    log format would have printed (messages and info-level activity
+    descriptions) is handed back, so the captured stderr, progress phases
+    and diagnostics keep working on plain text.
+
+    `watch` maps store paths (drvs or outputs) to labels; when one of them
+    finishes building or substituting, or fails, a `host <label> built` /
+    `host <label> failed` line is added to the stream.
+    """
+
+    def __init__(self, watch: Optional[Dict[str, str]] = None) -> None:
+        self.watch = watch or {}
+        self.completed: Dict[str, str] = {}
+        self._open: Dict[int, Dict[str, Any]] = {}
+        self.builds: List[Dict[str, Any]] = []
+        self.substitutions: List[Dict[str, Any]] = []
+        self.bytes_downloaded = 0
+        self.nar_bytes_copied = 0
+        self.failed: List[str] = []
+
+    def feed(self, line: str) -> Optional[str]:
+        if not line.startswith("@nix "):
+            return line
+        # Build log lines are the bulk of the stream and carry no timing
+        # information; keys are emitted sorted, so they can be skipped
+        # without decoding.
+        if line.startswith('@nix {"action":"result"') and line.rstrip().endswith('"type":101}'):
+            return None
+        try:
+            return self._event(json.loads(line[5:]))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # A malformed record must not kill the reader thread: pass it on
+            # as plain text.
+            return line
+
+    def _event(self, event: Dict[str, Any]) -> Optional[str]:
+        action = event.get("action")
+        now = time.monotonic()
+        if action == "msg":
+            msg = _ANSI_ESCAPE.sub("", str(event.get("msg", "")))
+            failed = _NIX_BUILD_FAILED.search(msg)
+            if failed:
+                self.failed.append(failed.group(1))
+            failed = failed or _NIX_DEPS_FAILED.search(msg)
+            notice = self._notice(failed.group(1), "failed") if failed else None
+            return msg + "\n" + (notice or "")
+        if action == "start":
+            self._open[event.get("id")] = {
+                "type": event.get("type"),
+                "fields": event.get("fields") or [],
+                "parent": event.get("parent"),
+                "started": now,
+                "progress": 0,
+                "bytes": 0,
+                "phases": [],
+            }
+            text = event.get("text")
+            if text and int(event.get("level", 0)) <= 3:
+                return f"{text}\n"
+            return None
+        activity = self._open.get(event.get("id"))
+        if activity is None:
+            return None
+        if action == "result":
+            fields = event.get("fields") or []
+            if event.get("type") == _NIX_RES_PROGRESS and fields:
+                activity["progress"] = max(activity["progress"], int(fields[0]))
+            elif event.get("type") == _NIX_RES_SET_PHASE and fields:
+                activity["phases"].append((str(fields[0]), now))
+        elif action == "stop":
+            del self._open[event.get("id")]
+            return self._close(activity, now)
+        return None
+
+    def _notice(self, path: str, outcome: str) -> Optional[str]:
+        label = self.watch.get(path)
+        if label is None or label in self.completed:
+            return None
+        self.completed[label] = outcome
+        total = len(set(self.watch.values()))
+        return f"host {label} {outcome} ({len(self.completed)}/{total})\n"
+
+    def _ancestor(self, activity: Dict[str, Any], kind: int) -> Optional[Dict[str, Any]]:
+        parent = self._open.get(activity["parent"])
+        while parent is not None and parent["type"] != kind:
+            parent = self._open.get(parent["parent"])
+        return parent
+
+    def _close(self, activity: Dict[str, Any], now: float) -> Optional[str]:
+        kind = activity["type"]
+        fields = activity["fields"]
+        notice: Optional[str] = None
+        if kind in (_NIX_ACT_BUILD, _NIX_ACT_SUBSTITUTE) and fields and str(fields[0]) not in self.failed:
+            notice = self._notice(str(fields[0]), "built")
+        if kind == _NIX_ACT_BUILD and fields:
+            phases: Dict[str, float] = {}
+            marks = activity["phases"] + [("", now)]
+            for (phase, at), (_next, until) in zip(marks, marks[1:]):
+                phases[phase] = round(phases.get(phase, 0.0) + until - at, 3)
+            self.builds.append(
+                {
+                    "drvPath": str(fields[0]),
+                    "machine": str(fields[1]) if len(fields) > 1 and fields[1] else "local",
+                    "started": activity["started"],
+                    "stopped": now,
+                    "phases": phases,
+                }
+            )
+        elif kind == _NIX_ACT_SUBSTITUTE and fields:
+            self.substitutions.append(
+                {
+                    "path": str(fields[0]),
+                    "substituter": str(fields[1]) if len(fields) > 1 else None,
+                    "seconds": now - activity["started"],
+                    "bytes": activity["bytes"],
+                }
+            )
+        elif kind == _NIX_ACT_FILE_TRANSFER:
+            self.bytes_downloaded += activity["progress"]
+            substitution = self._ancestor(activity, _NIX_ACT_SUBSTITUTE)
+            if substitution is not None:
+                substitution["bytes"] += activity["progress"]
+        elif kind == _NIX_ACT_COPY_PATH:
+            self.nar_bytes_copied += activity["progress"]
+        return notice
+
+    def built_paths(self) -> List[str]:
+        return [build["drvPath"] for build in self.builds]
+
+    def _critical_path(self, inputs: Optional[Dict[str, List[str]]]) -> Dict[str, Any]:
+        """Longest chain of dependent builds by wall time.
+
+        With `inputs` (drv basename -> input drv basenames) edges come from
+        the derivation graph; without it a build is assumed to have waited
+        on whichever build finished last before it started.
+        """
+        dist: Dict[str, float] = {}
+        prev: Dict[str, Optional[str]] = {}
+        finished: List[Dict[str, Any]] = []
+        for build in sorted(self.builds, key=lambda b: b["stopped"]):
+            key = _store_basename(build["drvPath"])
+            if inputs is not None:
+                candidates = [dep for dep in inputs.get(key, []) if dep in dist]
+            else:
+                waited = [b for b in finished if b["stopped"] <= build["started"]]
+                candidates = [_store_basename(waited[-1]["drvPath"])] if waited else []
+            best = max(candidates, key=lambda dep: dist[dep], default=None)
+            dist[key] = (dist[best] if best else 0.0) + build["stopped"] - build["started"]
+            prev[key] = best
+            finished.append(build)
+        if not dist:
+            return {"basis": "derivation-graph" if inputs is not None else "timeline", "seconds": 0.0, "derivations": []}
+        node: Optional[str] = max(dist, key=lambda k: dist[k])
+        total = dist[node]
+        chain: List[str] = []
+        while node:
+            chain.append(_store_name(node))
+            node = prev[node]
+        return {
+            "basis": "derivation-graph" if inputs is not None else "timeline",
+            "seconds": round(total, 3),
+            "derivations": chain[::-1],
+        }
+
+    def summary(self, top: int, inputs: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+        machines: Dict[str, int] = {}
+        for build in self.builds:
+            machines[build["machine"]] = machines.get(build["machine"], 0) + 1
+        builds = sorted(self.builds, key=lambda b: b["stopped"] - b["started"], reverse=True)
+        substitutions = sorted(self.substitutions, key=lambda s: s["seconds"], reverse=True)
+        return {
+            "built": len(self.builds),
+            "substituted": len(self.substitutions),
+            "failed": [_store_name(path) for path in self.failed],
+            "buildSeconds": round(sum(b["stopped"] - b["started"] for b in self.builds), 3),
+            "substituteSeconds": round(sum(s["seconds"] for s in self.substitutions), 3),
+            "bytesDownloaded": self.bytes_downloaded,
+            "narBytesCopied": self.nar_bytes_copied,
+            "machines": machines,
+            "builds": [
+                {
+                    "name": _store_name(b["drvPath"]),
+                    "drvPath": b["drvPath"],
+                    "seconds": round(b["stopped"] - b["started"], 3),
+                    "machine": b["machine"],
+                    "phases": b["phases"],
+                }
+                for b in builds[:top]
+            ],
+            "substitutions": [
+                {
+                    "name": _store_name(s["path"]),
+                    "path": s["path"],
+                    "seconds": round(s["seconds"], 3),
+                    "bytes": s["bytes"],
+                    "substituter": s["substituter"],
+                }
+                for s in substitutions[:top]
+            ],
+            "criticalPath": self._critical_path(inputs),
+        }
+
+
+def _derivation_show(drv_paths: List[str], cwd: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """`nix derivation show` for all of `drv_paths` in one call, keyed by basename."""
+    try:
+        proc = subprocess.run(
+            ["nix", "derivation", "show", *drv_paths], cwd=cwd, capture_output=True, text=True, timeout=120
+        )
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        _debug(f"derivation show failed: {exc}")
+        return None
+    if proc.returncode != 0:
+        _debug(f"derivation show failed: {proc.stderr.strip()[:200]}")
+        return None
+    try:
+        shown = json.loads(proc.stdout)
+    except json.JSONDecodeError:
+        return None
+    return {_store_basename(drv): info for drv, info in shown.items()}
+
+
+def _derivation_inputs(drv_paths: List[str], cwd: str) -> Optional[Dict[str, List[str]]]:
+    """Input derivations of `drv_paths`, keyed by basename."""
+    shown = _derivation_show(drv_paths, cwd)
+    if shown is None:
+        return None
+    return {drv: [_store_basename(dep) for dep in (info.get("inputDrvs") or {})] for drv, info in shown.items()}
+
+
+def _derivation_closure(drv_path: str, cwd: str) -> Optional[List[str]]:
+    """Every store path (derivations and sources) `drv_path` depends on, as basenames."""
+    try:
+        proc = subprocess.run(
+            ["nix-store", "--query", "--requisites", drv_path], cwd=cwd, capture_output=True, text=True, timeout=120
+        )
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        _debug(f"requisites query failed: {exc}")
+        return None
+    if proc.returncode != 0:
+        return None
+    return [_store_basename(path) for path in proc.stdout.split()]
+
+
+def _native_system() -> str:
+    machine = platform.machine().lower()
+    machine = {"amd64": "x86_64", "arm64": "aarch64"}.get(machine, machine)
+    return f"{machine}-{sys.platform}"
+
+
+_PLAN_BUILD_HEADER = re.compile(r"^(?:these \d+ derivations|this derivation) will be built:")
+_PLAN_FETCH_HEADER = re.compile(
+    r"^(?:these \d+ paths|this path) will be fetched(?: \(([^,]+) download, ([^)]+) unpacked\))?:"
+)
+
+
+class _BuildPlan:
+    """Collects nix's "will be built" / "will be fetched" listings from stderr text.
+
+    `feed` takes (possibly multi-line) stderr text and returns it unchanged,
+    so it can sit in a `stderr_filter` chain after `_BuildTelemetry`.
+    """
+
+    def __init__(self) -> None:
+        self.to_build: List[str] = []
+        self.to_fetch: List[str] = []
+        self.download: Optional[str] = None
+        self.unpacked: Optional[str] = None
+        self._target: Optional[List[str]] = None
+
+    def feed(self, text: str) -> str:
+        for line in text.splitlines():
+            stripped = line.strip()
+            if self._target is not None and stripped.startswith("/nix/store/"):
+                self._target.append(stripped)
+                continue
+            self._target = None
+            if _PLAN_BUILD_HEADER.match(stripped):
+                self._target = self.to_build
+                continue
+            fetch = _PLAN_FETCH_HEADER.match(stripped)
+            if fetch:
+                self._target = self.to_fetch
+                self.download, self.unpacked = fetch.group(1), fetch.group(2)
+        return text
+
+    def summary(self) -> Optional[Dict[str, Any]]:
+        if not self.to_build and not self.to_fetch:
+            return None
+        return {
+            "toBuild": self.to_build,
+            "toFetch": self.to_fetch,
+            "downloadSize": self.download,
+            "unpackedSize": self.unpacked,
+        }
+
+
+def _invalid_outputs(drv_path: str, cwd: str) -> Optional[Tuple[List[str], List[str]]]:
+    """(output paths, those not valid in the local store) of a store derivation.
+
+    Validity of all outputs is checked in one `nix-store --check-validity`
+    call. Returns None when the derivation itself is not in the store (e.g. a
+    cached drvPath whose .drv was garbage-collected).
+    """
+    try:
+        outputs = subprocess.run(
+            ["nix-store", "--query", "--outputs", drv_path], cwd=cwd, capture_output=True, text=True, timeout=60
+        )
+        if outputs.returncode != 0:
+            return None
+        out_paths = outputs.stdout.split()
+        if not out_paths:
+            return None
+        check = subprocess.run(
+            ["nix-store", "--check-validity", "--print-invalid", *out_paths],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        _debug(f"output validity check failed: {exc}")
+        return None
+    if check.returncode != 0:
+        return None
+    return out_paths, check.stdout.split()
+
+
+_FINGERPRINT_GIT_TIMEOUT = 30
+
+
+def _flake_source_fingerprint(repo_root: str) -> Optional[Dict[str, str]]:
+    """Git tree hash of what the flake sees, plus the flake.lock digest.
+
+    A flake in a git repo is built from tracked files at their working-tree
+    contents, so the tree is written from a throwaway copy of the index with
+    tracked changes added (`git add -u`). Neither the real index nor the
+    repo's object store is touched: new blobs and trees go to a temporary
+    object directory, with the real one as an alternate. Returns None
+    outside a git checkout, without git, or when git hangs (e.g. a stuck
+    lock), which disables caching.
+    """
+
+    def git(*args: str, env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["git", *args], cwd=repo_root, env=env, capture_output=True, text=True, timeout=_FINGERPRINT_GIT_TIMEOUT
+        )
+
+    try:
+        dirs = git("rev-parse", "--absolute-git-dir", "--git-common-dir")
+        if dirs.returncode != 0:
+            return None
+        git_dir, common_dir = dirs.stdout.splitlines()[:2]
+        objects = Path(repo_root, common_dir).resolve() / "objects"
+        index = Path(git_dir) / "index"
+        with tempfile.TemporaryDirectory(prefix="nix-ops-index-") as tmp:
+            env = dict(
+                os.environ,
+                GIT_INDEX_FILE=str(Path(tmp) / "index"),
+                GIT_OBJECT_DIRECTORY=str(Path(tmp) / "objects"),
+                GIT_ALTERNATE_OBJECT_DIRECTORIES=str(objects),
+            )
+            # git only accepts an object directory that already exists.
+            Path(env["GIT_OBJECT_DIRECTORY"]).mkdir()
+            if index.exists():
+                # Copying keeps the stat cache, so only changed files are rehashed.
+                Path(env["GIT_INDEX_FILE"]).write_bytes(index.read_bytes())
+            else:
+                git("read-tree", "HEAD", env=env)
+            added = git("add", "-u", ".", env=env)
+            tree = git("write-tree", env=env)
+    except (OSError, ValueError, subprocess.TimeoutExpired) as exc:
+        _debug(f"flake fingerprint unavailable: {exc}")
+        return None
+    if added.returncode != 0 or tree.returncode != 0:
+        return None
+    lock_path = Path(repo_root) / "flake.lock"
+    lock = hashlib.sha256(lock_path.read_bytes()).hexdigest() if lock_path.exists() else ""
+    return {"treeHash": tree.stdout.strip(), "flakeLock": lock}
+
+
+class _EvalCache:
+    """Persistent cache of successful `nix eval` outputs.
+
+    Keys combine the flake source fingerprint (git tree hash + flake.lock)
+    with the evaluated attribute and command, so any tracked edit or input
+    bump misses naturally; nothing is invalidated explicitly. The newest
+    `max_entries` results are kept in one JSON file.
+    """
+
+    def __init__(self, path: Path, max_entries: int, enabled: bool = True) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries: Optional["OrderedDict[str, Dict[str, Any]]"] = None
+
+    def _load(self) -> "OrderedDict[str, Dict[str, Any]]":
+        if self._entries is None:
+            self._entries = OrderedDict()
+            try:
+                loaded = json.loads(self.path.read_text(encoding="utf-8"))
+                for key, entry in loaded.get("entries", {}).items():
+                    self._entries[key] = entry
+            except (OSError, json.JSONDecodeError, AttributeError):
+                pass
+        return self._entries
+
+    @staticmethod
+    def key(fingerprint: Dict[str, str], cmd: List[str]) -> str:
+        material = json.dumps([fingerprint["treeHash"], fingerprint["flakeLock"], cmd])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        self.put_many({key: entry})
+
+    def put_many(self, items: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock:
+            entries = self._load()
+            for key, entry in items.items():
+                entries[key] = entry
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps({"entries": entries}, ensure_ascii=True), encoding="utf-8")
+            os.replace(tmp, self.path)
+
+    def fingerprint(self, cwd: str) -> Optional[Dict[str, str]]:
+        return _flake_source_fingerprint(cwd) if self.enabled else None
+
+    def run(
+        self,
+        cmd: List[str],
+        *,
+        cwd: str,
+        timeout: int,
+        refresh: bool = False,
+        fingerprint: Optional[Dict[str, str]] = None,
+        runner: Optional[Callable[[Optional[Dict[str, str]]], Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """_run_command for a pure eval, answered from the cache when the flake is unchanged.
+
+        Pass `fingerprint` when issuing several evals of the same tree, so the
+        tree hash is computed once. `runner(fingerprint)` replaces the plain
+        `nix eval` subprocess on a miss (e.g. the warm evaluator).
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint(cwd)
+        if runner is None:
+            runner = lambda _fingerprint: _run_command(cmd, cwd=cwd, timeout=timeout)  # noqa: E731
+        if fingerprint is None:
+            result = runner(None)
+            result["evalCache"] = {"hit": False, "enabled": False}
+            return result
+        key = self.key(fingerprint, cmd)
+        if not refresh:
+            entry = self.get(key)
+            if entry is not None:
+                return {
+                    "command": cmd,
+                    "cwd": cwd,
+                    "exitCode": 0,
+                    "stdout": entry["stdout"],
+                    "stderr": "",
+                    "durationSeconds": 0.0,
+                    "evalCache": {"hit": True, "treeHash": fingerprint["treeHash"], "cachedAt": entry["cachedAt"]},
+                }
+        result = runner(fingerprint)
+        if result["exitCode"] == 0 and "outputHandle" not in result:
+            self.put(key, {"stdout": result["stdout"], "cachedAt": _utcnow().isoformat(), "command": cmd})
+        result["evalCache"] = {"hit": False, "treeHash": fingerprint["treeHash"], "refreshed": refresh}
+        return result
+
+
+class _DiffCache:
+    """nix-diff output per (drvA, drvB) pair, one JSON file per pair.
+
+    Store derivations are immutable, so an entry never goes stale; only the
+    `keep` most recently used pairs are kept to bound disk use.
+    """
+
+    def __init__(self, root: Path, keep: int) -> None:
+        self.root = root
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _path(self, drv_a: str, drv_b: str) -> Path:
+        digest = hashlib.sha256(f"{drv_a}\0{drv_b}".encode("utf-8")).hexdigest()
+        return self.root / f"{digest}.json"
+
+    def get(self, drv_a: str, drv_b: str) -> Optional[Dict[str, Any]]:
+        path = self._path(drv_a, drv_b)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return entry
+
+    def put(self, drv_a: str, drv_b: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self._path(drv_a, drv_b)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(entry, ensure_ascii=True), encoding="utf-8")
+            os.replace(tmp, path)
+            files = sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+            for stale in files[self.keep :]:
+                stale.unlink(missing_ok=True)
+
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+_REPL_ERROR = re.compile(r"^\s*error:", re.MULTILINE)
+
+
+class _ReplUnavailable(Exception):
+    """The warm evaluator cannot serve this request; fall back to `nix eval`."""
+
+
+class _NixRepl:
+    """Long-lived `nix repl` with the repo's flake loaded (`:lf .`).
+
+    Expressions are sent over stdin as `builtins.toJSON (<expr>)`, followed by
+    a sentinel string so the end of each answer is unambiguous. nixpkgs and
+    the flake stay parsed between calls. When the flake fingerprint (git tree
+    + flake.lock) changes the flake is re-loaded in place, which reuses the
+    parse cache for unchanged inputs; after `max_reloads` re-loads, or
+    `idle_seconds` without use, the process is restarted/stopped to bound
+    memory. One evaluation runs at a time; a call that finds the repl busy
+    raises `_ReplUnavailable` rather than queueing (its timeout would run
+    out waiting), so concurrent callers go through `nix eval` instead.
+    """
+
+    def __init__(self, repo_root: str, idle_seconds: float, max_reloads: int) -> None:
+        self.repo_root = repo_root
+        self.idle_seconds = idle_seconds
+        self.max_reloads = max_reloads
+        self.disabled_reason: Optional[str] = None
+        self._lock = threading.RLock()
+        self._proc: Optional[subprocess.Popen] = None
+        self._buffer = b""
+        self._loaded: Optional[Dict[str, str]] = None
+        self._reloads = 0
+        self._sequence = 0
+        self._idle_timer: Optional[threading.Timer] = None
+
+    def _send(self, line: str, deadline: float) -> str:
+        """Send one repl line and return everything printed for it."""
+        assert self._proc is not None and self._proc.stdin is not None
+        self._sequence += 1
+        sentinel = f"__nix_ops_done_{self._sequence}__"
+        try:
+            self._proc.stdin.write(f"{line}\n\"{sentinel}\"\n".encode("utf-8"))
+            self._proc.stdin.flush()
+        except (BrokenPipeError, OSError) as exc:
+            self.stop()
+            raise _ReplUnavailable(f"nix repl pipe closed: {exc}") from exc
+        fd = self._proc.stdout.fileno()
+        marker = sentinel.encode("utf-8")
+        while marker not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stop()
+                raise subprocess.TimeoutExpired(["nix", "repl"], 0)
+            readable, _, _ = select.select([fd], [], [], min(remaining, 1.0))
+            if not readable:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.stop()
+                raise _ReplUnavailable("nix repl exited")
+            self._buffer += chunk
+        head, _, rest = self._buffer.partition(marker)
+        # Drop the rest of the sentinel's own output line.
+        self._buffer = rest.split(b"\n", 1)[1] if b"\n" in rest else b""
+        text = _ANSI_ESCAPE.sub("", head.decode("utf-8", errors="replace"))
+        # The sentinel is echoed as a quoted string; strip its opening quote.
+        return text[:-1] if text.endswith('"') else text
+
+    def _start(self, deadline: float) -> None:
+        env = dict(os.environ, NO_COLOR="1", TERM="dumb")
+        try:
+            self._proc = subprocess.Popen(
+                ["nix", "repl", "--extra-experimental-features", "nix-command flakes"],
+                cwd=self.repo_root,
+                env=env,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        except OSError as exc:
+            self.disabled_reason = f"cannot start nix repl: {exc}"
+            raise _ReplUnavailable(self.disabled_reason) from exc
+        self._buffer = b""
+        self._loaded = None
+        self._reloads = 0
+
+    def _load(self, fingerprint: Optional[Dict[str, str]], deadline: float) -> None:
+        output = self._send(":lf .", deadline)
+        if _REPL_ERROR.search(output):
+            # Old nix without :lf, or a flake that does not even load; the
+            # CLI path reports the real error.
+            self.stop()
+            if "unknown command" in output or "invalid command" in output:
+                self.disabled_reason = "nix repl does not support :lf"
+            raise _ReplUnavailable(output.strip()[-500:])
+        self._loaded = fingerprint
+
+    def evaluate(self, expr: str, fingerprint: Optional[Dict[str, str]], timeout: float) -> Dict[str, Any]:
+        """Evaluate `expr` in the flake's scope; returns (exit 0/1, stdout JSON, stderr) like _run_command."""
+        if self.disabled_reason is not None:
+            raise _ReplUnavailable(self.disabled_reason)
+        if not self._lock.acquire(blocking=False):
+            raise _ReplUnavailable("nix repl is busy with another evaluation")
+        try:
+            deadline = time.monotonic() + timeout
+            start = _utcnow()
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+            warm = self._proc is not None and self._proc.poll() is None
+            if not warm:
+                self._start(deadline)
+            if self._loaded is None or fingerprint is None or fingerprint != self._loaded:
+                if self._loaded is not None:
+                    self._reloads += 1
+                    if self._reloads > self.max_reloads:
+                        self.stop()
+                        self._start(deadline)
+                        warm = False
+                self._load(fingerprint, deadline)
+            output = self._send(f"builtins.toJSON ({expr})", deadline)
+            self._idle_timer = threading.Timer(self.idle_seconds, self.stop)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+        finally:
+            self._lock.release()
+        end = _utcnow()
+        result: Dict[str, Any] = {
+            "startedAt": start.isoformat(),
+            "finishedAt": end.isoformat(),
+            "durationSeconds": round((end - start).total_seconds(), 3),
+            "evaluator": {"kind": "repl", "warm": warm, "reloads": self._reloads},
+        }
+        if _REPL_ERROR.search(output):
+            result.update({"exitCode": 1, "stdout": "", "stderr": output.strip() + "\n"})
+            return result
+        literal = output.strip().splitlines()[-1] if output.strip() else ""
+        try:
+            # toJSON's result is printed as a Nix string literal: JSON-style
+            # escapes plus an escaped `${`.
+            value = json.loads(literal.replace("\\${", "${"))
+        except json.JSONDecodeError as exc:
+            raise _ReplUnavailable(f"unexpected nix repl output: {output.strip()[-200:]}") from exc
+        result.update({"exitCode": 0, "stdout": value, "stderr": ""})
+        return result
+
+    def stop(self) -> None:
+        with self._lock:
+            proc, self._proc = self._proc, None
+            self._loaded = None
+            if proc is not None and proc.poll() is None:
+                _kill_process_group(proc, signal.SIGKILL)
+                proc.wait()
+
+
+def _host_drv_cmd(host: str) -> List[str]:
+    return ["nix", "eval", "--raw", f".#nixosConfigurations.{host}.config.system.build.toplevel.drvPath"]
+
+
+def _host_drv_expr(host: str) -> str:
+    return f"nixosConfigurations.{json.dumps(host)}.config.system.build.toplevel.drvPath"
+
+
+_INSTALLER_PACKAGES = {
+    "pix4": ("aarch64-linux", "createInstallSD-pix4"),
+    "pix5": ("aarch64-linux", "createInstallSD-pix5"),
+}
+
+
+def _installer_attr(variant: str) -> str:
+    system, package = _INSTALLER_PACKAGES[variant]
+    return f".#packages.{system}.{package}"
+
+
+def _installer_drv_expr(variant: str) -> str:
+    system, package = _INSTALLER_PACKAGES[variant]
+    return f"packages.{json.dumps(system)}.{json.dumps(package)}.drvPath"
+
+
+# One evaluator pass over every host. tryEval keeps a throw/assert in one host
+# from aborting the batch; errors it cannot catch fail the whole call and fall
+# back to per-host evals.
+_ALL_HOSTS_APPLY = (
+    "cs: builtins.mapAttrs (name: c: "
+    "let r = builtins.tryEval c.config.system.build.toplevel.drvPath; "
+    "in if r.success then { drvPath = r.value; } else { error = true; }) cs"
+)
+
+
+ERROR_PATTERN = re.compile(r"error:\s*(.+)")
+PATH_PATTERN = re.compile(r"(/[^:\s]+\.nix):(\d+):(\d+)")
+
+
+class _DiagnosticsScanner:
+    """Single-pass Nix diagnostics extractor that can be fed output as it arrives.
+
+    Every `error: <message>` line becomes a diagnostic whose location is the
+    first `file.nix:line:col` within the next `lookahead` lines. The
+    `… while evaluating ...` frames printed before it (each with its own
+    `at` location) are attached as `trace`. Repeats of the same message and
+    location are merged into one entry with `occurrences`, and at most
+    `max_items` distinct diagnostics are kept (`dropped` counts the rest).
+    While nothing awaits a location, `feed` jumps straight to the next line
+    that can start an error or frame using `str.find`, so the bulk of a
+    build log is never split into lines; cost stays linear in the input and
+    memory in the number of distinct errors.
+    """
+
+    _MARKERS = ("error:", "… ", "while evaluating", "while calling")
+
+    def __init__(self, lookahead: int = 8, max_items: int = DEFAULT_DIAGNOSTICS_MAX) -> None:
+        self.lookahead = lookahead
+        self.max_items = max_items
+        self.dropped = 0
+        self._items: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self._partial = ""
+        self._frames: List[Dict[str, Any]] = []
+        self._frame_open = False
+        self._pending: Optional[Dict[str, Any]] = None
+        self._budget = 0
+
+    def feed(self, chunk: str) -> None:
+        """Scan `chunk`; a trailing partial line is held until the next call or `close`."""
+        if self._partial:
+            chunk = self._partial + chunk
+        end = chunk.rfind("\n") + 1
+        self._partial = chunk[end:]
+        pos = 0
+        upcoming = {marker: -2 for marker in self._MARKERS}
+        while pos < end:
+            if self._pending is None and not self._frame_open:
+                hit = end
+                for marker, at in upcoming.items():
+                    if -1 < at < pos or at == -2:
+                        at = chunk.find(marker, pos, end)
+                        upcoming[marker] = at
+                    if pos <= at < hit:
+                        hit = at
+                if hit == end:
+                    return
+                pos = chunk.rfind("\n", pos, hit) + 1 or pos
+            newline = chunk.find("\n", pos, end)
+            self._line(chunk[pos:newline])
+            pos = newline + 1
+
+    def close(self) -> List[Dict[str, Any]]:
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ""
+        self._emit()
+        return self.diagnostics()
+
+    def diagnostics(self) -> List[Dict[str, Any]]:
+        return list(self._items.values())
+
+    def extend(self, items: List[Dict[str, Any]]) -> None:
+        """Merge already-extracted diagnostics (e.g. from another stream)."""
+        for item in items:
+            self._add(dict(item))
+
+    def _line(self, line: str) -> None:
+        if line.endswith("\r"):
+            line = line[:-1]
+        if "error:" in line:
+            match = ERROR_PATTERN.search(line)
+            self._emit()
+            if match is None:
+                # Bare `error:` heads a trace; frames follow on their own lines.
+                self._frames = []
+                self._frame_open = False
+                return
+            message = match.group(1).strip()
+            if message.startswith(("… while", "while ")):
+                self._frame(message)
+                return
+            self._pending = {"message": message}
+            self._budget = self.lookahead
+        else:
+            stripped = line.lstrip()
+            if stripped.startswith(("… while", "… from call site", "while evaluating", "while calling")):
+                self._emit()
+                self._frame(stripped)
+                return
+        if ".nix:" not in line:
+            self._tick()
+            return
+        loc_match = PATH_PATTERN.search(line)
+        if loc_match is not None:
+            location = {
+                "file": loc_match.group(1),
+                "line": int(loc_match.group(2)),
+                "column": int(loc_match.group(3)),
+            }
+            if self._pending is not None:
+                self._pending["location"] = location
+                self._emit()
+                return
+            if self._frame_open:
+                self._frames[-1]["location"] = location
+                self._frame_open = False
+        self._tick()
+
+    def _tick(self) -> None:
+        if self._pending is None and not self._frame_open:
+            return
+        self._budget -= 1
+        if self._budget <= 0:
+            if self._pending is not None:
+                self._emit()
+            else:
+                self._frame_open = False
+
+    def _frame(self, text: str) -> None:
+        self._frames.append({"frame": text.lstrip("… ").rstrip(":")})
+        self._frame_open = True
+        self._budget = self.lookahead
+
+    def _emit(self) -> None:
+        item = self._pending
+        if item is None:
+            return
+        self._pending = None
+        if self._frames:
+            item["trace"] = self._frames
+            self._frames = []
+            self._frame_open = False
+        self._add(item)
+
+    def _add(self, item: Dict[str, Any]) -> None:
+        location = item.get("location") or {}
+        key = (item["message"], location.get("file"), location.get("line"), location.get("column"))
+        seen = self._items.get(key)
+        if seen is not None:
+            seen["occurrences"] = seen.get("occurrences", 1) + item.get("occurrences", 1)
+        elif len(self._items) < self.max_items:
+            self._items[key] = item
+        else:
+            self.dropped += 1
+
+
+def _extract_diagnostics(output: str) -> List[Dict[str, Any]]:
+    scanner = _DiagnosticsScanner()
+    scanner.feed(output)
+    return scanner.close()
+
+
+def _host_target(host: str, config: Dict[str, Any]) -> str:
+    allowed_hosts = config.get("allowedHosts", {})
+    host_entry = allowed_hosts.get(host)
+    if not host_entry:
+        raise ValueError(f"Host '{host}' is not present in allowedHosts")
+    target = host_entry.get("sshTarget")
+    if not target:
+        raise ValueError(f"Host '{host}' is missing sshTarget")
+    return str(target)
+
+
+class _SshMaster:
+    def __init__(self, host: str, target: str, socket_path: Path) -> None:
+        self.host = host
+        self.target = target
+        self.socket_path = socket_path
+        self.options: List[str] = []
+        self.lock = threading.Lock()
+        self.started_at: Optional[float] = None
+        self.last_used = 0.0
+        self.last_checked = 0.0
+        self.uses = 0
+
+
+class _SshPool:
+    """Managed ControlMaster sockets, one per allowedHosts entry.
+
+    The first call to a host pays the TCP + key exchange once in a detached
+    `ssh -M -N -f` master; later calls multiplex over its socket. Masters are
+    health-checked with `-O check` after `sshControlCheckSeconds` of quiet,
+    restarted transparently when the mux fails, and closed after
+    `sshControlIdleSeconds` without use (ssh's ControlPersist enforces the
+    same limit if the server dies).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._masters: Dict[str, _SshMaster] = {}
+
+    @staticmethod
+    def control_dir(config: Dict[str, Any]) -> Path:
+        configured = config.get("sshControlDir")
+        if configured:
+            path = Path(str(configured))
+        else:
+            # Unix socket paths are capped at ~104 bytes, so stay short and in /tmp.
+            path = Path(tempfile.gettempdir()) / f"nix-ops-mcp-{os.getuid()}"
+        path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        return path
+
+    def _master(self, host: str, target: str, config: Dict[str, Any]) -> _SshMaster:
+        with self._lock:
+            master = self._masters.get(host)
+            if master is None or master.target != target:
+                digest = hashlib.sha1(f"{host}\0{target}".encode("utf-8")).hexdigest()[:16]
+                master = _SshMaster(host, target, self.control_dir(config) / f"{digest}.sock")
+                self._masters[host] = master
+            return master
+
+    def _control_cmd(self, master: _SshMaster, op: str) -> List[str]:
+        return ["ssh", *master.options, "-o", f"ControlPath={master.socket_path}", "-O", op, master.target]
+
+    def _check(self, master: _SshMaster) -> bool:
+        if not master.socket_path.exists():
+            return False
+        proc = subprocess.run(
+            self._control_cmd(master, "check"),
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=10,
+            check=False,
+        )
+        return proc.returncode == 0
+
+    def _start(self, master: _SshMaster, config: Dict[str, Any]) -> None:
+        idle = int(config.get("sshControlIdleSeconds", DEFAULT_SSH_CONTROL_IDLE_SECONDS))
+        cmd = [
+            "ssh",
+            *master.options,
+            "-o", "ControlMaster=yes",
+            "-o", f"ControlPath={master.socket_path}",
+            "-o", f"ControlPersist={idle}s",
+            "-N",
+            "-f",
+            master.target,
+        ]
+        # Not routed through _run_command: the master outlives the request that
+        # started it, so cancelling that request must not kill it.
+        proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60, check=False)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip() or f"ssh master exited with {proc.returncode}")
+        master.started_at = time.monotonic()
+        master.last_checked = master.started_at
+        _debug(f"ssh_pool: master up host={master.host} socket={master.socket_path}")
+
+    def _stop(self, master: _SshMaster) -> None:
+        if master.socket_path.exists():
+            subprocess.run(
+                self._control_cmd(master, "exit"),
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                timeout=10,
+                check=False,
+            )
+        master.started_at = None
+
+    def evict_idle(self, config: Dict[str, Any]) -> None:
+        idle = int(config.get("sshControlIdleSeconds", DEFAULT_SSH_CONTROL_IDLE_SECONDS))
+        now = time.monotonic()
+        with self._lock:
+            stale = [m for m in self._masters.values() if m.started_at is not None and now - m.last_used > idle]
+        for master in stale:
+            with master.lock:
+                if master.started_at is not None and now - master.last_used > idle:
+                    _debug(f"ssh_pool: evicting idle master host={master.host}")
+                    self._stop(master)
+
+    def acquire(self, host: str, target: str, config: Dict[str, Any], *, recheck: bool = False) -> Tuple[_SshMaster, Dict[str, Any]]:
+        """Return a live master for host plus timing/bookkeeping for the call.
+
+        `recheck` health-checks the master now instead of after
+        `sshControlCheckSeconds`; only a master that fails the check is
+        stopped and restarted (`reconnected` in the returned info).
+        """
+        self.evict_idle(config)
+        master = self._master(host, target, config)
+        master.options = [str(item) for item in config.get("sshOptions", [])]
+        check_every = float(config.get("sshControlCheckSeconds", DEFAULT_SSH_CONTROL_CHECK_SECONDS))
+        info: Dict[str, Any] = {"pooled": True, "reused": False, "connectSeconds": 0.0}
+        with master.lock:
+            started = time.monotonic()
+            alive = master.started_at is not None
+            if alive and (recheck or time.monotonic() - master.last_checked > check_every):
+                alive = self._check(master)
+                master.last_checked = time.monotonic()
+                info["healthChecked"] = True
+            if not alive:
+                if master.started_at is not None or recheck:
+                    info["reconnected"] = True
+                if recheck and master.started_at is not None:
+                    self._stop(master)
+                self._start(master, config)
+            else:
+                info["reused"] = True
+            info["connectSeconds"] = round(time.monotonic() - started, 3)
+            master.last_used = time.monotonic()
+            master.uses += 1
+        return master, info
+
+    def close_all(self) -> None:
+        with self._lock:
+            masters = list(self._masters.values())
+        for master in masters:
+            try:
+                self._stop(master)
+            except Exception:
+                pass
+
+    def status(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "host": m.host,
+                    "sshTarget": m.target,
+                    "connected": m.started_at is not None,
+                    "uses": m.uses,
+                    "idleSeconds": round(now - m.last_used, 1) if m.last_used else None,
+                }
+                for m in self._masters.values()
+            ]
+
+
+_SSH_POOL = _SshPool()
+atexit.register(_SSH_POOL.close_all)
+
+
+def _run_ssh(host: str, remote_cmd: str, config: Dict[str, Any], timeout: int = 60) -> Dict[str, Any]:
+    target = _host_target(host, config)
+    ssh_options = [str(item) for item in config.get("sshOptions", [])]
+    started = time.monotonic()
+    timing: Dict[str, Any] = {"pooled": False}
+    mux_options: List[str] = []
+    if bool(config.get("sshControlMaster", True)):
+        try:
+            master, timing = _SSH_POOL.acquire(host, target, config)
+            mux_options = ["-o", "ControlMaster=no", "-o", f"ControlPath={master.socket_path}"]
+        except (RuntimeError, OSError, subprocess.TimeoutExpired) as exc:
+            # Fall back to a plain connection; the command itself reports the real error.
+            _debug(f"ssh_pool: master for {host} unavailable: {exc}")
+            timing = {"pooled": False, "poolError": str(exc)}
+    cmd = ["ssh", *ssh_options, *mux_options, target, remote_cmd]
+    command_started = time.monotonic()
+    result = _run_command(cmd, cwd=config["repoRoot"], timeout=timeout)
+    # 255 is ssh's own failure code, but also a legitimate remote exit code.
+    # Only when the master fails `-O check` is it reconnected and the command
+    # retried once (all pooled commands are read-only templates); a live
+    # master is left alone, since other calls may be multiplexed on it.
+    if result["exitCode"] == 255 and timing.get("pooled"):
+        retry = True
+        try:
+            master, rechecked = _SSH_POOL.acquire(host, target, config, recheck=True)
+            retry = bool(rechecked.get("reconnected"))
+            if retry:
+                timing = rechecked
+            else:
+                timing["masterAlive"] = True
+        except (RuntimeError, OSError, subprocess.TimeoutExpired) as exc:
+            # The master won't come back: retry once over a plain connection.
+            _debug(f"ssh_pool: restarting master for {host} failed: {exc}")
+            timing = {"pooled": False, "poolError": str(exc)}
+            cmd = ["ssh", *ssh_options, target, remote_cmd]
+        if retry:
+            timing["retried"] = True
+            command_started = time.monotonic()
+            result = _run_command(cmd, cwd=config["repoRoot"], timeout=timeout)
+    timing["commandSeconds"] = round(time.monotonic() - command_started, 3)
+    timing["totalSeconds"] = round(time.monotonic() - started, 3)
+    result["host"] = host
+    result["sshTarget"] = target
+    result["sshTiming"] = timing
+    return result
+
+
+# nix's warning when a daemon drops `--builders` from an untrusted client.
+_NIX_RESTRICTED_BUILDERS = re.compile(r"ignoring the client-specified setting '(?:builders|max-jobs)'")
+
+
+def _nix_trusted_user() -> Optional[bool]:
+    """Whether nix honours restricted settings (`--builders`) from this user.
+
+    True when the store is this user's own (single-user install, no daemon)
+    or the user, one of its groups or `*` is in `trusted-users`; None when
+    the setting cannot be read.
+    """
+    try:
+        if os.stat("/nix/store").st_uid == os.getuid():
+            return True
+    except OSError:
+        pass
+    for cmd in (["nix", "config", "show", "trusted-users"], ["nix", "show-config"]):
+        try:
+            shown = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if shown.returncode != 0:
+            continue
+        value = shown.stdout.strip()
+        if cmd[1] == "show-config":
+            value = next(
+                (line.split("=", 1)[1] for line in value.splitlines() if line.startswith("trusted-users =")), ""
+            )
+        trusted = set(value.split())
+        user = pwd.getpwuid(os.getuid()).pw_name
+        groups: Set[str] = set()
+        for gid in {os.getgid(), *os.getgroups()}:
+            try:
+                groups.add(grp.getgrgid(gid).gr_name)
+            except KeyError:
+                continue
+        return "*" in trusted or user in trusted or any(f"@{group}" in trusted for group in groups)
+    return None
+
+
+# Read-only probe: 1-minute load, CPU count, free KiB under /nix/store.
+_BUILDER_PROBE_CMD = "cat /proc/loadavg && nproc && df -Pk /nix/store | tail -n 1"
+_BUILDER_EWMA_ALPHA = 0.3
+
+
+class _BuilderPool:
+    """Build placement over the `remoteBuilders` from config.
+
+    Each builder is `{"name", "uri", "systems", "maxJobs", "speedFactor",
+    "features", "host"}` for a nix remote builder probed over ssh via its
+    `allowedHosts` entry `host`, or `{"name", "local": true, "systems", ...}`
+    for a stand-in that builds on this machine (probed locally, so placement
+    can be exercised without remote hardware). Probes (load, cores, free
+    store space) are cached for `builderProbeSeconds`; measured throughput
+    (derivations built per minute of wall time, an EWMA) is kept in
+    `builder-stats.json` so later placements prefer builders that proved
+    fast. A builder is scored as throughput x idle fraction; until it has
+    been measured its `speedFactor` scales the fleet's median throughput.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.builders: List[Dict[str, Any]] = [dict(item) for item in config.get("remoteBuilders", [])]
+        self.path = _repo_path(config, "builderStatsPath", DEFAULT_BUILDER_STATS_PATH)
+        self.probe_seconds = float(config.get("builderProbeSeconds", DEFAULT_BUILDER_PROBE_SECONDS))
+        self.min_free = float(config.get("builderMinFreeGiB", DEFAULT_BUILDER_MIN_FREE_GIB)) * 1024**3
+        self._lock = threading.Lock()
+        self._probes: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._stats: Dict[str, Dict[str, Any]] = self._load()
+        self._trusted: Optional[bool] = None
+        self._trust_checked = False
+
+    def trusted(self) -> Optional[bool]:
+        """_nix_trusted_user, checked once; placement is skipped when False."""
+        with self._lock:
+            if not self._trust_checked:
+                self._trusted = _nix_trusted_user()
+                self._trust_checked = True
+            return self._trusted
+
+    def distrust(self) -> None:
+        """Remember that nix ignored `--builders` from us after all."""
+        with self._lock:
+            self._trusted = False
+            self._trust_checked = True
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            loaded = json.loads(self.path.read_text(encoding="utf-8"))
+            return dict(loaded.get("builders", {}))
+        except (OSError, json.JSONDecodeError, AttributeError):
+            return {}
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"builders": self._stats}, indent=2, ensure_ascii=True), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def probe(self, builder: Dict[str, Any], refresh: bool = False) -> Dict[str, Any]:
+        name = str(builder["name"])
+        with self._lock:
+            cached = self._probes.get(name)
+        if cached is not None and not refresh and time.monotonic() - cached[0] < self.probe_seconds:
+            return cached[1]
+        started = time.monotonic()
+        if builder.get("local"):
+            store = "/nix/store" if os.path.isdir("/nix/store") else self.config["repoRoot"]
+            probe: Dict[str, Any] = {
+                "reachable": True,
+                "load": round(os.getloadavg()[0], 2),
+                "cores": os.cpu_count() or 1,
+                "freeBytes": shutil.disk_usage(store).free,
+            }
+        elif builder.get("host"):
+            try:
+                result = _run_ssh(str(builder["host"]), _BUILDER_PROBE_CMD, self.config, timeout=15)
+                lines = result["stdout"].splitlines()
+                if result["exitCode"] != 0 or len(lines) < 3:
+                    raise ValueError(result["stderr"].strip()[-200:] or "unexpected probe output")
+                probe = {
+                    "reachable": True,
+                    "load": float(lines[0].split()[0]),
+                    "cores": int(lines[1]),
+                    "freeBytes": int(lines[2].split()[3]) * 1024,
+                }
+            except (ValueError, IndexError, OSError, subprocess.TimeoutExpired) as exc:
+                probe = {"reachable": False, "error": str(exc)}
+        else:
+            # No allowedHosts entry to reach it through: rank on throughput alone.
+            probe = {"reachable": True, "probed": False}
+        probe["probeSeconds"] = round(time.monotonic() - started, 3)
+        with self._lock:
+            self._probes[name] = (time.monotonic(), probe)
+        return probe
+
+    def _score(self, builder: Dict[str, Any], probe: Dict[str, Any], reference: float) -> float:
+        stats = self._stats.get(str(builder["name"]), {})
+        speed = stats.get("throughput") or float(builder.get("speedFactor", 1)) * reference
+        cores = int(probe.get("cores") or builder.get("maxJobs") or 1)
+        idle = max(0.05, 1.0 - float(probe.get("load", 0.0)) / cores)
+        return speed * idle
+
+    def _reference(self) -> float:
+        measured = sorted(item["throughput"] for item in self._stats.values() if item.get("throughput"))
+        return measured[len(measured) // 2] if measured else 1.0
+
+    def candidates(self, system: str, refresh: bool = False) -> List[Dict[str, Any]]:
+        """Builders for `system` with their probe and score, best first."""
+        eligible = [b for b in self.builders if system in b.get("systems", [])]
+        if not eligible:
+            return []
+        with ThreadPoolExecutor(max_workers=len(eligible), thread_name_prefix="nix-ops-probe") as pool:
+            probes = list(pool.map(lambda b: self.probe(b, refresh), eligible))
+        reference = self._reference()
+        ranked: List[Dict[str, Any]] = []
+        for builder, probe in zip(eligible, probes):
+            entry = {"name": builder["name"], "probe": probe, "stats": self._stats.get(str(builder["name"]))}
+            if not probe.get("reachable"):
+                entry["excluded"] = "unreachable"
+            elif "freeBytes" in probe and probe["freeBytes"] < self.min_free:
+                entry["excluded"] = "low store space"
+            else:
+                entry["score"] = round(self._score(builder, probe, reference), 3)
+            ranked.append(entry)
+        ranked.sort(key=lambda entry: entry.get("score", -1.0), reverse=True)
+        return ranked
+
+    def place(self, system: str, requested: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Pick a builder for `system` and the nix arguments that send the build there.
+
+        `requested` names a builder to use regardless of score. Returns None
+        when no builder is configured for `system` or none is usable, in
+        which case nix's own builder configuration applies.
+        """
+        ranked = self.candidates(system)
+        if requested:
+            chosen = next((entry for entry in ranked if entry["name"] == requested), None)
+            if chosen is None:
+                raise ValueError(f"Builder '{requested}' is not configured for {system}")
+            reason = "requested"
+        else:
+            chosen = next((entry for entry in ranked if "score" in entry), None)
+            if chosen is None:
+                return None
+            reason = "best score"
+        builder = next(b for b in self.builders if b["name"] == chosen["name"])
+        if builder.get("local"):
+            nix_args = ["--builders", ""]
+            if builder.get("maxJobs") is not None:
+                nix_args += ["--max-jobs", str(int(builder["maxJobs"]))]
+        else:
+            features = ",".join(builder.get("features", [])) or "-"
+            spec = f"{builder['uri']} {system} - {int(builder.get('maxJobs', 1))} {builder.get('speedFactor', 1)} {features}"
+            nix_args = ["--builders", spec, "--max-jobs", "0"]
+        return {
+            "name": chosen["name"],
+            "system": system,
+            "reason": reason,
+            "nixArgs": nix_args,
+            "candidates": ranked,
+        }
+
+    def record(self, name: str, built: int, wall_seconds: float) -> None:
+        if built <= 0 or wall_seconds <= 0:
+            return
+        rate = built / (wall_seconds / 60.0)
+        with self._lock:
+            stats = self._stats.setdefault(name, {"throughput": None, "samples": 0, "built": 0, "wallSeconds": 0.0})
+            previous = stats.get("throughput")
+            stats["throughput"] = round(
+                rate if previous is None else previous + _BUILDER_EWMA_ALPHA * (rate - previous), 4
+            )
+            stats["samples"] += 1
+            stats["built"] += built
+            stats["wallSeconds"] = round(stats["wallSeconds"] + wall_seconds, 3)
+            stats["updatedAt"] = _utcnow().isoformat()
+            self._save()
+
+    def describe(self, refresh: bool = False) -> List[Dict[str, Any]]:
+        described = []
+        for builder in self.builders:
+            described.append(
+                {
+                    **builder,
+                    "probe": self.probe(builder, refresh),
+                    "stats": self._stats.get(str(builder["name"])),
+                }
+            )
+        return described
+
+
+def _journal_cmd(args: Dict[str, Any]) -> str:
+    lines = int(args.get("lines", 200))
+    unit = args.get("unit")
+    since = args.get("since")
+    cmd_parts = ["journalctl", "--no-pager", "-n", str(lines)]
+    if unit:
+        cmd_parts += ["-u", str(unit)]
+    if since:
+        cmd_parts += ["--since", str(since)]
+    # Runs through the remote shell: every argument-derived value is quoted.
+    return " ".join(shlex.quote(part) for part in cmd_parts)
+
+
+def _dmesg_cmd(args: Dict[str, Any]) -> str:
+    lines = int(args.get("lines", 200))
+    return f"dmesg --color=never | tail -n {lines}"
+
+
+def _service_status_cmd(args: Dict[str, Any]) -> str:
+    if not args.get("unit"):
+        raise ValueError("unit is required for service_status")
+    return f"systemctl status {shlex.quote(str(args['unit']))} --no-pager -l"
+
+
+_FIRMWARE_CHECK_SCRIPT = (
+    "echo '=== FIRMWARE FILES ===' && "
+    "ls -lhA /boot/firmware/ 2>/dev/null || echo '/boot/firmware not mounted' && "
+    "echo && echo '=== OVERLAYS ===' && "
+    "ls /boot/firmware/overlays/ 2>/dev/null | head -20 || echo 'no overlays dir' && "
+    "echo && echo '=== CONFIG.TXT ===' && "
+    "cat /boot/firmware/config.txt 2>/dev/null || echo 'no config.txt' && "
+    "echo && echo '=== BOOT MODE ===' && "
+    "if [ -f /boot/firmware/RPI_EFI.fd ]; then echo 'UEFI firmware present'; "
+    "else echo 'No UEFI firmware (classic boot)'; fi && "
+    "echo && echo '=== ESP FILES ===' && "
+    "ls -lhA /boot/ 2>/dev/null | head -20 || echo '/boot not mounted' && "
+    "echo && echo '=== BOOTCTL ===' && "
+    "bootctl status --no-pager 2>/dev/null || echo 'bootctl not available or not UEFI boot'"
+)
+
+_TPM_STATUS_SCRIPT = (
+    "echo '=== PCR VALUES ===' && "
+    "tpm2_pcrread sha256:0,1,2,3,4,5,6,7 2>&1 || echo 'tpm2_pcrread not available' && "
+    "echo && echo '=== TPM2 TOOLS ===' && "
+    "which tpm2_pcrread 2>/dev/null && echo 'tpm2-tools: available' || echo 'tpm2-tools: not found' && "
+    "echo && echo '=== LUKS TOKENS ===' && "
+    "cryptsetup luksDump /dev/disk/by-partlabel/cryptroot 2>/dev/null | grep -A5 'Tokens:' || "
+    "echo 'no cryptroot partition or cryptsetup not available'"
+)
+
+_DISK_HEALTH_SCRIPT = (
+    "echo '=== BLOCK DEVICES ===' && "
+    "lsblk -Jbo NAME,SIZE,FSTYPE,MOUNTPOINT,MODEL 2>&1 && "
+    "echo && echo '=== DISK USAGE ===' && "
+    "df -h / && "
+    "echo && echo '=== SD/EMMC LIFE TIME ===' && "
+    "cat /sys/block/mmcblk0/device/life_time 2>/dev/null || echo 'no life_time info' && "
+    "echo && echo '=== SMART DATA ===' && "
+    "smartctl -a /dev/sda 2>/dev/null || echo 'no smartctl or no SSD'"
+)
+
+
+def _firmware_summary(host: str, stdout: str) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"host": host}
+    summary["hasUefiFirmware"] = "UEFI firmware present" in stdout
+    summary["hasConfigTxt"] = "no config.txt" not in stdout
+    if "kernel=RPI_EFI.fd" in stdout:
+        summary["bootMode"] = "uefi"
+    elif "kernel=kernel.img" in stdout:
+        summary["bootMode"] = "classic-kernel"
+    else:
+        summary["bootMode"] = "unknown"
+    return summary
+
 
+def _tpm_summary(host: str, stdout: str) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"host": host}
+    summary["tpm2ToolsAvailable"] = "tpm2-tools: available" in stdout
+    summary["hasLuksTokens"] = "Tokens:" in stdout and "no cryptroot" not in stdout
+    return summary
 
-ERROR_PATTERN = re.compile(r"error:\s*(.+)")
-PATH_PATTERN = re.compile(r"(/[^:\s]+\.nix):(\d+):(\d+)")
 
+def _disk_summary(host: str, stdout: str) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"host": host}
+    summary["hasLifeTimeInfo"] = "no life_time info" not in stdout
+    summary["hasSmartData"] = "no smartctl or no SSD" not in stdout
+    return summary
 
-def _extract_diagnostics(output: str) -> List[Dict[str, Any]]:
-    diagnostics: List[Dict[str, Any]] = []
-    lines = output.splitlines()
-    for idx, line in enumerate(lines):
-        error_match = ERROR_PATTERN.search(line)
-        if not error_match:
-            continue
-        message = error_match.group(1).strip()
-        location: Optional[Dict[str, Any]] = None
-        for j in range(idx, min(idx + 8, len(lines))):
-            loc_match = PATH_PATTERN.search(lines[j])
-            if loc_match:
-                location = {
-                    "file": loc_match.group(1),
-                    "line": int(loc_match.group(2)),
-                    "column": int(loc_match.group(3)),
-                }
-                break
-        item: Dict[str, Any] = {"message": message}
-        if location:
-            item["location"] = location
-        diagnostics.append(item)
-    return diagnostics
 
+# Fixed read-only templates fleet_exec may fan out:
+# name -> (remote command builder, per-host timeout, summary builder)
+_FLEET_TEMPLATES: Dict[str, Tuple[Any, int, Any]] = {
+    "journal": (_journal_cmd, 90, None),
+    "dmesg": (_dmesg_cmd, 90, None),
+    "service_status": (_service_status_cmd, 90, None),
+    "firmware_check": (lambda _args: _FIRMWARE_CHECK_SCRIPT, 30, _firmware_summary),
+    "tpm_status": (lambda _args: _TPM_STATUS_SCRIPT, 30, _tpm_summary),
+    "disk_health": (lambda _args: _DISK_HEALTH_SCRIPT, 30, _disk_summary),
+}
 
-def _host_target(host: str, config: Dict[str, Any]) -> str:
-    allowed_hosts = config.get("allowedHosts", {})
-    host_entry = allowed_hosts.get(host)
-    if not host_entry:
-        raise ValueError(f"Host '{host}' is not present in allowedHosts")
-    target = host_entry.get("sshTarget")
-    if not target:
-        raise ValueError(f"Host '{host}' is missing sshTarget")
-    return str(target)
 
+def _latency_stats(samples_ms: List[float]) -> Optional[Dict[str, float]]:
+    """min/avg/max plus jitter as the mean delta between consecutive samples (RFC 3550 style)."""
+    if not samples_ms:
+        return None
+    deltas = [abs(b - a) for a, b in zip(samples_ms, samples_ms[1:])]
+    return {
+        "minMs": round(min(samples_ms), 3),
+        "avgMs": round(sum(samples_ms) / len(samples_ms), 3),
+        "maxMs": round(max(samples_ms), 3),
+        "jitterMs": round(sum(deltas) / len(deltas), 3) if deltas else 0.0,
+    }
 
-def _run_ssh(host: str, remote_cmd: str, config: Dict[str, Any], timeout: int = 60) -> Dict[str, Any]:
-    target = _host_target(host, config)
-    ssh_options = [str(item) for item in config.get("sshOptions", [])]
-    cmd = ["ssh", *ssh_options, target, remote_cmd]
-    result = _run_command(cmd, cwd=config["repoRoot"], timeout=timeout)
-    result["host"] = host
-    result["sshTarget"] = target
+
+def _probe_icmp(ip: str, samples: int, timeout: float) -> Dict[str, Any]:
+    # ping handles the raw/datagram socket privileges; -i 0.2 is the unprivileged minimum.
+    deadline = int(timeout + samples * 0.2 + 0.999)
+    cmd = ["ping", "-n", "-c", str(samples), "-i", "0.2", "-W", str(max(1, int(timeout))), "-w", str(deadline), ip]
+    try:
+        proc = subprocess.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            timeout=deadline + 2,
+            check=False,
+        )
+    except FileNotFoundError:
+        return {"sent": 0, "received": 0, "error": "ping not found"}
+    except subprocess.TimeoutExpired:
+        return {"sent": samples, "received": 0, "error": "ping timeout"}
+    times = [float(m) for m in re.findall(r"time[=<]([\d.]+)\s*ms", proc.stdout)]
+    result: Dict[str, Any] = {"sent": samples, "received": len(times), "latency": _latency_stats(times)}
+    if proc.returncode not in (0, 1):
+        result["error"] = (proc.stderr or proc.stdout).strip()[:200]
     return result
 
 
+def _probe_tcp(ip: str, port: int, samples: int, timeout: float) -> Dict[str, Any]:
+    """Time TCP handshakes; a refused connect still proves the host is up."""
+    times: List[float] = []
+    state = "timeout"
+    budget_end = time.monotonic() + timeout
+    for _ in range(samples):
+        remaining = budget_end - time.monotonic()
+        if remaining <= 0:
+            break
+        started = time.perf_counter()
+        try:
+            with socket.create_connection((ip, port), timeout=remaining):
+                pass
+            state = "open"
+        except ConnectionRefusedError:
+            state = "refused"
+        except (socket.timeout, TimeoutError):
+            break
+        except OSError as exc:
+            state = "unreachable" if not times else state
+            if not times:
+                return {"port": port, "state": state, "error": str(exc), "latency": None}
+            break
+        times.append((time.perf_counter() - started) * 1000.0)
+    return {"port": port, "state": state, "samples": len(times), "latency": _latency_stats(times)}
+
+
 _UART_BAUD_MAP = {
     9600: termios.B9600,
     19200: termios.B19200,
@@ -362,6 +2894,28 @@ _UART_BAUD_MAP = {
     57600: termios.B57600,
     115200: termios.B115200,
 }
+# High rates (FTDI/CP210x/CH343 adapters, Pi 5 debug UART) where the platform
+# defines them; macOS termios stops at 230400.
+_UART_BAUD_MAP.update(
+    {
+        rate: getattr(termios, f"B{rate}")
+        for rate in (230400, 460800, 500000, 576000, 921600, 1000000, 1152000, 1500000, 2000000, 2500000, 3000000)
+        if hasattr(termios, f"B{rate}")
+    }
+)
+
+_UART_READ_MIN = 4096
+_UART_READ_MAX = 65536
+
+
+def _uart_read_size(baud_rate: int) -> int:
+    """Initial read size: about 20 ms of line rate (8N1 = 10 bits per byte)."""
+    return max(_UART_READ_MIN, min(_UART_READ_MAX, baud_rate // 10 // 50))
+
+
+def _uart_next_read_size(read_size: int, got: int) -> int:
+    # A full read means more was probably waiting; read bigger next time.
+    return min(read_size * 2, _UART_READ_MAX) if got >= read_size else read_size
 
 
 def _discover_uart_ttys() -> List[str]:
@@ -371,29 +2925,99 @@ def _discover_uart_ttys() -> List[str]:
     return sorted(set(devices))
 
 
-def _capture_uart(
-    device: str,
-    *,
-    baud_rate: int = 115200,
-    seconds: int = 15,
-    max_bytes: int = 16384,
-    send_data: Optional[str] = None,
-) -> Dict[str, Any]:
-    if baud_rate not in _UART_BAUD_MAP:
-        raise ValueError(f"Unsupported baudRate {baud_rate}. Supported: {sorted(_UART_BAUD_MAP)}")
-    if seconds < 1 or seconds > 120:
-        raise ValueError("seconds must be between 1 and 120")
-    if max_bytes < 256 or max_bytes > 262144:
-        raise ValueError("maxBytes must be between 256 and 262144")
+# Boot chain milestones as they appear on the Pi UART, in boot order: classic
+# boot (EEPROM -> config.txt -> kernel.img + initrd) and the UEFI chain
+# (EEPROM -> RPI_EFI.fd -> EDK2 -> systemd-boot -> Linux). Each phase runs
+# from its marker to the next marker found.
+_BOOT_TIMELINE_MARKERS: List[Tuple[str, str]] = [
+    ("eeprom", r"RPi: BOOTLOADER|BOOTMODE|Raspberry Pi Bootloader"),
+    ("config.txt", r"config\.txt"),
+    ("firmware-load", r"Loading ['\"]?(?:kernel\S*\.img|RPI_EFI\.fd)|Read (?:kernel\S*\.img|RPI_EFI\.fd)|Starting OS"),
+    ("uefi", r"UEFI firmware|EDK II|TianoCore|Tianocore"),
+    ("systemd-boot", r"systemd-boot|Boot Loader Interface"),
+    ("kernel", r"EFI stub:|Booting Linux on physical CPU|Linux version \d"),
+    ("initrd", r"Run /init as init process|\(Initrd\)|running in initrd"),
+    ("luks-unlock", r"cryptsetup|Please enter passphrase"),
+    ("switch-root", r"Switching root|NixOS Stage 2"),
+    ("login", r"login:"),
+]
+
+
+# Background captures flush a new cache entry every few seconds, so one boot
+# spans many entries. Entries of the same device closer than this are read as
+# one stream; a quiet LUKS passphrase prompt can easily sit for a minute.
+_BOOT_SESSION_GAP_SECONDS = 300.0
+
+
+def _boot_sessions(entries: List[Dict[str, Any]], gap_seconds: float) -> List[List[Dict[str, Any]]]:
+    """Group timed capture entries (oldest first) into per-device runs with small gaps."""
+    sessions: List[List[Dict[str, Any]]] = []
+    open_runs: Dict[Any, Tuple[List[Dict[str, Any]], float]] = {}
+    for entry in entries:
+        started = _cache_ts(entry.get("startedAt"))
+        if started is None:
+            sessions.append([entry])
+            continue
+        begin = started.timestamp()
+        end = begin + entry["lineMs"][-1] / 1000.0
+        device = entry.get("device")
+        run = open_runs.get(device)
+        if run is not None and begin - run[1] <= gap_seconds:
+            run[0].append(entry)
+            open_runs[device] = (run[0], max(run[1], end))
+        else:
+            session = [entry]
+            sessions.append(session)
+            open_runs[device] = (session, end)
+    return sessions
+
+
+def _split_boots(records: List[Dict[str, Any]], first_marker: Optional[re.Pattern]) -> List[List[Dict[str, Any]]]:
+    """Cut a merged capture stream at each repeat of the first boot marker (a reboot)."""
+    boots: List[List[Dict[str, Any]]] = [[]]
+    for record in records:
+        if boots[-1] and first_marker is not None and first_marker.search(record["line"]):
+            boots.append([])
+        boots[-1].append(record)
+    return [boot for boot in boots if boot]
+
+
+def _boot_timeline(records: List[Dict[str, Any]], markers: List[Tuple[str, re.Pattern]]) -> Dict[str, Any]:
+    """Phase start/duration table from (line, offsetMs) records of one boot."""
+    found: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        if len(found) == len(markers):
+            break
+        for phase, matcher in markers:
+            if phase not in found and matcher.search(record["line"]):
+                found[phase] = {
+                    "phase": phase,
+                    "lineNumber": record["lineNumber"],
+                    "line": record["line"][:200],
+                    "atMs": record.get("offsetMs"),
+                }
+    order = {phase: i for i, (phase, _) in enumerate(markers)}
+    phases = sorted(
+        found.values(),
+        key=lambda p: (p["atMs"] if p["atMs"] is not None else float("inf"), order[p["phase"]]),
+    )
+    for current, following in zip(phases, phases[1:] + [None]):
+        if following is not None and current["atMs"] is not None and following["atMs"] is not None:
+            current["durationMs"] = following["atMs"] - current["atMs"]
+        else:
+            current["durationMs"] = None
+    timed = [p["atMs"] for p in phases if p["atMs"] is not None]
+    return {
+        "phases": phases,
+        "missingPhases": [phase for phase, _ in markers if phase not in found],
+        "totalMs": (max(timed) - min(timed)) if len(timed) > 1 else None,
+    }
 
-    fd: Optional[int] = None
-    original_attr: Optional[List[Any]] = None
-    chunks: List[bytes] = []
-    total = 0
-    deadline = _utcnow() + dt.timedelta(seconds=seconds)
 
+def _open_uart(device: str, baud_rate: int) -> Tuple[int, List[Any]]:
+    """Open and configure a TTY raw 8N1; returns (fd, original attrs to restore)."""
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
     try:
-        fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
         original_attr = termios.tcgetattr(fd)
         attrs = termios.tcgetattr(fd)
 
@@ -407,30 +3031,207 @@ def _capture_uart(
         attrs[5] = _UART_BAUD_MAP[baud_rate]
         termios.tcsetattr(fd, termios.TCSANOW, attrs)
         termios.tcflush(fd, termios.TCIFLUSH)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd, original_attr
 
-        if send_data:
-            os.write(fd, send_data.encode("utf-8", errors="ignore"))
 
-        while _utcnow() < deadline and total < max_bytes:
-            remaining = (deadline - _utcnow()).total_seconds()
-            timeout = 0.2 if remaining > 0.2 else max(remaining, 0.0)
-            readable, _, _ = select.select([fd], [], [], timeout)
-            if not readable:
+def _close_uart(fd: Optional[int], original_attr: Optional[List[Any]]) -> None:
+    if fd is not None and original_attr is not None:
+        try:
+            termios.tcsetattr(fd, termios.TCSANOW, original_attr)
+        except Exception:
+            pass
+    if fd is not None:
+        try:
+            os.close(fd)
+        except Exception:
+            pass
+
+
+_UART_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+def _split_uart_lines(text: str) -> List[str]:
+    """Split decoded UART text on LF, CR and CRLF only, like bytes.splitlines.
+
+    str.splitlines also breaks on \\x1c-\\x1e, \\x85, \\u2028 and \\u2029, which
+    would throw stored lines out of step with their _line_offsets_ms stamps.
+    """
+    lines = _UART_LINE_BREAK.split(text)
+    if lines and lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _line_offsets_ms(data: bytes, chunk_starts: List[int], chunk_times: List[float], origin: float) -> List[int]:
+    """Milliseconds from `origin` at which each line's first byte was read.
+
+    `chunk_starts[i]` is the byte offset in `data` where read i began and
+    `chunk_times[i]` its monotonic read time. Lines split on LF, CR and CRLF,
+    the same rule _split_uart_lines applies to the decoded text.
+    """
+    offsets: List[int] = []
+    position = 0
+    for line in data.splitlines(keepends=True):
+        chunk = max(bisect.bisect_right(chunk_starts, position) - 1, 0)
+        offsets.append(int(round((chunk_times[chunk] - origin) * 1000)))
+        position += len(line)
+    return offsets
+
+
+def _validate_capture_args(baud_rate: int, seconds: int, max_bytes: int) -> None:
+    if baud_rate not in _UART_BAUD_MAP:
+        raise ValueError(f"Unsupported baudRate {baud_rate}. Supported: {sorted(_UART_BAUD_MAP)}")
+    if seconds < 1 or seconds > 120:
+        raise ValueError("seconds must be between 1 and 120")
+    if max_bytes < 256 or max_bytes > 262144:
+        raise ValueError("maxBytes must be between 256 and 262144")
+
+
+class _UartTrigger:
+    """Incremental untilPattern/failPattern matcher over a byte stream.
+
+    Bytes are decoded incrementally (a UTF-8 sequence split across reads is
+    held back, not replaced), and each new piece is searched together with
+    the last `carry_chars` characters, so a marker split across reads still
+    matches without rescanning the whole capture. `offset` in the result is
+    the character offset of the match in the decoded stdout.
+    """
+
+    def __init__(self, until: Optional[re.Pattern], fail: Optional[re.Pattern], carry_chars: int) -> None:
+        self.until = until
+        self.fail = fail
+        self.carry_chars = carry_chars
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._carry = ""
+        self._consumed = 0
+
+    @staticmethod
+    def compile(pattern: Any, name: str) -> Optional[re.Pattern]:
+        if pattern is None or pattern == "":
+            return None
+        try:
+            return re.compile(str(pattern))
+        except re.error as exc:
+            raise ValueError(f"Invalid {name} regex: {exc}") from exc
+
+    def feed(self, data: bytes) -> Optional[Dict[str, Any]]:
+        text = self._decoder.decode(data)
+        if not text:
+            return None
+        window = self._carry + text
+        base = self._consumed - len(self._carry)
+        hits = []
+        for kind, matcher in (("fail", self.fail), ("until", self.until)):
+            if matcher is None:
                 continue
-            read_len = min(4096, max_bytes - total)
-            if read_len <= 0:
-                break
+            match = matcher.search(window)
+            if match is not None:
+                hits.append((match.start(), kind, matcher, match))
+        self._consumed += len(text)
+        self._carry = window[-self.carry_chars :]
+        if not hits:
+            return None
+        # Earliest match wins; on a tie failPattern wins (sorted first).
+        start, kind, matcher, match = min(hits, key=lambda h: h[0])
+        return {
+            "kind": kind,
+            "pattern": matcher.pattern,
+            "match": match.group(0),
+            "offset": base + start,
+        }
+
+
+def _capture_uart_multi(
+    devices: List[str],
+    *,
+    baud_rate: int = 115200,
+    seconds: int = 15,
+    max_bytes: int = 16384,
+    send_data: Optional[str] = None,
+    until_pattern: Optional[str] = None,
+    fail_pattern: Optional[str] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """Capture several TTYs in one select loop; `max_bytes` is a per-device budget.
+
+    A device that fails to open gets an `error` entry; the rest still capture.
+    A device stops as soon as `until_pattern` or `fail_pattern` matches its
+    output. The loop ends at the deadline or once every device is done.
+    """
+    _validate_capture_args(baud_rate, seconds, max_bytes)
+    until = _UartTrigger.compile(until_pattern, "untilPattern")
+    fail = _UartTrigger.compile(fail_pattern, "failPattern")
+    watching = until is not None or fail is not None
+    triggers = {device: _UartTrigger(until, fail, DEFAULT_UART_TRIGGER_CARRY_CHARS) for device in devices}
+    fired: Dict[str, Dict[str, Any]] = {}
+
+    opened: Dict[int, Tuple[str, List[Any]]] = {}
+    chunks: Dict[str, List[bytes]] = {device: [] for device in devices}
+    totals: Dict[str, int] = {device: 0 for device in devices}
+    chunk_starts: Dict[str, List[int]] = {device: [] for device in devices}
+    chunk_times: Dict[str, List[float]] = {device: [] for device in devices}
+    errors: Dict[str, str] = {}
+    read_size = {device: _uart_read_size(baud_rate) for device in devices}
+    started_at = _utcnow().isoformat()
+    started = time.monotonic()
+    deadline = started + seconds
+
+    try:
+        for device in devices:
             try:
-                data = os.read(fd, read_len)
-            except BlockingIOError:
-                continue
-            if not data:
+                fd, original_attr = _open_uart(device, baud_rate)
+            except OSError as exc:
+                errors[device] = str(exc)
                 continue
-            chunks.append(data)
-            total += len(data)
-
-        combined = b"".join(chunks)
-        return {
+            opened[fd] = (device, original_attr)
+            if send_data:
+                os.write(fd, send_data.encode("utf-8", errors="ignore"))
+
+        active = set(opened)
+        while active:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select(list(active), [], [], min(0.2, remaining))
+            for fd in readable:
+                device = opened[fd][0]
+                read_len = min(read_size[device], max_bytes - totals[device])
+                try:
+                    data = os.read(fd, read_len)
+                except BlockingIOError:
+                    continue
+                except OSError as exc:
+                    # Adapter unplugged mid-capture; keep what arrived.
+                    errors[device] = str(exc)
+                    active.discard(fd)
+                    continue
+                if not data:
+                    continue
+                read_size[device] = _uart_next_read_size(read_size[device], len(data))
+                chunk_starts[device].append(totals[device])
+                chunk_times[device].append(time.monotonic())
+                chunks[device].append(data)
+                totals[device] += len(data)
+                if watching:
+                    hit = triggers[device].feed(data)
+                    if hit is not None:
+                        hit["elapsedSeconds"] = round(time.monotonic() - started, 3)
+                        fired[device] = hit
+                        active.discard(fd)
+                        continue
+                if totals[device] >= max_bytes:
+                    active.discard(fd)
+    finally:
+        for fd, (_device, original_attr) in opened.items():
+            _close_uart(fd, original_attr)
+
+    elapsed = round(time.monotonic() - started, 3)
+    results: Dict[str, Dict[str, Any]] = {}
+    for device in devices:
+        combined = b"".join(chunks[device])
+        result: Dict[str, Any] = {
             "device": device,
             "baudRate": baud_rate,
             "seconds": seconds,
@@ -438,18 +3239,526 @@ def _capture_uart(
             "bytesRead": len(combined),
             "stdout": combined.decode("utf-8", errors="replace"),
             "hexPreview": combined[:256].hex(),
+            "elapsedSeconds": elapsed,
+            "startedAt": started_at,
+            "lineOffsetsMs": _line_offsets_ms(combined, chunk_starts[device], chunk_times[device], started),
         }
-    finally:
-        if fd is not None and original_attr is not None:
-            try:
-                termios.tcsetattr(fd, termios.TCSANOW, original_attr)
-            except Exception:
-                pass
-        if fd is not None:
+        if watching:
+            result["trigger"] = fired.get(device)
+        if device in errors:
+            result["error"] = errors[device]
+        results[device] = result
+    return results
+
+
+def _capture_uart(
+    device: str,
+    *,
+    baud_rate: int = 115200,
+    seconds: int = 15,
+    max_bytes: int = 16384,
+    send_data: Optional[str] = None,
+    until_pattern: Optional[str] = None,
+    fail_pattern: Optional[str] = None,
+) -> Dict[str, Any]:
+    result = _capture_uart_multi(
+        [device],
+        baud_rate=baud_rate,
+        seconds=seconds,
+        max_bytes=max_bytes,
+        send_data=send_data,
+        until_pattern=until_pattern,
+        fail_pattern=fail_pattern,
+    )[device]
+    if "error" in result and not result["bytesRead"]:
+        # Keep the single-device contract: an unusable TTY raises.
+        raise OSError(result["error"])
+    return result
+
+
+class _UartRing:
+    """Bounded byte ring addressed by absolute stream offsets (cursors).
+
+    Offset 0 is the first byte ever written; the ring keeps the newest
+    `capacity` bytes. A reader whose cursor fell off the front is told how
+    many bytes it missed instead of silently skipping them.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._buf = bytearray()
+        self._start = 0
+        self._cond = threading.Condition()
+
+    @property
+    def end(self) -> int:
+        with self._cond:
+            return self._start + len(self._buf)
+
+    def write(self, data: bytes) -> None:
+        with self._cond:
+            self._buf += data
+            excess = len(self._buf) - self.capacity
+            if excess > 0:
+                del self._buf[:excess]
+                self._start += excess
+            self._cond.notify_all()
+
+    def read(self, cursor: Optional[int], max_bytes: int, wait: float = 0.0) -> Dict[str, Any]:
+        with self._cond:
+            end = self._start + len(self._buf)
+            if cursor is None:
+                cursor = max(self._start, end - max_bytes)
+            if wait > 0 and cursor >= end:
+                self._cond.wait_for(lambda: self._start + len(self._buf) > cursor, timeout=wait)
+                end = self._start + len(self._buf)
+            dropped = max(0, self._start - cursor)
+            begin = max(cursor, self._start)
+            if begin > end:
+                # Cursor from a previous session/ring; restart at the live edge.
+                begin = end
+            data = bytes(self._buf[begin - self._start : min(end, begin + max_bytes) - self._start])
+            return {
+                "data": data,
+                "cursor": begin + len(data),
+                "droppedBytes": dropped,
+                "ringStart": self._start,
+                "ringEnd": end,
+            }
+
+
+class _UartBackgroundCapture:
+    """One TTY kept open on a daemon thread, feeding a ring and the cache.
+
+    The device is opened and configured once. Every byte goes into the ring
+    for uart_tail; complete lines are appended to the UART cache as one
+    capture per flush (every `flush_seconds`, or sooner once 64 KiB of lines
+    are pending), with `background: true` in the header.
+    """
+
+    _FLUSH_BYTES = 64 * 1024
+
+    def __init__(self, device: str, baud_rate: int, store: _UartCacheStore, ring_bytes: int, flush_seconds: float) -> None:
+        self.device = device
+        self.baud_rate = baud_rate
+        self.store = store
+        self.ring = _UartRing(ring_bytes)
+        self.flush_seconds = flush_seconds
+        self.started_at = _utcnow()
+        self.error: Optional[str] = None
+        self.cached_lines = 0
+        self._fd: Optional[int] = None
+        self._original_attr: Optional[List[Any]] = None
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._pending = bytearray()
+        self._pending_starts: List[int] = []
+        self._pending_times: List[float] = []
+        self._thread = threading.Thread(target=self._run, name=f"nix-ops-uart-{Path(device).name}", daemon=True)
+
+    def start(self) -> None:
+        self._fd, self._original_attr = _open_uart(self.device, self.baud_rate)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def send(self, data: str) -> None:
+        if self._fd is None or not self.running:
+            raise ValueError(f"Background capture on {self.device} is not running")
+        with self._write_lock:
+            os.write(self._fd, data.encode("utf-8", errors="ignore"))
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        fd = self._fd
+        last_flush = time.monotonic()
+        read_size = _uart_read_size(self.baud_rate)
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([fd], [], [], 0.2)
+                if readable:
+                    try:
+                        data = os.read(fd, read_size)
+                    except BlockingIOError:
+                        data = b""
+                    if data:
+                        read_size = _uart_next_read_size(read_size, len(data))
+                        self.ring.write(data)
+                        self._pending_starts.append(len(self._pending))
+                        self._pending_times.append(time.monotonic())
+                        self._pending += data
+                now = time.monotonic()
+                if now - last_flush >= self.flush_seconds or len(self._pending) >= self._FLUSH_BYTES:
+                    self._flush(final=False)
+                    last_flush = now
+        except OSError as exc:
+            # Typically the adapter was unplugged; keep what we have.
+            self.error = str(exc)
+            _log(f"uart background {self.device} stopped: {exc}")
+        finally:
+            self._flush(final=True)
+            _close_uart(fd, self._original_attr)
+            self._fd = None
+
+    def _flush(self, final: bool) -> None:
+        cut = len(self._pending) if final else self._pending.rfind(b"\n") + 1
+        if cut <= 0 and len(self._pending) >= self._FLUSH_BYTES:
+            # No newline in a full buffer (binary output, a spinner, wrong
+            # baud rate): flush it as a partial line rather than grow forever.
+            cut = len(self._pending)
+        if cut <= 0:
+            return
+        chunk = bytes(self._pending[:cut])
+        del self._pending[:cut]
+        starts, times = self._pending_starts, self._pending_times
+        origin = times[0]
+        line_ms = _line_offsets_ms(chunk, starts, times, origin)
+        # The read covering byte `cut` (possibly straddling it) now starts the
+        # remaining pending bytes at offset 0; later reads shift down.
+        keep = bisect.bisect_right(starts, cut) - 1
+        self._pending_starts = [max(start - cut, 0) for start in starts[keep:]] if self._pending else []
+        self._pending_times = times[keep:] if self._pending else []
+        lines = _split_uart_lines(chunk.decode("utf-8", errors="replace"))
+        if not lines:
+            return
+        now = _utcnow()
+        header = {
+            "ts": now.isoformat(),
+            "device": self.device,
+            "baudRate": self.baud_rate,
+            "bytesRead": len(chunk),
+            "background": True,
+            "startedAt": (now - dt.timedelta(seconds=time.monotonic() - origin)).isoformat(),
+        }
+        if len(line_ms) == len(lines):
+            header["lineMs"] = line_ms
+        try:
+            self.store.append_capture(header, lines)
+            self.cached_lines += len(lines)
+        except OSError as exc:
+            _log(f"uart background {self.device}: cache append failed: {exc}")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "device": self.device,
+            "baudRate": self.baud_rate,
+            "running": self.running,
+            "startedAt": self.started_at.isoformat(),
+            "cursor": self.ring.end,
+            "ringBytes": self.ring.capacity,
+            "cachedLines": self.cached_lines,
+            "error": self.error,
+        }
+
+
+class _UartBackgroundManager:
+    def __init__(self, store: _UartCacheStore, config: Dict[str, Any]) -> None:
+        self.store = store
+        self.ring_bytes = int(config.get("uartRingBytes", DEFAULT_UART_RING_BYTES))
+        self.flush_seconds = float(config.get("uartBackgroundFlushSeconds", DEFAULT_UART_BACKGROUND_FLUSH_SECONDS))
+        self._lock = threading.Lock()
+        self._captures: Dict[str, _UartBackgroundCapture] = {}
+
+    def get(self, device: str) -> Optional[_UartBackgroundCapture]:
+        with self._lock:
+            capture = self._captures.get(device)
+        return capture if capture is not None and capture.running else None
+
+    def start(self, device: str, baud_rate: int) -> Tuple[_UartBackgroundCapture, bool]:
+        if baud_rate not in _UART_BAUD_MAP:
+            raise ValueError(f"Unsupported baudRate {baud_rate}. Supported: {sorted(_UART_BAUD_MAP)}")
+        with self._lock:
+            existing = self._captures.get(device)
+            if existing is not None and existing.running:
+                return existing, False
+            capture = _UartBackgroundCapture(device, baud_rate, self.store, self.ring_bytes, self.flush_seconds)
+            capture.start()
+            self._captures[device] = capture
+            return capture, True
+
+    def stop(self, device: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            devices = [device] if device else list(self._captures)
+            captures = [self._captures.pop(d) for d in devices if d in self._captures]
+        for capture in captures:
+            capture.stop()
+        return [c.status() for c in captures]
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [c.status() for c in self._captures.values()]
+
+
+# Long-running tools that go through the job manager: they can run with
+# `background: true`, and identical in-flight calls share one subprocess.
+_JOB_TOOLS = ("check_flake", "build_host", "build_installer", "build_hosts", "deploy_execute")
+# Arguments that do not change what a job does, so they are left out of the
+# coalescing key (the first caller's timeout applies).
+_JOB_KEY_IGNORED_ARGS = ("background", "timeoutSeconds")
+# Side-effecting jobs that must run once per call, never joined.
+_JOB_UNCOALESCED = ("deploy_execute",)
+
+
+class _Job:
+    """One tool call run on its own thread, with a combined output log.
+
+    Command output from the job's thread reaches `line` through
+    `_CURRENT_PROGRESS`; it is appended to the log file, counted for
+    job_status, and forwarded to the progress reporters of every foreground
+    caller waiting on the job.
+    """
+
+    def __init__(self, job_id: str, tool: str, args: Dict[str, Any], key: str, log_path: Path) -> None:
+        self.id = job_id
+        self.tool = tool
+        self.args = args
+        self.key = key
+        self.log_path = log_path
+        self.status = "queued"
+        self.phase = "starting"
+        self.lines = {"stdout": 0, "stderr": 0}
+        self.created_at = _utcnow()
+        self.finished_at: Optional[dt.datetime] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+        self.callers = 1
+        self.waiters: List[_ProgressReporter] = []
+        # (request id, progress reporter, callback) of deferred foreground calls.
+        self.followers: List[Tuple[Any, Optional[_ProgressReporter], Callable[["_Job"], None]]] = []
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._log: Optional[io.TextIOWrapper] = None
+
+    @property
+    def request_key(self) -> str:
+        # Pseudo request id so the job's subprocesses are tracked/cancellable.
+        return f"job:{self.id}"
+
+    def line(self, stream: str, text: str) -> None:
+        with self._lock:
+            self.lines[stream] += 1
+            for pattern, template in _NIX_PHASE_PATTERNS:
+                match = pattern.search(text)
+                if match:
+                    self.phase = template.format(*match.groups())
+                    break
+            if self._log is None:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                self._log = self.log_path.open("a", encoding="utf-8", errors="replace")
+            self._log.write(text + "\n")
+            self._log.flush()
+            waiters = list(self.waiters)
+        for reporter in waiters:
+            reporter.line(stream, text)
+
+    def finish(self, status: str, result: Optional[Dict[str, Any]], error: Optional[BaseException]) -> None:
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = _utcnow()
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self.done.set()
+            followers, self.followers = self.followers, []
+            for _request_id, reporter, _callback in followers:
+                if reporter in self.waiters:
+                    self.waiters.remove(reporter)
+        for request_id, _reporter, callback in followers:
             try:
-                os.close(fd)
-            except Exception:
-                pass
+                callback(self)
+            except Exception as exc:
+                _debug(f"job {self.id}: completing request {request_id} failed: {exc}")
+
+    def summary(self) -> Dict[str, Any]:
+        end = self.finished_at or _utcnow()
+        summary: Dict[str, Any] = {
+            "jobId": self.id,
+            "tool": self.tool,
+            "args": self.args,
+            "status": self.status,
+            "phase": self.phase,
+            "lines": dict(self.lines),
+            "callers": self.callers,
+            "createdAt": self.created_at.isoformat(),
+            "elapsedSeconds": round((end - self.created_at).total_seconds(), 3),
+        }
+        if self.finished_at is not None:
+            summary["finishedAt"] = self.finished_at.isoformat()
+        if self.error is not None:
+            summary["error"] = str(self.error)
+        return summary
+
+
+class _JobManager:
+    """Runs long tool calls as jobs and coalesces identical in-flight calls.
+
+    Jobs run on a pool of `jobWorkers` threads (default: maxWorkers); extra
+    jobs wait as "queued". A call whose (tool, args, flake source) key
+    matches a queued or running job attaches to it instead of starting a
+    second subprocess; every caller gets the same result. Calls in
+    `_JOB_UNCOALESCED` always get their own job. The newest `history`
+    finished jobs (and their logs) are kept for job_status and job_log.
+    """
+
+    def __init__(self, config: Dict[str, Any], source: Callable[[], Optional[Dict[str, str]]]) -> None:
+        self.history = int(config.get("jobHistory", DEFAULT_JOB_HISTORY))
+        self.source = source
+        workers = int(config.get("jobWorkers", config.get("maxWorkers", DEFAULT_MAX_WORKERS)))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="nix-ops-job")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, _Job]" = OrderedDict()
+        self._running: Dict[str, _Job] = {}
+        self._futures: Dict[str, Future] = {}
+        self._counter = 0
+
+    @staticmethod
+    def key(tool: str, args: Dict[str, Any], source: Optional[Dict[str, str]]) -> str:
+        relevant = {k: v for k, v in args.items() if k not in _JOB_KEY_IGNORED_ARGS}
+        return json.dumps([tool, relevant, source], sort_keys=True, default=str)
+
+    def submit(self, tool: str, handler: Any, args: Dict[str, Any]) -> Tuple[_Job, bool]:
+        """Start a job, or join the identical one already running; returns (job, coalesced)."""
+        # The flake source is part of the key: a call made after an edit must
+        # not be answered with a build of the old tree.
+        key = None if tool in _JOB_UNCOALESCED else self.key(tool, args, self.source())
+        with self._lock:
+            running = self._running.get(key) if key is not None else None
+            if running is not None:
+                running.callers += 1
+                return running, True
+            self._counter += 1
+            job_id = f"job-{_utcnow().strftime('%Y%m%dT%H%M%S')}-{self._counter}"
+            job = _Job(job_id, tool, dict(args), key or job_id, _OUTPUT_SPOOL.root / f"{job_id}.log")
+            self._jobs[job_id] = job
+            if key is not None:
+                self._running[key] = job
+            self._futures[job_id] = self._pool.submit(self._run, job, handler)
+        return job, False
+
+    def _run(self, job: _Job, handler: Any) -> None:
+        with job._lock:
+            job.status = "running"
+        # Subprocesses belong to the job, not to whichever request created it.
+        _CURRENT_REQUEST.set(job.request_key)
+        _CURRENT_PROGRESS.set(job)
+        _REQUESTS.begin(job.request_key)
+        result: Optional[Dict[str, Any]] = None
+        error: Optional[BaseException] = None
+        try:
+            result = handler(job.args)
+        except Exception as exc:
+            error = exc
+        cancelled = _REQUESTS.finish(job.request_key)
+        with self._lock:
+            self._running.pop(job.key, None)
+            self._futures.pop(job.id, None)
+        if cancelled:
+            job.finish("cancelled", None, error or RuntimeError("Job was cancelled"))
+        elif error is not None:
+            job.finish("failed", None, error)
+        else:
+            job.finish("succeeded", result, None)
+        self._trim()
+
+    def _trim(self) -> None:
+        with self._lock:
+            finished = [j for j in self._jobs.values() if j.done.is_set()]
+            for job in finished[: max(0, len(finished) - self.history)]:
+                del self._jobs[job.id]
+                job.log_path.unlink(missing_ok=True)
+
+    def get(self, job_id: str) -> Optional[_Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[_Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job: _Job) -> int:
+        with self._lock:
+            future = self._futures.get(job.id)
+            dequeued = future is not None and future.cancel()
+            if dequeued:
+                self._running.pop(job.key, None)
+                self._futures.pop(job.id, None)
+        if dequeued:
+            job.finish("cancelled", None, RuntimeError("Job was cancelled before it started"))
+            self._trim()
+            return 0
+        return _REQUESTS.cancel(job.request_key)
+
+    def follow(self, job: _Job, request_id: Any, callback: Callable[[_Job], None]) -> None:
+        """Call `callback(job)` when the job ends, without holding a thread meanwhile.
+
+        The caller's progress reporter is forwarded job output until then.
+        Runs the callback at once if the job has already finished.
+        """
+        reporter = _CURRENT_PROGRESS.get()
+        with job._lock:
+            if not job.done.is_set():
+                if reporter is not None:
+                    job.waiters.append(reporter)
+                job.followers.append((request_id, reporter, callback))
+                return
+        callback(job)
+
+    def abandon(self, request_id: Any) -> bool:
+        """Drop a cancelled request's follow; cancels the job if no caller is left."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            with job._lock:
+                mine = [f for f in job.followers if f[0] == request_id]
+                for follower in mine:
+                    job.followers.remove(follower)
+                    if follower[1] in job.waiters:
+                        job.waiters.remove(follower[1])
+            if not mine:
+                continue
+            with self._lock:
+                job.callers -= 1
+                abandoned = job.callers <= 0
+            if abandoned:
+                self.cancel(job)
+            return True
+        return False
+
+    def wait(self, job: _Job, request_id: Any) -> Optional[Dict[str, Any]]:
+        """Block a foreground caller until the job ends; None if the caller was cancelled.
+
+        Progress for the caller's own token is forwarded while it waits. If the
+        last caller of a job cancels, the job is cancelled too.
+        """
+        reporter = _CURRENT_PROGRESS.get()
+        if reporter is not None:
+            with job._lock:
+                job.waiters.append(reporter)
+        try:
+            while not job.done.wait(0.2):
+                if request_id is not None and _REQUESTS.is_cancelled(request_id):
+                    with self._lock:
+                        job.callers -= 1
+                        abandoned = job.callers <= 0
+                    if abandoned:
+                        self.cancel(job)
+                    return None
+        finally:
+            if reporter is not None:
+                with job._lock:
+                    if reporter in job.waiters:
+                        job.waiters.remove(reporter)
+        if job.error is not None:
+            raise job.error
+        return job.result
 
 
 class NixOpsServer:
@@ -457,15 +3766,55 @@ class NixOpsServer:
         _debug("NixOpsServer: loading config")
         self.config = _load_config()
         self.repo_root = self.config["repoRoot"]
+        _OUTPUT_SPOOL.configure(self.config)
+        self.uart_cache = _uart_cache_store(self.config)
+        try:
+            self.uart_cache.maintain()
+        except OSError as exc:
+            _log(f"uart cache maintenance failed: {exc}")
+        self.uart_background = _UartBackgroundManager(self.uart_cache, self.config)
+        atexit.register(self.uart_background.stop)
+        if bool(self.config.get("uartBackgroundAutostart", False)):
+            for device in _discover_uart_ttys():
+                try:
+                    self.uart_background.start(device, int(self.config.get("uartBackgroundBaudRate", 115200)))
+                except (OSError, ValueError) as exc:
+                    _log(f"uart background autostart failed for {device}: {exc}")
+        self.jobs = _JobManager(self.config, lambda: _flake_source_fingerprint(self.repo_root))
+        self.eval_cache = _EvalCache(
+            _repo_path(self.config, "evalCachePath", DEFAULT_EVAL_CACHE_PATH),
+            int(self.config.get("evalCacheMaxEntries", DEFAULT_EVAL_CACHE_MAX_ENTRIES)),
+            enabled=bool(self.config.get("evalCache", True)),
+        )
+        self.diff_cache = _DiffCache(
+            _repo_path(self.config, "diffCacheDir", DEFAULT_DIFF_CACHE_DIR),
+            int(self.config.get("diffCacheKeep", DEFAULT_DIFF_CACHE_KEEP)),
+        )
+        self.builders = _BuilderPool(self.config)
+        self.evaluator: Optional[_NixRepl] = None
+        if bool(self.config.get("evalWarmRepl", True)):
+            self.evaluator = _NixRepl(
+                self.repo_root,
+                float(self.config.get("evalReplIdleSeconds", DEFAULT_EVAL_REPL_IDLE_SECONDS)),
+                int(self.config.get("evalReplMaxReloads", DEFAULT_EVAL_REPL_MAX_RELOADS)),
+            )
+            atexit.register(self.evaluator.stop)
         _debug(f"NixOpsServer: repo_root={self.repo_root}")
         self.tools = {
             "check_flake": self.check_flake,
             "list_hosts": self.list_hosts,
             "eval_host": self.eval_host,
+            "eval_all_hosts": self.eval_all_hosts,
             "build_host": self.build_host,
             "build_installer": self.build_installer,
+            "build_hosts": self.build_hosts,
+            "list_builders": self.list_builders,
             "format_check": self.format_check,
             "parse_nix_error": self.parse_nix_error,
+            "output_page": self.output_page,
+            "job_status": self.job_status,
+            "job_log": self.job_log,
+            "job_cancel": self.job_cancel,
             "pi_journal": self.pi_journal,
             "pi_dmesg": self.pi_dmesg,
             "pi_service_status": self.pi_service_status,
@@ -473,11 +3822,17 @@ class NixOpsServer:
             "pi_uart_console": self.pi_uart_console,
             "pi_uart_cache_query": self.pi_uart_cache_query,
             "pi_uart_cache_range": self.pi_uart_cache_range,
+            "uart_background_start": self.uart_background_start,
+            "uart_background_stop": self.uart_background_stop,
+            "uart_background_status": self.uart_background_status,
+            "uart_tail": self.uart_tail,
+            "uart_boot_timeline": self.uart_boot_timeline,
             "deploy_plan": self.deploy_plan,
             "deploy_execute": self.deploy_execute,
             "pi_tpm_status": self.pi_tpm_status,
             "pi_disk_health": self.pi_disk_health,
             "pi_network_scan": self.pi_network_scan,
+            "fleet_exec": self.fleet_exec,
             "nix_diff": self.nix_diff,
         }
 
@@ -491,26 +3846,43 @@ class NixOpsServer:
                     "properties": {
                         "build": {"type": "boolean", "default": False},
                         "timeoutSeconds": {"type": "integer", "default": 600},
+                        "telemetry": {"type": "boolean", "default": True},
+                        "background": {"type": "boolean", "default": False},
                     },
                 },
             },
             {
                 "name": "list_hosts",
-                "description": "List hostnames from nixosConfigurations.",
-                "inputSchema": {"type": "object", "properties": {}},
+                "description": "List hostnames from nixosConfigurations (cached per git tree + flake.lock; refresh=true re-evaluates).",
+                "inputSchema": {"type": "object", "properties": {"refresh": {"type": "boolean", "default": False}}},
             },
             {
                 "name": "eval_host",
-                "description": "Evaluate host toplevel derivation path.",
+                "description": "Evaluate host toplevel derivation path (cached per git tree + flake.lock; refresh=true re-evaluates).",
                 "inputSchema": {
                     "type": "object",
                     "required": ["hostname"],
-                    "properties": {"hostname": {"type": "string"}},
+                    "properties": {
+                        "hostname": {"type": "string"},
+                        "refresh": {"type": "boolean", "default": False},
+                    },
+                },
+            },
+            {
+                "name": "eval_all_hosts",
+                "description": "Evaluate every nixosConfigurations toplevel drvPath in one nix eval pass; returns a name->drvPath map plus per-host errors (failing hosts are re-evaluated individually, in parallel).",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "refresh": {"type": "boolean", "default": False},
+                        "concurrency": {"type": "integer", "default": 4},
+                        "timeoutSeconds": {"type": "integer", "default": 900},
+                    },
                 },
             },
             {
                 "name": "build_host",
-                "description": "Build host toplevel derivation (dry-run default).",
+                "description": "Build host toplevel derivation (dry-run default). Returns at once with the out path when the toplevel is already built; otherwise reports which derivations are built vs fetched.",
                 "inputSchema": {
                     "type": "object",
                     "required": ["hostname"],
@@ -518,12 +3890,16 @@ class NixOpsServer:
                         "hostname": {"type": "string"},
                         "dryRun": {"type": "boolean", "default": True},
                         "timeoutSeconds": {"type": "integer", "default": 3600},
+                        "skipIfBuilt": {"type": "boolean", "default": True},
+                        "builder": {"type": "string", "default": "auto"},
+                        "telemetry": {"type": "boolean", "default": True},
+                        "background": {"type": "boolean", "default": False},
                     },
                 },
             },
             {
                 "name": "build_installer",
-                "description": "Build Pi installer image output for pix4 or pix5.",
+                "description": "Build Pi installer image output for pix4 or pix5 (skipped when already built).",
                 "inputSchema": {
                     "type": "object",
                     "required": ["variant"],
@@ -531,6 +3907,40 @@ class NixOpsServer:
                         "variant": {"type": "string", "enum": ["pix4", "pix5"]},
                         "dryRun": {"type": "boolean", "default": True},
                         "timeoutSeconds": {"type": "integer", "default": 7200},
+                        "skipIfBuilt": {"type": "boolean", "default": True},
+                        "builder": {"type": "string", "default": "auto"},
+                        "telemetry": {"type": "boolean", "default": True},
+                        "background": {"type": "boolean", "default": False},
+                    },
+                },
+            },
+            {
+                "name": "build_hosts",
+                "description": "Build several host toplevels together: one nix build per system (native first) with shared derivations built once; reports per-host status as hosts finish and the shared-derivation savings (dry-run default).",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["hostnames"],
+                    "properties": {
+                        "hostnames": {"type": "array", "items": {"type": "string"}},
+                        "dryRun": {"type": "boolean", "default": True},
+                        "maxJobs": {"type": "integer"},
+                        "cores": {"type": "integer"},
+                        "skipIfBuilt": {"type": "boolean", "default": True},
+                        "builder": {"type": "string", "default": "auto"},
+                        "telemetry": {"type": "boolean", "default": True},
+                        "timeoutSeconds": {"type": "integer", "default": 7200},
+                        "background": {"type": "boolean", "default": False},
+                    },
+                },
+            },
+            {
+                "name": "list_builders",
+                "description": "List configured remote builders with load / free store probes and measured throughput; with system, rank them as build placement would.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "system": {"type": "string"},
+                        "refresh": {"type": "boolean", "default": False},
                     },
                 },
             },
@@ -548,6 +3958,47 @@ class NixOpsServer:
                     "properties": {"output": {"type": "string"}},
                 },
             },
+            {
+                "name": "output_page",
+                "description": "Page through the full stdout/stderr of a command whose output was truncated (result has outputHandle). Negative offset counts from the end.",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["handle"],
+                    "properties": {
+                        "handle": {"type": "string"},
+                        "stream": {"type": "string", "enum": ["stdout", "stderr"], "default": "stderr"},
+                        "offset": {"type": "integer", "default": 0},
+                        "maxBytes": {"type": "integer", "default": 65536},
+                    },
+                },
+            },
+            {
+                "name": "job_status",
+                "description": "Status of one background/coalesced job (with its result once finished), or all known jobs if jobId is omitted.",
+                "inputSchema": {"type": "object", "properties": {"jobId": {"type": "string"}}},
+            },
+            {
+                "name": "job_log",
+                "description": "Read a job's combined stdout/stderr log from offset; pass nextOffset on the next call. Negative offset counts from the end.",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["jobId"],
+                    "properties": {
+                        "jobId": {"type": "string"},
+                        "offset": {"type": "integer", "default": 0},
+                        "maxBytes": {"type": "integer", "default": 65536},
+                    },
+                },
+            },
+            {
+                "name": "job_cancel",
+                "description": "Cancel a running job, killing its subprocesses (all callers sharing it see it cancelled).",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["jobId"],
+                    "properties": {"jobId": {"type": "string"}},
+                },
+            },
             {
                 "name": "pi_journal",
                 "description": "Read journal logs from an allowlisted Pi host.",
@@ -599,41 +4050,97 @@ class NixOpsServer:
             },
             {
                 "name": "pi_uart_console",
-                "description": "Discover /dev/ttyACM* and /dev/ttyUSB* serial devices and capture UART output for Pi boot debugging.",
+                "description": "Discover /dev/ttyACM* and /dev/ttyUSB* serial devices and capture UART output for Pi boot debugging. Pass devices or allDevices to capture several consoles in one window.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "device": {"type": "string"},
+                        "devices": {"type": "array", "items": {"type": "string"}},
+                        "allDevices": {"type": "boolean", "default": False},
+                        "baudRate": {"type": "integer", "default": 115200},
+                        "seconds": {"type": "integer", "default": 15},
+                        "maxBytes": {"type": "integer", "default": 16384},
+                        "send": {"type": "string"},
+                        "untilPattern": {"type": "string"},
+                        "failPattern": {"type": "string"},
+                    },
+                },
+            },
+            {
+                "name": "pi_uart_cache_query",
+                "description": "Search cached UART lines using a regex pattern, optionally limited to a time window or one capture.",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["pattern"],
+                    "properties": {
+                        "pattern": {"type": "string"},
+                        "ignoreCase": {"type": "boolean", "default": False},
+                        "maxLines": {"type": "integer", "default": 200},
+                        "device": {"type": "string"},
+                        "since": {"type": "string", "description": "ISO-8601 timestamp (UTC if no offset)"},
+                        "until": {"type": "string", "description": "ISO-8601 timestamp (UTC if no offset)"},
+                        "captureId": {"type": "integer"},
+                    },
+                },
+            },
+            {
+                "name": "pi_uart_cache_range",
+                "description": "Return cached UART lines for an inclusive line-number range.",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["startLine", "endLine"],
+                    "properties": {
+                        "startLine": {"type": "integer"},
+                        "endLine": {"type": "integer"},
+                    },
+                },
+            },
+            {
+                "name": "uart_background_start",
+                "description": "Keep a UART device (or all discovered devices) open on a background thread, buffering into a ring for uart_tail and appending lines to the UART cache.",
                 "inputSchema": {
                     "type": "object",
                     "properties": {
                         "device": {"type": "string"},
+                        "allDevices": {"type": "boolean", "default": False},
                         "baudRate": {"type": "integer", "default": 115200},
-                        "seconds": {"type": "integer", "default": 15},
-                        "maxBytes": {"type": "integer", "default": 16384},
-                        "send": {"type": "string"},
                     },
                 },
             },
             {
-                "name": "pi_uart_cache_query",
-                "description": "Search cached UART lines using a regex pattern.",
+                "name": "uart_background_stop",
+                "description": "Stop background UART capture on one device, or all devices if omitted.",
+                "inputSchema": {"type": "object", "properties": {"device": {"type": "string"}}},
+            },
+            {
+                "name": "uart_background_status",
+                "description": "List background UART captures with their current cursor and cached line counts.",
+                "inputSchema": {"type": "object", "properties": {}},
+            },
+            {
+                "name": "uart_tail",
+                "description": "Return UART bytes captured in the background since cursor (omit cursor for the latest maxBytes). Pass the returned cursor on the next call.",
                 "inputSchema": {
                     "type": "object",
-                    "required": ["pattern"],
                     "properties": {
-                        "pattern": {"type": "string"},
-                        "ignoreCase": {"type": "boolean", "default": False},
-                        "maxLines": {"type": "integer", "default": 200},
                         "device": {"type": "string"},
+                        "cursor": {"type": "integer"},
+                        "maxBytes": {"type": "integer", "default": 65536},
+                        "waitSeconds": {"type": "number", "default": 0},
                     },
                 },
             },
             {
-                "name": "pi_uart_cache_range",
-                "description": "Return cached UART lines for an inclusive line-number range.",
+                "name": "uart_boot_timeline",
+                "description": "Turn boot-chain markers (EEPROM, config.txt, UEFI, systemd-boot, kernel, initrd, LUKS unlock, switch-root, login) in cached UART captures into phase start times and durations using per-line arrival timestamps.",
                 "inputSchema": {
                     "type": "object",
-                    "required": ["startLine", "endLine"],
                     "properties": {
-                        "startLine": {"type": "integer"},
-                        "endLine": {"type": "integer"},
+                        "device": {"type": "string"},
+                        "captureId": {"type": "integer"},
+                        "last": {"type": "integer", "default": 1},
+                        "mergeGapSeconds": {"type": "number", "default": _BOOT_SESSION_GAP_SECONDS},
+                        "markers": {"type": "object", "additionalProperties": {"type": "string"}},
                     },
                 },
             },
@@ -660,6 +4167,7 @@ class NixOpsServer:
                         "mode": {"type": "string", "enum": ["test", "switch", "boot"], "default": "test"},
                         "confirmation": {"type": "string"},
                         "timeoutSeconds": {"type": "integer", "default": 1800},
+                        "background": {"type": "boolean", "default": False},
                     },
                 },
             },
@@ -683,8 +4191,32 @@ class NixOpsServer:
             },
             {
                 "name": "pi_network_scan",
-                "description": "Ping all allowlisted Pi hosts and report reachability and latency. Runs locally, no SSH needed.",
-                "inputSchema": {"type": "object", "properties": {}},
+                "description": "Probe all allowlisted Pi hosts concurrently with ICMP and TCP connects to the SSH port; reports reachability and min/avg/max/jitter latency. Runs locally, no SSH needed.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "samples": {"type": "integer", "default": DEFAULT_SCAN_SAMPLES},
+                        "timeoutSeconds": {"type": "number", "default": DEFAULT_SCAN_TIMEOUT_SECONDS},
+                        "port": {"type": "integer", "default": 22},
+                    },
+                },
+            },
+            {
+                "name": "fleet_exec",
+                "description": "Run one fixed read-only observability template (journal, dmesg, service_status, firmware_check, tpm_status, disk_health) on all or selected allowlisted hosts concurrently, returning partial results per host.",
+                "inputSchema": {
+                    "type": "object",
+                    "required": ["template"],
+                    "properties": {
+                        "template": {"type": "string", "enum": sorted(_FLEET_TEMPLATES)},
+                        "hosts": {"type": "array", "items": {"type": "string"}},
+                        "unit": {"type": "string"},
+                        "lines": {"type": "integer", "default": 200},
+                        "since": {"type": "string"},
+                        "concurrency": {"type": "integer", "default": DEFAULT_FLEET_CONCURRENCY},
+                        "timeoutSeconds": {"type": "integer"},
+                    },
+                },
             },
             {
                 "name": "nix_diff",
@@ -695,25 +4227,213 @@ class NixOpsServer:
                     "properties": {
                         "hostnameA": {"type": "string"},
                         "hostnameB": {"type": "string"},
+                        "refresh": {"type": "boolean", "default": False},
                     },
                 },
             },
         ]
 
+    def _eval(
+        self,
+        cmd: List[str],
+        expr: str,
+        *,
+        raw: bool,
+        timeout: int,
+        refresh: bool = False,
+        fingerprint: Optional[Dict[str, str]] = None,
+        warm: bool = True,
+    ) -> Dict[str, Any]:
+        """Cached eval of `expr` (the flake-scope equivalent of `cmd`), on the warm repl when possible.
+
+        `warm=False` always runs `cmd`, e.g. to re-instantiate a .drv that the
+        repl, having already forced the value, would not write again.
+        """
+
+        def run(current: Optional[Dict[str, str]]) -> Dict[str, Any]:
+            if self.evaluator is not None and warm:
+                try:
+                    result = self.evaluator.evaluate(expr, current, timeout)
+                except (_ReplUnavailable, subprocess.TimeoutExpired) as exc:
+                    _debug(f"eval: warm repl unavailable, using nix eval: {exc}")
+                else:
+                    if raw and result["exitCode"] == 0:
+                        value = json.loads(result["stdout"])
+                        result["stdout"] = value if isinstance(value, str) else result["stdout"]
+                    return {"command": cmd, "cwd": self.repo_root, **result}
+            return _run_command(cmd, cwd=self.repo_root, timeout=timeout)
+
+        return self.eval_cache.run(
+            cmd, cwd=self.repo_root, timeout=timeout, refresh=refresh, fingerprint=fingerprint, runner=run
+        )
+
+    def _run_nix_logged(
+        self,
+        cmd: List[str],
+        *,
+        timeout: int,
+        args: Dict[str, Any],
+        diagnostics: Tuple[str, ...] = ("stderr",),
+        telemetry: Optional[_BuildTelemetry] = None,
+    ) -> Dict[str, Any]:
+        """Run a nix build-type command with `--log-format internal-json` telemetry.
+
+        `telemetry: false` (or config `buildTelemetry: false`) runs the
+        command with the default log format instead. A caller that needs the
+        raw timings (or watched paths) passes its own `telemetry` recorder.
+        """
+        plan = _BuildPlan()
+        if not bool(args.get("telemetry", self.config.get("buildTelemetry", True))):
+            result = _run_command(
+                cmd, cwd=self.repo_root, timeout=timeout, stderr_filter=plan.feed, diagnostics=diagnostics
+            )
+        else:
+            recorder = telemetry or _BuildTelemetry()
+
+            def stderr_filter(line: str) -> Optional[str]:
+                text = recorder.feed(line)
+                return None if text is None else plan.feed(text)
+
+            result = _run_command(
+                [*cmd, "--log-format", "internal-json"],
+                cwd=self.repo_root,
+                timeout=timeout,
+                stderr_filter=stderr_filter,
+                diagnostics=diagnostics,
+            )
+            # Edges for the critical path only matter once builds can chain.
+            inputs = _derivation_inputs(recorder.built_paths(), self.repo_root) if len(recorder.builds) > 1 else None
+            top = int(self.config.get("buildTelemetryTop", DEFAULT_BUILD_TELEMETRY_TOP))
+            result["buildTelemetry"] = recorder.summary(top, inputs)
+        if plan.summary() is not None:
+            result["plan"] = plan.summary()
+        return result
+
+    def _placed_build(
+        self,
+        cmd: List[str],
+        system: Optional[str],
+        *,
+        timeout: int,
+        args: Dict[str, Any],
+        dry_run: bool,
+        telemetry: Optional[_BuildTelemetry] = None,
+    ) -> Dict[str, Any]:
+        """`_run_nix_logged` on the builder chosen for `system`, recording its throughput.
+
+        Dry runs build nothing and are not placed; `builder: "off"` leaves
+        placement to nix's own builder configuration, and so does a user
+        nix does not trust with `--builders` (a restricted setting). A
+        `--max-jobs` already in `cmd` is the caller's and is kept.
+        """
+        requested = args.get("builder")
+        placement = None
+        skipped = None
+        if not dry_run and system and requested != "off" and self.builders.builders:
+            if self.builders.trusted() is False:
+                skipped = "not a trusted nix user, so --builders would be ignored"
+            else:
+                placement = self.builders.place(system, None if requested in (None, "auto") else str(requested))
+        if placement is None:
+            result = self._run_nix_logged(cmd, timeout=timeout, args=args, telemetry=telemetry)
+            if skipped:
+                result["builder"] = {"skipped": skipped}
+            return result
+        nix_args = list(placement["nixArgs"])
+        if "--max-jobs" in cmd and "--max-jobs" in nix_args:
+            at = nix_args.index("--max-jobs")
+            del nix_args[at : at + 2]
+            placement["callerMaxJobs"] = True
+        placement["nixArgs"] = nix_args
+        result = self._run_nix_logged([*cmd, *nix_args], timeout=timeout, args=args, telemetry=telemetry)
+        if _NIX_RESTRICTED_BUILDERS.search(result["stderr"]):
+            # The daemon dropped --builders: stop placing, and retry a build
+            # that failed for it (nothing ran) under nix's own configuration.
+            self.builders.distrust()
+            if result["exitCode"] != 0:
+                result = self._run_nix_logged(cmd, timeout=timeout, args=args, telemetry=telemetry)
+                result["builder"] = {"skipped": "nix ignored --builders: not a trusted nix user"}
+                return result
+        built = (result.get("buildTelemetry") or {}).get("built", 0)
+        if result["exitCode"] == 0:
+            self.builders.record(placement["name"], built, result["durationSeconds"])
+        result["builder"] = placement
+        return result
+
+    def _drv_system(self, drv_cmd: List[str], drv_expr: str) -> Optional[str]:
+        evaluated = self._eval(drv_cmd, drv_expr, raw=True, timeout=240)
+        if evaluated["exitCode"] != 0:
+            return None
+        drv_path = evaluated["stdout"].strip()
+        shown = _derivation_show([drv_path], self.repo_root) or {}
+        system = shown.get(_store_basename(drv_path), {}).get("system")
+        return str(system) if system else None
+
+    def _skip_if_built(
+        self, cmd: List[str], drv_cmd: List[str], drv_expr: str, args: Dict[str, Any], *, dry_run: bool
+    ) -> Optional[Dict[str, Any]]:
+        """Result for an already realised build, or None if something must be built.
+
+        Uses the (cached) drvPath and one batched validity query over its
+        outputs, so an up-to-date toplevel costs no evaluating `nix build`.
+        A real build still gets its `./result` link, from the store paths.
+        """
+        if not bool(args.get("skipIfBuilt", self.config.get("buildSkipIfBuilt", True))):
+            return None
+        start = _utcnow()
+        evaluated = self._eval(drv_cmd, drv_expr, raw=True, timeout=240)
+        if evaluated["exitCode"] != 0:
+            # Let the build itself report the evaluation error.
+            return None
+        drv_path = evaluated["stdout"].strip()
+        status = _invalid_outputs(drv_path, self.repo_root)
+        if status is None or status[1]:
+            return None
+        out_paths = status[0]
+        if not dry_run:
+            # The `result` link `nix build <attr>` leaves for the default
+            # output, without evaluating anything. A derivation without an
+            # `out` output fails here and takes the normal build path.
+            linked = _run_command(
+                ["nix", "build", "--out-link", "result", f"{drv_path}^out"], cwd=self.repo_root, timeout=120
+            )
+            if linked["exitCode"] != 0:
+                return None
+        end = _utcnow()
+        return {
+            "command": cmd,
+            "cwd": self.repo_root,
+            "exitCode": 0,
+            "stdout": "".join(f"{path}\n" for path in out_paths),
+            "stderr": "",
+            "startedAt": start.isoformat(),
+            "finishedAt": end.isoformat(),
+            "durationSeconds": round((end - start).total_seconds(), 3),
+            "alreadyBuilt": True,
+            "drvPath": drv_path,
+            "outPaths": out_paths,
+            "evalCache": evaluated.get("evalCache"),
+            "plan": {"toBuild": [], "toFetch": [], "downloadSize": None, "unpackedSize": None},
+            "diagnostics": [],
+        }
+
     def check_flake(self, args: Dict[str, Any]) -> Dict[str, Any]:
         build = bool(args.get("build", False))
         timeout = int(args.get("timeoutSeconds", 600))
         cmd = ["nix", "flake", "check"]
         if not build:
             cmd.append("--no-build")
-        result = _run_command(cmd, cwd=self.repo_root, timeout=timeout)
-        diagnostics = _extract_diagnostics(result["stderr"] + "\n" + result["stdout"])
-        result["diagnostics"] = diagnostics
-        return result
+        return self._run_nix_logged(cmd, timeout=timeout, args=args, diagnostics=("stderr", "stdout"))
 
-    def list_hosts(self, _args: Dict[str, Any]) -> Dict[str, Any]:
+    def list_hosts(self, args: Dict[str, Any]) -> Dict[str, Any]:
         cmd = ["nix", "eval", "--json", ".#nixosConfigurations", "--apply", "builtins.attrNames"]
-        result = _run_command(cmd, cwd=self.repo_root, timeout=120)
+        result = self._eval(
+            cmd,
+            "builtins.attrNames nixosConfigurations",
+            raw=False,
+            timeout=120,
+            refresh=bool(args.get("refresh", False)),
+        )
         hosts: List[str] = []
         if result["exitCode"] == 0:
             try:
@@ -724,12 +4444,114 @@ class NixOpsServer:
 
     def eval_host(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["hostname"])
-        attr = f".#nixosConfigurations.{host}.config.system.build.toplevel.drvPath"
-        cmd = ["nix", "eval", "--raw", attr]
-        result = _run_command(cmd, cwd=self.repo_root, timeout=240)
+        result = self._eval(
+            _host_drv_cmd(host),
+            _host_drv_expr(host),
+            raw=True,
+            timeout=240,
+            refresh=bool(args.get("refresh", False)),
+        )
         result["hostname"] = host
         return result
 
+    def eval_all_hosts(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        refresh = bool(args.get("refresh", False))
+        timeout = int(args.get("timeoutSeconds", 900))
+        concurrency = int(args.get("concurrency", self.config.get("evalConcurrency", DEFAULT_EVAL_CONCURRENCY)))
+        if concurrency < 1 or concurrency > 32:
+            raise ValueError("concurrency must be between 1 and 32")
+        started = time.monotonic()
+        fingerprint = self.eval_cache.fingerprint(self.repo_root)
+
+        bulk_cmd = ["nix", "eval", "--json", ".#nixosConfigurations", "--apply", _ALL_HOSTS_APPLY]
+        bulk = self._eval(
+            bulk_cmd,
+            f"({_ALL_HOSTS_APPLY}) nixosConfigurations",
+            raw=False,
+            timeout=timeout,
+            refresh=refresh,
+            fingerprint=fingerprint,
+        )
+        drv_paths: Dict[str, str] = {}
+        failed: List[str] = []
+        mode = "bulk"
+        if bulk["exitCode"] == 0:
+            try:
+                for host, entry in json.loads(bulk["stdout"]).items():
+                    if "drvPath" in entry:
+                        drv_paths[host] = entry["drvPath"]
+                    else:
+                        failed.append(host)
+            except (json.JSONDecodeError, AttributeError, TypeError):
+                bulk["exitCode"] = -1
+            if fingerprint is not None and not bulk["evalCache"].get("hit"):
+                # Seed eval_host's cache entries from the batch.
+                cached_at = _utcnow().isoformat()
+                self.eval_cache.put_many(
+                    {
+                        self.eval_cache.key(fingerprint, _host_drv_cmd(host)): {
+                            "stdout": drv_path,
+                            "cachedAt": cached_at,
+                            "command": _host_drv_cmd(host),
+                        }
+                        for host, drv_path in drv_paths.items()
+                    }
+                )
+        if bulk["exitCode"] != 0:
+            # An error tryEval cannot catch took the batch down; find out which
+            # hosts are affected one by one.
+            mode = "per-host"
+            names = self.list_hosts({"refresh": refresh})
+            if not names["hosts"]:
+                return {
+                    "error": "Bulk evaluation failed and host names could not be listed.",
+                    "bulk": bulk,
+                    "diagnostics": _extract_diagnostics(bulk["stderr"]),
+                }
+            failed = list(names["hosts"])
+        elif failed:
+            mode = "bulk+per-host"
+
+        errors: Dict[str, Any] = {}
+        if failed:
+            # Per-host evals report the real error message for each failure.
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(failed)), thread_name_prefix="nix-ops-eval") as pool:
+                futures = {
+                    host: pool.submit(
+                        contextvars.copy_context().run,
+                        self._eval,
+                        _host_drv_cmd(host),
+                        _host_drv_expr(host),
+                        raw=True,
+                        timeout=timeout,
+                        refresh=refresh,
+                        fingerprint=fingerprint,
+                    )
+                    for host in failed
+                }
+            for host, future in futures.items():
+                try:
+                    result = future.result()
+                except subprocess.TimeoutExpired:
+                    errors[host] = {"message": f"evaluation timed out after {timeout}s"}
+                    continue
+                if result["exitCode"] == 0:
+                    drv_paths[host] = result["stdout"].strip()
+                else:
+                    diagnostics = _extract_diagnostics(result["stderr"])
+                    errors[host] = {
+                        "message": diagnostics[0]["message"] if diagnostics else result["stderr"].strip()[-500:],
+                        "diagnostics": diagnostics,
+                    }
+
+        return {
+            "hosts": dict(sorted(drv_paths.items())),
+            "errors": errors,
+            "mode": mode,
+            "evalCache": bulk.get("evalCache"),
+            "durationSeconds": round(time.monotonic() - started, 3),
+        }
+
     def build_host(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["hostname"])
         dry_run = bool(args.get("dryRun", True))
@@ -738,29 +4560,227 @@ class NixOpsServer:
         cmd = ["nix", "build", attr]
         if dry_run:
             cmd.append("--dry-run")
-        result = _run_command(cmd, cwd=self.repo_root, timeout=timeout)
+        result = self._skip_if_built(cmd, _host_drv_cmd(host), _host_drv_expr(host), args, dry_run=dry_run)
+        if result is None:
+            placing = not dry_run and self.builders.builders and args.get("builder") != "off"
+            system = self._drv_system(_host_drv_cmd(host), _host_drv_expr(host)) if placing else None
+            result = self._placed_build(cmd, system, timeout=timeout, args=args, dry_run=dry_run)
         result["hostname"] = host
         result["dryRun"] = dry_run
-        result["diagnostics"] = _extract_diagnostics(result["stderr"])
         return result
 
     def build_installer(self, args: Dict[str, Any]) -> Dict[str, Any]:
         variant = str(args["variant"])
         dry_run = bool(args.get("dryRun", True))
         timeout = int(args.get("timeoutSeconds", 7200))
-        attr_map = {
-            "pix4": ".#packages.aarch64-linux.createInstallSD-pix4",
-            "pix5": ".#packages.aarch64-linux.createInstallSD-pix5",
-        }
-        cmd = ["nix", "build", attr_map[variant]]
+        attr = _installer_attr(variant)
+        cmd = ["nix", "build", attr]
         if dry_run:
             cmd.append("--dry-run")
-        result = _run_command(cmd, cwd=self.repo_root, timeout=timeout)
+        drv_cmd = ["nix", "eval", "--raw", f"{attr}.drvPath"]
+        result = self._skip_if_built(cmd, drv_cmd, _installer_drv_expr(variant), args, dry_run=dry_run)
+        if result is None:
+            system = _INSTALLER_PACKAGES[variant][0]
+            result = self._placed_build(cmd, system, timeout=timeout, args=args, dry_run=dry_run)
         result["variant"] = variant
         result["dryRun"] = dry_run
-        result["diagnostics"] = _extract_diagnostics(result["stderr"])
         return result
 
+    def build_hosts(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        hosts = [str(host) for host in args.get("hostnames") or []]
+        if not hosts:
+            raise ValueError("hostnames must name at least one host")
+        dry_run = bool(args.get("dryRun", True))
+        deadline = time.monotonic() + int(args.get("timeoutSeconds", 7200))
+        skip_built = bool(args.get("skipIfBuilt", self.config.get("buildSkipIfBuilt", True)))
+        concurrency = int(self.config.get("evalConcurrency", DEFAULT_EVAL_CONCURRENCY))
+        started = time.monotonic()
+        fingerprint = self.eval_cache.fingerprint(self.repo_root)
+        report: Dict[str, Dict[str, Any]] = {host: {} for host in hosts}
+
+        # drvPaths (cache hits after eval_all_hosts), then output validity,
+        # both fanned out over the eval pool.
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(hosts)), thread_name_prefix="nix-ops-eval") as pool:
+            evals = {
+                host: pool.submit(
+                    contextvars.copy_context().run,
+                    self._eval,
+                    _host_drv_cmd(host),
+                    _host_drv_expr(host),
+                    raw=True,
+                    timeout=240,
+                    fingerprint=fingerprint,
+                )
+                for host in hosts
+            }
+            drv_paths: Dict[str, str] = {}
+            for host, future in evals.items():
+                try:
+                    evaluated = future.result()
+                except subprocess.TimeoutExpired:
+                    # One hung eval must not cost the other hosts their results.
+                    report[host] = {"status": "evalTimeout", "message": "evaluation timed out after 240s"}
+                    continue
+                if evaluated["exitCode"] != 0:
+                    report[host] = {"status": "evalFailed", "diagnostics": _extract_diagnostics(evaluated["stderr"])}
+                else:
+                    drv_paths[host] = evaluated["stdout"].strip()
+                    report[host]["drvPath"] = drv_paths[host]
+            validity = {host: pool.submit(_invalid_outputs, drv, self.repo_root) for host, drv in drv_paths.items()}
+            # A cached drvPath whose .drv was garbage-collected would sink the
+            # whole batch (derivation show, `^*` installables): evaluate those
+            # hosts again so the .drv is written back.
+            stale = [host for host, future in validity.items() if future.result() is None]
+            reevals = {
+                host: pool.submit(
+                    contextvars.copy_context().run,
+                    self._eval,
+                    _host_drv_cmd(host),
+                    _host_drv_expr(host),
+                    raw=True,
+                    timeout=240,
+                    refresh=True,
+                    fingerprint=fingerprint,
+                    warm=False,
+                )
+                for host in stale
+            }
+            for host, future in reevals.items():
+                try:
+                    evaluated = future.result()
+                except subprocess.TimeoutExpired:
+                    report[host] = {"status": "evalTimeout", "message": "evaluation timed out after 240s"}
+                    del drv_paths[host]
+                    del validity[host]
+                    continue
+                if evaluated["exitCode"] != 0:
+                    report[host] = {"status": "evalFailed", "diagnostics": _extract_diagnostics(evaluated["stderr"])}
+                    del drv_paths[host]
+                    del validity[host]
+                    continue
+                drv_paths[host] = evaluated["stdout"].strip()
+                report[host]["drvPath"] = drv_paths[host]
+                validity[host] = pool.submit(_invalid_outputs, drv_paths[host], self.repo_root)
+            outputs: Dict[str, List[str]] = {}
+            for host, future in validity.items():
+                status = future.result()
+                if status is None:
+                    report[host] = {"status": "evalFailed", "error": f"{drv_paths[host]} is not in the store"}
+                    del drv_paths[host]
+                    continue
+                outputs[host] = status[0]
+                if skip_built and not status[1]:
+                    report[host].update(status="alreadyBuilt", outPaths=status[0])
+                    del drv_paths[host]
+
+        # One nix build per system, native first, so local hosts finish
+        # while aarch64 work queues on builders or emulation.
+        shown = _derivation_show(list(drv_paths.values()), self.repo_root) or {}
+        groups: Dict[str, List[str]] = {}
+        for host, drv in drv_paths.items():
+            system = str(shown.get(_store_basename(drv), {}).get("system", "unknown"))
+            report[host]["system"] = system
+            groups.setdefault(system, []).append(host)
+        native = _native_system()
+        group_results: List[Dict[str, Any]] = []
+        shared_total = {"perHost": 0, "unique": 0, "saved": 0, "savedSeconds": 0.0}
+        shared_top: List[Dict[str, Any]] = []
+        for system in sorted(groups, key=lambda name: (name != native, name)):
+            group = groups[system]
+            cmd = ["nix", "build", "--no-link", "--keep-going", *(f"{drv_paths[host]}^*" for host in group)]
+            if args.get("maxJobs") is not None:
+                cmd += ["--max-jobs", str(int(args["maxJobs"]))]
+            if args.get("cores") is not None:
+                cmd += ["--cores", str(int(args["cores"]))]
+            if dry_run:
+                cmd.append("--dry-run")
+            watch = {drv_paths[host]: host for host in group}
+            watch.update({path: host for host in group for path in outputs.get(host, [])})
+            telemetry = _BuildTelemetry(watch)
+            remaining = max(1, int(deadline - time.monotonic()))
+            result = self._placed_build(
+                cmd, system, timeout=remaining, args=args, dry_run=dry_run, telemetry=telemetry
+            )
+            result["system"] = system
+            result["hosts"] = group
+            group_results.append(result)
+
+            planned = {_store_basename(drv) for drv in (result.get("plan") or {}).get("toBuild", [])}
+            if planned:
+                shared = self._shared_builds(group, drv_paths, planned, telemetry)
+                for host in group:
+                    report[host]["toBuild"] = shared["perHost"].get(host, 0)
+                for key in ("unique", "saved", "savedSeconds"):
+                    shared_total[key] += shared[key]
+                shared_total["perHost"] += sum(shared["perHost"].values())
+                shared_top.extend(shared["top"])
+
+            if dry_run:
+                for host in group:
+                    report[host]["status"] = "planned"
+                continue
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(group)), thread_name_prefix="nix-ops-eval") as pool:
+                checks = {host: pool.submit(_invalid_outputs, drv_paths[host], self.repo_root) for host in group}
+            for host, future in checks.items():
+                status = future.result()
+                if status is not None and not status[1]:
+                    report[host].update(status="built", outPaths=status[0])
+                else:
+                    report[host]["status"] = "failed"
+
+        shared_total["savedSeconds"] = round(shared_total["savedSeconds"], 3)
+        shared_top.sort(key=lambda item: len(item["hosts"]), reverse=True)
+        return {
+            "hosts": report,
+            "dryRun": dry_run,
+            "groups": group_results,
+            "sharedDerivations": {**shared_total, "top": shared_top[:DEFAULT_BUILD_TELEMETRY_TOP]},
+            "exitCode": 0 if all(item.get("status") in ("alreadyBuilt", "built", "planned") for item in report.values()) else 1,
+            "durationSeconds": round(time.monotonic() - started, 3),
+        }
+
+    def _shared_builds(
+        self, group: List[str], drv_paths: Dict[str, str], planned: Set[str], telemetry: _BuildTelemetry
+    ) -> Dict[str, Any]:
+        """How much of one build group's work is shared between its hosts.
+
+        Each host's share of the plan is its derivation closure intersected
+        with the planned builds; `saved` is what separate per-host builds
+        would have built on top of the single combined build.
+        """
+        with ThreadPoolExecutor(max_workers=min(4, len(group)), thread_name_prefix="nix-ops-eval") as pool:
+            closures = {host: pool.submit(_derivation_closure, drv_paths[host], self.repo_root) for host in group}
+        needed_by: Dict[str, List[str]] = {}
+        per_host: Dict[str, int] = {}
+        for host, future in closures.items():
+            closure = future.result() or []
+            needs = [drv for drv in closure if drv in planned]
+            per_host[host] = len(needs)
+            for drv in needs:
+                needed_by.setdefault(drv, []).append(host)
+        seconds = {_store_basename(b["drvPath"]): b["stopped"] - b["started"] for b in telemetry.builds}
+        shared = {drv: users for drv, users in needed_by.items() if len(users) > 1}
+        return {
+            "perHost": per_host,
+            "unique": len(needed_by),
+            "saved": sum(len(users) - 1 for users in shared.values()),
+            "savedSeconds": sum(seconds.get(drv, 0.0) * (len(users) - 1) for drv, users in shared.items()),
+            "top": [
+                {"name": _store_name(drv), "hosts": users, "seconds": round(seconds[drv], 3) if drv in seconds else None}
+                for drv, users in sorted(shared.items(), key=lambda item: len(item[1]), reverse=True)[
+                    :DEFAULT_BUILD_TELEMETRY_TOP
+                ]
+            ],
+        }
+
+    def list_builders(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        refresh = bool(args.get("refresh", False))
+        system = args.get("system")
+        output: Dict[str, Any] = {"builders": self.builders.describe(refresh), "statsPath": str(self.builders.path)}
+        if system:
+            output["ranking"] = self.builders.candidates(str(system))
+        return output
+
     def format_check(self, _args: Dict[str, Any]) -> Dict[str, Any]:
         cmd = ["nix", "run", "nixpkgs#nixpkgs-fmt", "--", "--check", "."]
         result = _run_command(cmd, cwd=self.repo_root, timeout=240)
@@ -770,91 +4790,71 @@ class NixOpsServer:
         output = str(args["output"])
         return {"diagnostics": _extract_diagnostics(output)}
 
+    def output_page(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        max_bytes = int(args.get("maxBytes", 65536))
+        if max_bytes < 1 or max_bytes > 1024 * 1024:
+            raise ValueError("maxBytes must be between 1 and 1048576")
+        return _OUTPUT_SPOOL.page(
+            str(args["handle"]),
+            str(args.get("stream", "stderr")),
+            int(args.get("offset", 0)),
+            max_bytes,
+        )
+
     def pi_journal(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
-        lines = int(args.get("lines", 200))
         unit = args.get("unit")
-        since = args.get("since")
-        cmd_parts = ["journalctl", "--no-pager", "-n", str(lines)]
-        if unit:
-            cmd_parts += ["-u", str(unit)]
-        if since:
-            cmd_parts += ["--since", str(since)]
-        remote_cmd = " ".join(cmd_parts)
-        result = _run_ssh(host, remote_cmd, self.config, timeout=90)
+        result = _run_ssh(host, _journal_cmd(args), self.config, timeout=90)
         _append_audit({"tool": "pi_journal", "host": host, "unit": unit}, self.config)
         return result
 
     def pi_dmesg(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
         lines = int(args.get("lines", 200))
-        remote_cmd = f"dmesg --color=never | tail -n {lines}"
-        result = _run_ssh(host, remote_cmd, self.config, timeout=90)
+        result = _run_ssh(host, _dmesg_cmd(args), self.config, timeout=90)
         _append_audit({"tool": "pi_dmesg", "host": host, "lines": lines}, self.config)
         return result
 
     def pi_service_status(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
         unit = str(args["unit"])
-        remote_cmd = f"systemctl status {unit} --no-pager -l"
-        result = _run_ssh(host, remote_cmd, self.config, timeout=90)
+        result = _run_ssh(host, _service_status_cmd(args), self.config, timeout=90)
         _append_audit({"tool": "pi_service_status", "host": host, "unit": unit}, self.config)
         return result
 
     def pi_firmware_check(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
-        script = (
-            "echo '=== FIRMWARE FILES ===' && "
-            "ls -lhA /boot/firmware/ 2>/dev/null || echo '/boot/firmware not mounted' && "
-            "echo && echo '=== OVERLAYS ===' && "
-            "ls /boot/firmware/overlays/ 2>/dev/null | head -20 || echo 'no overlays dir' && "
-            "echo && echo '=== CONFIG.TXT ===' && "
-            "cat /boot/firmware/config.txt 2>/dev/null || echo 'no config.txt' && "
-            "echo && echo '=== BOOT MODE ===' && "
-            "if [ -f /boot/firmware/RPI_EFI.fd ]; then echo 'UEFI firmware present'; "
-            "else echo 'No UEFI firmware (classic boot)'; fi && "
-            "echo && echo '=== ESP FILES ===' && "
-            "ls -lhA /boot/ 2>/dev/null | head -20 || echo '/boot not mounted' && "
-            "echo && echo '=== BOOTCTL ===' && "
-            "bootctl status --no-pager 2>/dev/null || echo 'bootctl not available or not UEFI boot'"
-        )
-        result = _run_ssh(host, script, self.config, timeout=30)
+        result = _run_ssh(host, _FIRMWARE_CHECK_SCRIPT, self.config, timeout=30)
         _append_audit({"tool": "pi_firmware_check", "host": host}, self.config)
-
-        summary: Dict[str, Any] = {"host": host}
-        stdout = result.get("stdout", "")
-        summary["hasUefiFirmware"] = "UEFI firmware present" in stdout
-        summary["hasConfigTxt"] = "no config.txt" not in stdout
-        if "kernel=RPI_EFI.fd" in stdout:
-            summary["bootMode"] = "uefi"
-        elif "kernel=kernel.img" in stdout:
-            summary["bootMode"] = "classic-kernel"
-        else:
-            summary["bootMode"] = "unknown"
-
-        result["summary"] = summary
+        result["summary"] = _firmware_summary(host, result.get("stdout", ""))
         return result
 
-    def pi_uart_console(self, args: Dict[str, Any]) -> Dict[str, Any]:
+    def _select_uart_device(self, requested: Any) -> Tuple[Optional[str], List[str], Optional[Dict[str, Any]]]:
+        """Resolve the device argument against discovery: (device, discovered, error payload)."""
         discovered = _discover_uart_ttys()
         if not discovered:
-            return {
+            return None, [], {
                 "error": "No matching UART devices found.",
                 "searchedPatterns": ["/dev/ttyACM*", "/dev/ttyUSB*"],
                 "discovered": [],
             }
-
-        requested = args.get("device")
         if requested:
             device = str(requested)
             if device not in discovered:
-                return {
+                return None, discovered, {
                     "error": "Requested device not found in discovered UART devices.",
                     "requestedDevice": device,
                     "discovered": discovered,
                 }
-        else:
-            device = discovered[0]
+            return device, discovered, None
+        return discovered[0], discovered, None
+
+    def pi_uart_console(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        if args.get("devices") or bool(args.get("allDevices", False)):
+            return self._pi_uart_console_multi(args)
+        device, discovered, error = self._select_uart_device(args.get("device"))
+        if error is not None:
+            return error
 
         baud_rate = int(args.get("baudRate", 115200))
         seconds = int(args.get("seconds", 15))
@@ -863,25 +4863,51 @@ class NixOpsServer:
         if send_data is not None:
             send_data = str(send_data)
 
+        until_pattern = args.get("untilPattern")
+        fail_pattern = args.get("failPattern")
+
+        background = self.uart_background.get(device)
+        if background is not None:
+            # The TTY is already open on a background thread; a second reader
+            # would steal its bytes, so watch the ring instead.
+            result = self._console_from_background(
+                background,
+                seconds=seconds,
+                max_bytes=max_bytes,
+                send_data=send_data,
+                until_pattern=until_pattern,
+                fail_pattern=fail_pattern,
+            )
+            result["discovered"] = discovered
+            _append_audit(
+                {"tool": "pi_uart_console", "device": device, "source": "background", "bytesRead": result["bytesRead"]},
+                self.config,
+            )
+            return result
+
         result = _capture_uart(
             device,
             baud_rate=baud_rate,
             seconds=seconds,
             max_bytes=max_bytes,
             send_data=send_data,
+            until_pattern=until_pattern,
+            fail_pattern=fail_pattern,
         )
         result["discovered"] = discovered
         cached_lines = _append_uart_cache_capture(
+            self.uart_cache,
             device=device,
             baud_rate=baud_rate,
             seconds=seconds,
             max_bytes=max_bytes,
             bytes_read=int(result.get("bytesRead", 0)),
             stdout_text=str(result.get("stdout", "")),
-            config=self.config,
+            started_at=result.get("startedAt"),
+            line_ms=result.pop("lineOffsetsMs", None),
         )
         result["cachedLines"] = cached_lines
-        result["uartCachePath"] = str(_uart_cache_path(self.config))
+        result["uartCachePath"] = str(self.uart_cache.root)
         _append_audit(
             {
                 "tool": "pi_uart_console",
@@ -894,6 +4920,301 @@ class NixOpsServer:
         )
         return result
 
+    def _pi_uart_console_multi(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        discovered = _discover_uart_ttys()
+        if bool(args.get("allDevices", False)):
+            requested = discovered
+        else:
+            requested = [str(d) for d in args.get("devices") or []]
+        if not requested:
+            return {"error": "No matching UART devices found.", "discovered": discovered}
+        unknown = [d for d in requested if d not in discovered]
+        if unknown:
+            return {
+                "error": "Requested devices not found in discovered UART devices.",
+                "requestedDevices": unknown,
+                "discovered": discovered,
+            }
+
+        baud_rate = int(args.get("baudRate", 115200))
+        seconds = int(args.get("seconds", 15))
+        max_bytes = int(args.get("maxBytes", 16384))
+        send_data = args.get("send")
+        if send_data is not None:
+            send_data = str(send_data)
+
+        # Devices owned by a background capture are watched through its ring,
+        # alongside the direct captures; a second reader on the same TTY
+        # would split the byte stream between the two.
+        backgrounds = {d: self.uart_background.get(d) for d in requested}
+        busy = [d for d in requested if backgrounds[d] is not None]
+        devices = [d for d in requested if d not in busy]
+        watchers = ThreadPoolExecutor(max_workers=max(1, len(busy)), thread_name_prefix="nix-ops-uart")
+        watched = {
+            device: watchers.submit(
+                self._console_from_background,
+                backgrounds[device],
+                seconds=seconds,
+                max_bytes=max_bytes,
+                send_data=send_data,
+                until_pattern=args.get("untilPattern"),
+                fail_pattern=args.get("failPattern"),
+            )
+            for device in busy
+        }
+        watchers.shutdown(wait=False)
+        captures = _capture_uart_multi(
+            devices,
+            baud_rate=baud_rate,
+            seconds=seconds,
+            max_bytes=max_bytes,
+            send_data=send_data,
+            until_pattern=args.get("untilPattern"),
+            fail_pattern=args.get("failPattern"),
+        ) if devices else {}
+        for device, result in captures.items():
+            if result["bytesRead"] or "error" not in result:
+                result["cachedLines"] = _append_uart_cache_capture(
+                    self.uart_cache,
+                    device=device,
+                    baud_rate=baud_rate,
+                    seconds=seconds,
+                    max_bytes=max_bytes,
+                    bytes_read=int(result.get("bytesRead", 0)),
+                    stdout_text=str(result.get("stdout", "")),
+                    started_at=result.get("startedAt"),
+                    line_ms=result.pop("lineOffsetsMs", None),
+                )
+            result.pop("lineOffsetsMs", None)
+        for device, future in watched.items():
+            try:
+                captures[device] = future.result()
+            except ValueError as exc:
+                captures[device] = {"device": device, "source": "background", "error": str(exc)}
+        _append_audit(
+            {
+                "tool": "pi_uart_console",
+                "devices": requested,
+                "background": busy,
+                "baudRate": baud_rate,
+                "seconds": seconds,
+                "bytesRead": {d: r.get("bytesRead", 0) for d, r in captures.items()},
+            },
+            self.config,
+        )
+        return {
+            "captures": [captures[d] for d in requested],
+            "discovered": discovered,
+            "uartCachePath": str(self.uart_cache.root),
+        }
+
+    def _console_from_background(
+        self,
+        background: _UartBackgroundCapture,
+        *,
+        seconds: int,
+        max_bytes: int,
+        send_data: Optional[str],
+        until_pattern: Optional[str] = None,
+        fail_pattern: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if seconds < 1 or seconds > 120:
+            raise ValueError("seconds must be between 1 and 120")
+        if max_bytes < 256 or max_bytes > 262144:
+            raise ValueError("maxBytes must be between 256 and 262144")
+        until = _UartTrigger.compile(until_pattern, "untilPattern")
+        fail = _UartTrigger.compile(fail_pattern, "failPattern")
+        trigger = _UartTrigger(until, fail, DEFAULT_UART_TRIGGER_CARRY_CHARS) if until or fail else None
+        fired: Optional[Dict[str, Any]] = None
+        started = time.monotonic()
+        cursor = background.ring.end
+        if send_data:
+            background.send(send_data)
+        deadline = time.monotonic() + seconds
+        chunks: List[bytes] = []
+        total = 0
+        dropped = 0
+        while total < max_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            chunk = background.ring.read(cursor, max_bytes - total, wait=remaining)
+            cursor = chunk["cursor"]
+            dropped += chunk["droppedBytes"]
+            if chunk["data"]:
+                chunks.append(chunk["data"])
+                total += len(chunk["data"])
+                if trigger is not None:
+                    fired = trigger.feed(chunk["data"])
+                    if fired is not None:
+                        fired["elapsedSeconds"] = round(time.monotonic() - started, 3)
+                        break
+        combined = b"".join(chunks)
+        result = {
+            "device": background.device,
+            "baudRate": background.baud_rate,
+            "seconds": seconds,
+            "maxBytes": max_bytes,
+            "bytesRead": len(combined),
+            "stdout": combined.decode("utf-8", errors="replace"),
+            "hexPreview": combined[:256].hex(),
+            "source": "background",
+            "cursor": cursor,
+            "droppedBytes": dropped,
+            "cachedLines": 0,
+            "note": "Background capture already writes this device to the UART cache.",
+        }
+        if trigger is not None:
+            result["trigger"] = fired
+        return result
+
+    def uart_background_start(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        baud_rate = int(args.get("baudRate", 115200))
+        if bool(args.get("allDevices", False)):
+            devices = _discover_uart_ttys()
+            if not devices:
+                return {"error": "No matching UART devices found.", "discovered": []}
+        else:
+            device, _discovered, error = self._select_uart_device(args.get("device"))
+            if error is not None:
+                return error
+            devices = [device]
+        started: List[Dict[str, Any]] = []
+        failed: Dict[str, str] = {}
+        for device in devices:
+            try:
+                capture, created = self.uart_background.start(device, baud_rate)
+            except OSError as exc:
+                failed[device] = str(exc)
+                continue
+            started.append({**capture.status(), "alreadyRunning": not created})
+        _append_audit({"tool": "uart_background_start", "devices": devices, "baudRate": baud_rate}, self.config)
+        return {"captures": started, "failed": failed}
+
+    def uart_background_stop(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        device = args.get("device")
+        stopped = self.uart_background.stop(str(device) if device else None)
+        _append_audit({"tool": "uart_background_stop", "device": device}, self.config)
+        return {"stopped": stopped}
+
+    def uart_background_status(self, _args: Dict[str, Any]) -> Dict[str, Any]:
+        return {"captures": self.uart_background.status(), "discovered": _discover_uart_ttys()}
+
+    def uart_tail(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        max_bytes = int(args.get("maxBytes", 65536))
+        if max_bytes < 1 or max_bytes > 1024 * 1024:
+            raise ValueError("maxBytes must be between 1 and 1048576")
+        wait_seconds = float(args.get("waitSeconds", 0))
+        if wait_seconds < 0 or wait_seconds > 60:
+            raise ValueError("waitSeconds must be between 0 and 60")
+        requested = args.get("device")
+        running = [c["device"] for c in self.uart_background.status() if c["running"]]
+        if requested:
+            device = str(requested)
+        elif len(running) == 1:
+            device = running[0]
+        else:
+            return {"error": "Specify device; background captures running: " + (", ".join(running) or "none"), "running": running}
+        capture = self.uart_background.get(device)
+        if capture is None:
+            return {"error": f"No background capture running on {device}. Start one with uart_background_start.", "running": running}
+        cursor = args.get("cursor")
+        chunk = capture.ring.read(int(cursor) if cursor is not None else None, max_bytes, wait=wait_seconds)
+        return {
+            "device": device,
+            "cursor": chunk["cursor"],
+            "bytes": len(chunk["data"]),
+            "data": chunk["data"].decode("utf-8", errors="replace"),
+            "droppedBytes": chunk["droppedBytes"],
+            "ringStart": chunk["ringStart"],
+            "ringEnd": chunk["ringEnd"],
+        }
+
+    def uart_boot_timeline(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        last = int(args.get("last", 1))
+        if last < 1 or last > 50:
+            raise ValueError("last must be between 1 and 50")
+        device = args.get("device")
+        markers: List[Tuple[str, re.Pattern]] = []
+        custom = args.get("markers")
+        for phase, pattern in (custom.items() if isinstance(custom, dict) else _BOOT_TIMELINE_MARKERS):
+            try:
+                markers.append((str(phase), re.compile(str(pattern))))
+            except re.error as exc:
+                raise ValueError(f"Invalid marker regex for {phase}: {exc}") from exc
+
+        gap_seconds = float(args.get("mergeGapSeconds", _BOOT_SESSION_GAP_SECONDS))
+        if gap_seconds < 0 or gap_seconds > 3600:
+            raise ValueError("mergeGapSeconds must be between 0 and 3600")
+
+        entries = self.uart_cache.capture_entries(str(device) if device else None)
+        # Only captures with per-line arrival times can be timed; consecutive
+        # ones of a device are merged so a boot split across background
+        # flushes is timed as one stream.
+        sessions = _boot_sessions([e for e in entries if e.get("lineMs") and not e.get("emptyCapture")], gap_seconds)
+        capture_id: Optional[int] = None
+        if args.get("captureId") is not None:
+            capture_id = int(args["captureId"])
+            sessions = [s for s in sessions if any(e["captureId"] == capture_id for e in s)]
+            if not sessions:
+                sessions = [[e for e in entries if e["captureId"] == capture_id]]
+                if not sessions[0]:
+                    return {"error": f"Capture {capture_id} not found in the UART cache."}
+        else:
+            sessions = sessions[-last:]
+
+        timelines: List[Dict[str, Any]] = []
+        for session in sessions:
+            origin = _cache_ts(session[0].get("startedAt"))
+            records: List[Dict[str, Any]] = []
+            for entry in session:
+                started = _cache_ts(entry.get("startedAt"))
+                # Rebase each entry's offsets onto the session's first capture.
+                shift = int(round((started - origin).total_seconds() * 1000)) if started and origin else 0
+                first = entry["firstLine"]
+                for line_number, record, entry_id in self.uart_cache.iter_range(first, first + entry["lineCount"] - 1):
+                    if record.get("offsetMs") is not None:
+                        record["offsetMs"] += shift
+                    records.append({**record, "lineNumber": line_number, "captureId": entry_id})
+            boots = _split_boots(records, markers[0][1] if markers else None)
+            for boot in boots:
+                base = boot[0].get("offsetMs")
+                if base:
+                    boot = [
+                        {**r, "offsetMs": r["offsetMs"] - base} if r.get("offsetMs") is not None else r for r in boot
+                    ]
+                timeline = _boot_timeline(boot, markers)
+                if not timeline["phases"] and len(boots) > 1:
+                    # Tail of a previous boot (shutdown chatter) before the reboot.
+                    continue
+                capture_ids = sorted({r["captureId"] for r in boot})
+                timeline.update(
+                    {
+                        "captureId": capture_ids[0],
+                        "captureIds": capture_ids,
+                        "device": session[0].get("device"),
+                        "startedAt": boot[0].get("lineTs", session[0].get("startedAt", session[0].get("ts"))),
+                        "timed": bool(session[0].get("lineMs")),
+                    }
+                )
+                timelines.append(timeline)
+        if capture_id is None:
+            timelines = timelines[-last:]
+
+        result: Dict[str, Any] = {"timelines": timelines, "markers": {p: m.pattern for p, m in markers}}
+        if len(timelines) > 1:
+            # Per-phase spread across captures, to spot boot-latency regressions.
+            spread: Dict[str, List[int]] = {}
+            for timeline in timelines:
+                for phase in timeline["phases"]:
+                    if phase["durationMs"] is not None:
+                        spread.setdefault(phase["phase"], []).append(phase["durationMs"])
+            result["phaseStats"] = {
+                phase: {"min": min(v), "avg": round(sum(v) / len(v), 1), "max": max(v), "latest": v[-1], "samples": len(v)}
+                for phase, v in spread.items()
+            }
+        return result
+
     def pi_uart_cache_query(self, args: Dict[str, Any]) -> Dict[str, Any]:
         pattern = str(args["pattern"])
         ignore_case = bool(args.get("ignoreCase", False))
@@ -909,33 +5230,45 @@ class NixOpsServer:
         except re.error as exc:
             raise ValueError(f"Invalid regex pattern: {exc}") from exc
 
-        entries = _read_uart_cache_entries(self.config)
+        since = _parse_ts(args["since"]) if args.get("since") else None
+        until = _parse_ts(args["until"]) if args.get("until") else None
+        capture_id = int(args["captureId"]) if args.get("captureId") is not None else None
+
+        stats: Dict[str, Any] = {}
         matches: List[Dict[str, Any]] = []
-        for idx, entry in enumerate(entries, start=1):
-            line = str(entry.get("line", ""))
-            entry_device = str(entry.get("device", ""))
-            if device_filter and entry_device != device_filter:
-                continue
-            if matcher.search(line):
-                matches.append(
-                    {
-                        "lineNumber": idx,
-                        "ts": entry.get("ts"),
-                        "device": entry_device,
-                        "baudRate": entry.get("baudRate"),
-                        "line": line,
-                    }
-                )
-                if len(matches) >= max_lines:
-                    break
+        for idx, entry, cap_id in self.uart_cache.search(
+            matcher,
+            device=device_filter,
+            since=since,
+            until=until,
+            capture_id=capture_id,
+            stats=stats,
+        ):
+            matches.append(
+                {
+                    "lineNumber": idx,
+                    "captureId": cap_id,
+                    "ts": entry.get("ts"),
+                    "device": entry.get("device", ""),
+                    "baudRate": entry.get("baudRate"),
+                    "line": str(entry.get("line", "")),
+                }
+            )
+            if len(matches) >= max_lines:
+                break
 
         return {
-            "cachePath": str(_uart_cache_path(self.config)),
+            "cachePath": str(self.uart_cache.root),
             "pattern": pattern,
             "ignoreCase": ignore_case,
             "device": device_filter,
-            "totalCacheLines": len(entries),
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+            "captureId": capture_id,
+            "totalCacheLines": self.uart_cache.total_lines(),
             "matchesReturned": len(matches),
+            "truncated": len(matches) >= max_lines,
+            "scan": stats,
             "matches": matches,
         }
 
@@ -949,23 +5282,40 @@ class NixOpsServer:
         if end_line - start_line > 5000:
             raise ValueError("Requested range is too large (max 5000 lines)")
 
-        entries = _read_uart_cache_entries(self.config)
-        total = len(entries)
+        total = self.uart_cache.total_lines()
         if total == 0:
             return {
-                "cachePath": str(_uart_cache_path(self.config)),
+                "cachePath": str(self.uart_cache.root),
                 "totalCacheLines": 0,
                 "lines": [],
             }
 
-        start_idx = min(start_line, total)
-        end_idx = min(end_line, total)
-        sliced = entries[start_idx - 1 : end_idx]
+        # Retention may have dropped the oldest segments; numbering is stable,
+        # so the cache simply starts at a later line.
+        first_available = self.uart_cache.first_line()
+        last_available = first_available + total - 1
+        if end_line < first_available:
+            return {
+                "cachePath": str(self.uart_cache.root),
+                "error": (
+                    f"Lines {start_line}-{end_line} expired by cache retention; "
+                    f"the cache now starts at line {first_available}."
+                ),
+                "expired": True,
+                "requestedStartLine": start_line,
+                "requestedEndLine": end_line,
+                "firstAvailableLine": first_available,
+                "totalCacheLines": total,
+                "lines": [],
+            }
+        start_idx = min(max(start_line, first_available), last_available)
+        end_idx = min(end_line, last_available)
         lines: List[Dict[str, Any]] = []
-        for idx, entry in enumerate(sliced, start=start_idx):
+        for idx, entry, cap_id in self.uart_cache.iter_range(start_idx, end_idx):
             lines.append(
                 {
                     "lineNumber": idx,
+                    "captureId": cap_id,
                     "ts": entry.get("ts"),
                     "device": entry.get("device"),
                     "baudRate": entry.get("baudRate"),
@@ -974,64 +5324,140 @@ class NixOpsServer:
             )
 
         return {
-            "cachePath": str(_uart_cache_path(self.config)),
+            "cachePath": str(self.uart_cache.root),
             "requestedStartLine": start_line,
             "requestedEndLine": end_line,
             "returnedStartLine": start_idx,
             "returnedEndLine": end_idx,
+            "firstAvailableLine": first_available,
             "totalCacheLines": total,
             "lines": lines,
         }
 
     def pi_tpm_status(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
-        script = (
-            "echo '=== PCR VALUES ===' && "
-            "tpm2_pcrread sha256:0,1,2,3,4,5,6,7 2>&1 || echo 'tpm2_pcrread not available' && "
-            "echo && echo '=== TPM2 TOOLS ===' && "
-            "which tpm2_pcrread 2>/dev/null && echo 'tpm2-tools: available' || echo 'tpm2-tools: not found' && "
-            "echo && echo '=== LUKS TOKENS ===' && "
-            "cryptsetup luksDump /dev/disk/by-partlabel/cryptroot 2>/dev/null | grep -A5 'Tokens:' || "
-            "echo 'no cryptroot partition or cryptsetup not available'"
-        )
-        result = _run_ssh(host, script, self.config, timeout=30)
+        result = _run_ssh(host, _TPM_STATUS_SCRIPT, self.config, timeout=30)
         _append_audit({"tool": "pi_tpm_status", "host": host}, self.config)
-
-        stdout = result.get("stdout", "")
-        summary: Dict[str, Any] = {"host": host}
-        summary["tpm2ToolsAvailable"] = "tpm2-tools: available" in stdout
-        summary["hasLuksTokens"] = "Tokens:" in stdout and "no cryptroot" not in stdout
-        result["summary"] = summary
+        result["summary"] = _tpm_summary(host, result.get("stdout", ""))
         return result
 
     def pi_disk_health(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host = str(args["host"])
-        script = (
-            "echo '=== BLOCK DEVICES ===' && "
-            "lsblk -Jbo NAME,SIZE,FSTYPE,MOUNTPOINT,MODEL 2>&1 && "
-            "echo && echo '=== DISK USAGE ===' && "
-            "df -h / && "
-            "echo && echo '=== SD/EMMC LIFE TIME ===' && "
-            "cat /sys/block/mmcblk0/device/life_time 2>/dev/null || echo 'no life_time info' && "
-            "echo && echo '=== SMART DATA ===' && "
-            "smartctl -a /dev/sda 2>/dev/null || echo 'no smartctl or no SSD'"
-        )
-        result = _run_ssh(host, script, self.config, timeout=30)
+        result = _run_ssh(host, _DISK_HEALTH_SCRIPT, self.config, timeout=30)
         _append_audit({"tool": "pi_disk_health", "host": host}, self.config)
-
-        stdout = result.get("stdout", "")
-        summary: Dict[str, Any] = {"host": host}
-        summary["hasLifeTimeInfo"] = "no life_time info" not in stdout
-        summary["hasSmartData"] = "no smartctl or no SSD" not in stdout
-        result["summary"] = summary
+        result["summary"] = _disk_summary(host, result.get("stdout", ""))
         return result
 
-    def pi_network_scan(self, _args: Dict[str, Any]) -> Dict[str, Any]:
+    def fleet_exec(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        template = str(args["template"])
+        if template not in _FLEET_TEMPLATES:
+            raise ValueError(f"template must be one of: {', '.join(sorted(_FLEET_TEMPLATES))}")
+        build_cmd, default_timeout, summarize = _FLEET_TEMPLATES[template]
+        remote_cmd = build_cmd(args)
+
+        allowed_hosts = self.config.get("allowedHosts", {})
+        requested = args.get("hosts")
+        hosts = [str(h) for h in requested] if requested else sorted(allowed_hosts)
+        unknown = [h for h in hosts if h not in allowed_hosts]
+        if unknown:
+            raise ValueError(f"Hosts not present in allowedHosts: {', '.join(unknown)}")
+        if not hosts:
+            return {"error": "No hosts configured in allowedHosts", "hosts": {}}
+
+        concurrency = int(args.get("concurrency", DEFAULT_FLEET_CONCURRENCY))
+        if concurrency < 1 or concurrency > 32:
+            raise ValueError("concurrency must be between 1 and 32")
+        host_timeout = int(args.get("timeoutSeconds", default_timeout))
+        if host_timeout < 1 or host_timeout > 600:
+            raise ValueError("timeoutSeconds must be between 1 and 600")
+
+        started = time.monotonic()
+        parent = _CURRENT_REQUEST.get()
+        # Each host's ssh runs under its own pseudo request, so the ones still
+        # running at the deadline (or when the call is cancelled) can be
+        # killed without cancelling the fleet_exec request itself.
+        keys = {host: f"fleet:{parent}:{started}:{host}" for host in hosts}
+
+        def run_one(host: str) -> Dict[str, Any]:
+            _CURRENT_REQUEST.set(keys[host])
+            try:
+                result = _run_ssh(host, remote_cmd, self.config, timeout=host_timeout)
+            finally:
+                _REQUESTS.finish(keys[host])
+            if summarize is not None:
+                result["summary"] = summarize(host, result.get("stdout", ""))
+            result["status"] = "ok" if result["exitCode"] == 0 else "error"
+            return result
+
+        results: Dict[str, Any] = {}
+        # Queued hosts also wait for a worker, so the fleet-wide deadline is the
+        # per-host deadline times the number of waves plus slack for ssh setup.
+        waves = -(-len(hosts) // concurrency)
+        deadline = started + host_timeout * waves + 15
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, len(hosts)), thread_name_prefix="nix-ops-fleet")
+        try:
+            for key in keys.values():
+                _REQUESTS.begin(key)
+            futures = {
+                executor.submit(contextvars.copy_context().run, run_one, host): host
+                for host in hosts
+            }
+            pending = set(futures)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (parent is not None and _REQUESTS.is_cancelled(parent)):
+                    break
+                done, pending = wait(pending, timeout=min(remaining, 0.5), return_when=FIRST_COMPLETED)
+                for future in done:
+                    host = futures[future]
+                    try:
+                        results[host] = future.result()
+                    except subprocess.TimeoutExpired:
+                        results[host] = {"host": host, "status": "timeout", "error": f"no result within {host_timeout}s"}
+                    except Exception as exc:
+                        results[host] = {"host": host, "status": "error", "error": str(exc)}
+            for future in pending:
+                host = futures[future]
+                results[host] = {"host": host, "status": "timeout", "error": "fleet deadline exceeded"}
+                if future.cancel():
+                    _REQUESTS.finish(keys[host])
+                else:
+                    # Still in ssh: kill it rather than leave it running.
+                    results[host]["killed"] = _REQUESTS.cancel(keys[host])
+        finally:
+            executor.shutdown(wait=False)
+
+        wall = round(time.monotonic() - started, 3)
+        counts = {"ok": 0, "error": 0, "timeout": 0}
+        for result in results.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        _append_audit({"tool": "fleet_exec", "template": template, "hosts": hosts, **counts}, self.config)
+        return {
+            "template": template,
+            "remoteCommand": remote_cmd,
+            "concurrency": concurrency,
+            "timeoutSeconds": host_timeout,
+            "wallSeconds": wall,
+            "sumHostSeconds": round(sum(float(r.get("durationSeconds", 0)) for r in results.values()), 3),
+            "counts": counts,
+            "hosts": {host: results[host] for host in hosts},
+        }
+
+    def pi_network_scan(self, args: Dict[str, Any]) -> Dict[str, Any]:
         allowed_hosts = self.config.get("allowedHosts", {})
         if not allowed_hosts:
             return {"error": "No hosts configured in allowedHosts", "hosts": {}}
 
+        samples = int(args.get("samples", DEFAULT_SCAN_SAMPLES))
+        if samples < 1 or samples > 10:
+            raise ValueError("samples must be between 1 and 10")
+        timeout = float(args.get("timeoutSeconds", DEFAULT_SCAN_TIMEOUT_SECONDS))
+        if timeout <= 0 or timeout > 10:
+            raise ValueError("timeoutSeconds must be between 0 and 10")
+        port = int(args.get("port", 22))
+
         results: Dict[str, Any] = {}
+        targets: Dict[str, str] = {}
         for host_name, host_entry in allowed_hosts.items():
             target = host_entry.get("sshTarget", "")
             # Extract hostname/IP from sshTarget (e.g. "root@10.13.12.110" -> "10.13.12.110")
@@ -1039,35 +5465,68 @@ class NixOpsServer:
             if not ip:
                 results[host_name] = {"reachable": False, "error": "no sshTarget configured"}
                 continue
-            try:
-                proc = subprocess.run(
-                    ["ping", "-c", "1", "-W", "2", ip],
-                    capture_output=True, text=True, timeout=5, check=False,
-                )
-                reachable = proc.returncode == 0
-                latency = None
-                if reachable:
-                    match = re.search(r"time[=<]([\d.]+)\s*ms", proc.stdout)
-                    if match:
-                        latency = float(match.group(1))
-                results[host_name] = {"ip": ip, "reachable": reachable, "latencyMs": latency}
-            except subprocess.TimeoutExpired:
-                results[host_name] = {"ip": ip, "reachable": False, "error": "ping timeout"}
-            except Exception as exc:
-                results[host_name] = {"ip": ip, "reachable": False, "error": str(exc)}
+            targets[host_name] = ip
+
+        # Every ICMP and TCP probe runs at once, so the scan takes about one
+        # timeout window no matter how many hosts are offline.
+        started = time.monotonic()
+        if targets:
+            with ThreadPoolExecutor(max_workers=2 * len(targets), thread_name_prefix="nix-ops-scan") as executor:
+                icmp = {h: executor.submit(_probe_icmp, ip, samples, timeout) for h, ip in targets.items()}
+                tcp = {h: executor.submit(_probe_tcp, ip, port, samples, timeout) for h, ip in targets.items()}
+                for host_name, ip in targets.items():
+                    try:
+                        icmp_result = icmp[host_name].result()
+                    except Exception as exc:
+                        icmp_result = {"sent": samples, "received": 0, "error": str(exc)}
+                    try:
+                        tcp_result = tcp[host_name].result()
+                    except Exception as exc:
+                        tcp_result = {"port": port, "state": "error", "error": str(exc)}
+                    latency = icmp_result.get("latency") or tcp_result.get("latency")
+                    results[host_name] = {
+                        "ip": ip,
+                        "reachable": bool(icmp_result.get("received")) or tcp_result.get("state") in ("open", "refused"),
+                        "sshPortOpen": tcp_result.get("state") == "open",
+                        "latencyMs": latency["avgMs"] if latency else None,
+                        "icmp": icmp_result,
+                        "tcp": tcp_result,
+                    }
 
         _append_audit({"tool": "pi_network_scan", "hostsScanned": len(results)}, self.config)
-        return {"hosts": results, "scannedCount": len(results)}
+        return {
+            "hosts": results,
+            "scannedCount": len(results),
+            "samples": samples,
+            "timeoutSeconds": timeout,
+            "wallSeconds": round(time.monotonic() - started, 3),
+        }
 
     def nix_diff(self, args: Dict[str, Any]) -> Dict[str, Any]:
         host_a = str(args["hostnameA"])
         host_b = str(args["hostnameB"])
 
-        attr_a = f".#nixosConfigurations.{host_a}.config.system.build.toplevel.drvPath"
-        attr_b = f".#nixosConfigurations.{host_b}.config.system.build.toplevel.drvPath"
-
-        result_a = _run_command(["nix", "eval", "--raw", attr_a], cwd=self.repo_root, timeout=240)
-        result_b = _run_command(["nix", "eval", "--raw", attr_b], cwd=self.repo_root, timeout=240)
+        refresh = bool(args.get("refresh", False))
+        started = time.monotonic()
+        # Both sides at once against one tree fingerprint; cached drvPaths
+        # (e.g. from eval_host or eval_all_hosts) come back immediately.
+        fingerprint = self.eval_cache.fingerprint(self.repo_root)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="nix-ops-diff") as pool:
+            future_a, future_b = (
+                pool.submit(
+                    contextvars.copy_context().run,
+                    self._eval,
+                    _host_drv_cmd(host),
+                    _host_drv_expr(host),
+                    raw=True,
+                    timeout=240,
+                    refresh=refresh,
+                    fingerprint=fingerprint,
+                )
+                for host in (host_a, host_b)
+            )
+        result_a = future_a.result()
+        result_b = future_b.result()
 
         if result_a["exitCode"] != 0:
             return {"error": f"Failed to eval {host_a}", "detail": result_a}
@@ -1083,20 +5542,40 @@ class NixOpsServer:
             "drvPathA": drv_a,
             "drvPathB": drv_b,
             "identical": drv_a == drv_b,
+            "evalCache": {"a": result_a.get("evalCache"), "b": result_b.get("evalCache")},
         }
 
-        # Try nix-diff for a detailed comparison
-        diff_result = _run_command(
-            ["nix-diff", drv_a, drv_b],
-            cwd=self.repo_root, timeout=120,
-        )
-        if diff_result["exitCode"] == 0 or diff_result["stdout"]:
-            output["diff"] = diff_result["stdout"]
+        cached = None if drv_a == drv_b else self.diff_cache.get(drv_a, drv_b)
+        if drv_a == drv_b:
+            output["diff"] = ""
+            output["nixDiffAvailable"] = shutil.which("nix-diff") is not None
+        elif cached is not None:
+            output["diff"] = cached["diff"]
             output["nixDiffAvailable"] = True
-        else:
+            output["diffCached"] = True
+        elif shutil.which("nix-diff") is None:
             output["nixDiffAvailable"] = False
-            output["nixDiffError"] = diff_result["stderr"]
-
+            output["nixDiffError"] = "nix-diff not found on PATH"
+        else:
+            # Try nix-diff for a detailed comparison
+            diff_result = _run_command(
+                ["nix-diff", drv_a, drv_b],
+                cwd=self.repo_root, timeout=120,
+            )
+            if diff_result["exitCode"] == 0 or diff_result["stdout"]:
+                output["diff"] = diff_result["stdout"]
+                output["nixDiffAvailable"] = True
+                output["diffCached"] = False
+                if "outputHandle" in diff_result:
+                    output["outputHandle"] = diff_result["outputHandle"]
+                elif diff_result["exitCode"] == 0:
+                    # A failed run's partial stdout is shown but never cached.
+                    self.diff_cache.put(drv_a, drv_b, {"diff": diff_result["stdout"], "cachedAt": _utcnow().isoformat()})
+            else:
+                output["nixDiffAvailable"] = False
+                output["nixDiffError"] = diff_result["stderr"]
+
+        output["durationSeconds"] = round(time.monotonic() - started, 3)
         return output
 
     def _deploy_command(self, host: str, mode: str) -> Tuple[List[str], str]:
@@ -1145,18 +5624,99 @@ class NixOpsServer:
                 "error": "Confirmation token mismatch.",
                 "expectedConfirmationToken": expected,
             }
-        result = _run_command(cmd, cwd=self.repo_root, timeout=timeout)
+        result = _run_command(cmd, cwd=self.repo_root, timeout=timeout, diagnostics=("stderr",))
         _append_audit({"tool": "deploy_execute", "host": host, "mode": mode, "exitCode": result["exitCode"]}, self.config)
         result["host"] = host
         result["mode"] = mode
         result["mutationAllowed"] = bool(self.config.get("allowMutations", False))
-        result["diagnostics"] = _extract_diagnostics(result["stderr"])
         return result
 
+    def job_status(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        job_id = args.get("jobId")
+        if not job_id:
+            return {"jobs": [job.summary() for job in self.jobs.list()]}
+        job = self.jobs.get(str(job_id))
+        if job is None:
+            return {"error": f"Unknown job {job_id} (finished jobs are kept for the last {self.jobs.history})."}
+        summary = job.summary()
+        if job.result is not None:
+            summary["result"] = job.result
+        return summary
+
+    def job_log(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        job = self.jobs.get(str(args["jobId"]))
+        if job is None:
+            return {"error": f"Unknown job {args['jobId']}."}
+        offset = int(args.get("offset", 0))
+        max_bytes = int(args.get("maxBytes", 65536))
+        if max_bytes < 1 or max_bytes > 1024 * 1024:
+            raise ValueError("maxBytes must be between 1 and 1048576")
+        data = b""
+        total = 0
+        if job.log_path.exists():
+            total = job.log_path.stat().st_size
+            if offset < 0:
+                offset = max(0, total + offset)
+            with job.log_path.open("rb") as handle:
+                handle.seek(offset)
+                data = handle.read(max_bytes)
+        return {
+            "jobId": job.id,
+            "status": job.status,
+            "phase": job.phase,
+            "offset": offset,
+            "nextOffset": offset + len(data),
+            "totalBytes": total,
+            "eof": job.done.is_set() and offset + len(data) >= total,
+            "data": data.decode("utf-8", errors="replace"),
+        }
+
+    def job_cancel(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        job = self.jobs.get(str(args["jobId"]))
+        if job is None:
+            return {"error": f"Unknown job {args['jobId']}."}
+        if job.done.is_set():
+            return {"jobId": job.id, "status": job.status, "killed": 0}
+        killed = self.jobs.cancel(job)
+        _append_audit({"tool": "job_cancel", "jobId": job.id, "jobTool": job.tool, "killed": killed}, self.config)
+        job.done.wait(5)
+        return {"jobId": job.id, "status": job.status, "killed": killed}
+
+    def call_tool_deferred(
+        self, name: str, arguments: Dict[str, Any], respond: Callable[[Optional[Dict[str, Any]], Optional[BaseException]], None]
+    ) -> bool:
+        """Start a foreground job call that answers through `respond(payload, error)` when the job ends.
+
+        Returns False (nothing started) for any other call, which the caller
+        answers inline with call_tool. The calling thread is free again as
+        soon as the job is submitted.
+        """
+        handler = self.tools.get(name)
+        if handler is None or name not in _JOB_TOOLS or bool(arguments.get("background", False)):
+            return False
+        job, coalesced = self.jobs.submit(name, handler, arguments)
+
+        def finished(done: _Job) -> None:
+            if done.error is not None:
+                respond(None, done.error)
+            else:
+                respond({**(done.result or {}), "jobId": done.id, "coalesced": coalesced}, None)
+
+        self.jobs.follow(job, _CURRENT_REQUEST.get(), finished)
+        return True
+
     def call_tool(self, name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
         handler = self.tools.get(name)
         if handler is None:
             raise ValueError(f"Unknown tool: {name}")
+        if name in _JOB_TOOLS:
+            job, coalesced = self.jobs.submit(name, handler, arguments)
+            if bool(arguments.get("background", False)):
+                return {"jobId": job.id, "status": job.status, "coalesced": coalesced}
+            result = self.jobs.wait(job, _CURRENT_REQUEST.get())
+            if result is None:
+                return {"jobId": job.id, "status": "cancelled"}
+            return {**result, "jobId": job.id, "coalesced": coalesced}
         return handler(arguments)
 
 
@@ -1174,6 +5734,14 @@ def _handle_request(server: NixOpsServer, request: Dict[str, Any]) -> Any:
         }
         return _jsonrpc_result(request_id, result)
 
+    if method == "notifications/cancelled":
+        cancelled_id = (params or {}).get("requestId")
+        if cancelled_id is not None:
+            _REQUESTS.cancel(cancelled_id)
+            if server.jobs.abandon(cancelled_id):
+                # A deferred job call: no worker will finish the request.
+                _REQUESTS.finish(cancelled_id)
+        return _NOTIFICATION
     if method and method.startswith("notifications/"):
         return _NOTIFICATION
 
@@ -1192,26 +5760,86 @@ def _handle_request(server: NixOpsServer, request: Dict[str, Any]) -> Any:
     return _jsonrpc_error(request_id, -32601, f"Method not found: {method}")
 
 
+def _dispatch_tool_call(server: NixOpsServer, request: Dict[str, Any]) -> None:
+    """Worker-thread entry point: run one tools/call and write its response."""
+    request_id = request.get("id")
+    _CURRENT_REQUEST.set(request_id)
+    meta = (request.get("params") or {}).get("_meta") or {}
+    if meta.get("progressToken") is not None:
+        _CURRENT_PROGRESS.set(_ProgressReporter(meta["progressToken"]))
+    if _REQUESTS.is_cancelled(request_id):
+        _REQUESTS.finish(request_id)
+        _debug(f"dispatch: id={request_id} cancelled before start")
+        return
+
+    def respond(payload: Optional[Dict[str, Any]], error: Optional[BaseException]) -> None:
+        if _REQUESTS.finish(request_id):
+            _debug(f"dispatch: id={request_id} cancelled, dropping response")
+            return
+        if error is not None:
+            response = _jsonrpc_error(request_id, -32000, str(error))
+        else:
+            response = _jsonrpc_result(request_id, _tool_result(payload or {}))
+        try:
+            _write_message(response)
+        except (BrokenPipeError, ValueError, OSError) as exc:
+            _debug(f"dispatch: id={request_id} write failed: {exc}")
+
+    # Foreground job calls are answered from the job's completion, so an
+    # hour-long build never holds one of the maxWorkers tool threads.
+    params = request.get("params") or {}
+    try:
+        if server.call_tool_deferred(str(params.get("name", "")), params.get("arguments") or {}, respond):
+            return
+    except Exception as exc:
+        respond(None, exc)
+        return
+    try:
+        response = _handle_request(server, request)
+    finally:
+        cancelled = _REQUESTS.finish(request_id)
+    if cancelled:
+        _debug(f"dispatch: id={request_id} cancelled, dropping response")
+        return
+    try:
+        _write_message(response)
+    except (BrokenPipeError, ValueError, OSError) as exc:
+        _debug(f"dispatch: id={request_id} write failed: {exc}")
+
+
 def main() -> int:
     _log("process started (set NIX_OPS_MCP_DEBUG=1 for trace)")
     _debug(f"main: cwd={os.getcwd()}")
     _debug("main: creating server")
     server = NixOpsServer()
-    _debug("main: entering request loop")
-    while True:
-        _debug("main: waiting for message")
-        request = _read_message()
-        if request is None:
-            _debug("main: no message, exiting")
-            break
-        _debug(f"main: got method={request.get('method')}")
-        response = _handle_request(server, request)
-        if response is _NOTIFICATION:
-            continue
-        if response:
-            _debug("main: writing response")
-            _write_message(response)
-            _debug("main: response sent")
+    max_workers = max(1, int(server.config.get("maxWorkers", DEFAULT_MAX_WORKERS)))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nix-ops-tool")
+    _debug(f"main: entering request loop (maxWorkers={max_workers})")
+    try:
+        while True:
+            _debug("main: waiting for message")
+            request = _read_message()
+            if request is None:
+                _debug("main: no message, exiting")
+                break
+            method = request.get("method")
+            _debug(f"main: got method={method}")
+            # tools/call may run for an hour; everything else is answered inline
+            # so ping, tools/list and cancellations are never queued behind it.
+            if method == "tools/call" and "id" in request:
+                _REQUESTS.begin(request.get("id"))
+                executor.submit(contextvars.copy_context().run, _dispatch_tool_call, server, request)
+                continue
+            response = _handle_request(server, request)
+            if response is _NOTIFICATION:
+                continue
+            if response:
+                _debug("main: writing response")
+                _write_message(response)
+                _debug("main: response sent")
+    finally:
+        _debug(f"main: waiting for {_REQUESTS.in_flight()} in-flight tool call(s)")
+        executor.shutdown(wait=True)
     return 0
 
 
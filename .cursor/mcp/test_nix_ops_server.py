@@ -0,0 +1,297 @@
+"""
+Unit tests for the pure parts of nix-ops-server.py
+
+Covers the diagnostics scanner, the UART cache store, output spool pruning
+and job coalescing/cancellation; nothing here needs nix, ssh or a serial
+device.
+
+    python3 -m pytest -q .cursor/mcp/test_nix_ops_server.py
+"""
+
+from __future__ import annotations
+
+import datetime as dt
+import importlib.util
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+SERVER_PATH = Path(__file__).resolve().parent / "nix-ops-server.py"
+
+
+def _load_server() -> Any:
+    spec = importlib.util.spec_from_file_location("nix_ops_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+server = _load_server()
+
+
+# Diagnostics scanner -----------------------------------------------------
+
+BUILD_LOG = (
+    "building '/nix/store/abc-foo.drv'...\n"
+    + "copying path '/nix/store/def-bar' from 'https://cache.nixos.org'...\n" * 50
+    + "error:\n"
+    "       … while evaluating the attribute 'config.system.build.toplevel'\n"
+    "         at /repo/lib/mkHost.nix:12:5:\n"
+    "       … while calling the 'head' builtin\n"
+    "         at /repo/hosts/pix0/default.nix:3:9:\n"
+    "       error: attribute 'foo' missing\n"
+    "       at /repo/hosts/pix0/default.nix:7:3:\n"
+    "            6|\n"
+    + "some unrelated build output\n" * 20
+    + "error: attribute 'foo' missing\n"
+    "       at /repo/hosts/pix0/default.nix:7:3:\n"
+    "error: builder for '/nix/store/xyz-baz.drv' failed with exit code 1\n"
+)
+
+
+def _scan_chunked(text: str, size: int) -> Any:
+    scanner = server._DiagnosticsScanner()
+    for start in range(0, len(text), size):
+        scanner.feed(text[start : start + size])
+    return scanner.close()
+
+
+def test_diagnostics_whole_input() -> None:
+    items = server._extract_diagnostics(BUILD_LOG)
+    first = items[0]
+    assert first["message"] == "attribute 'foo' missing"
+    assert first["location"] == {"file": "/repo/hosts/pix0/default.nix", "line": 7, "column": 3}
+    assert first["occurrences"] == 2
+    assert [frame["location"]["file"] for frame in first["trace"]] == [
+        "/repo/lib/mkHost.nix",
+        "/repo/hosts/pix0/default.nix",
+    ]
+    assert items[1]["message"].startswith("builder for '/nix/store/xyz-baz.drv' failed")
+    assert "location" not in items[1]
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 4096])
+def test_diagnostics_chunked_matches_whole(size: int) -> None:
+    assert _scan_chunked(BUILD_LOG, size) == server._extract_diagnostics(BUILD_LOG)
+
+
+def test_diagnostics_max_items_counts_dropped() -> None:
+    scanner = server._DiagnosticsScanner(max_items=2)
+    scanner.feed("".join(f"error: problem {n}\n" for n in range(5)))
+    assert len(scanner.close()) == 2
+    assert scanner.dropped == 3
+
+
+# UART cache store --------------------------------------------------------
+
+
+def _header(ts: dt.datetime, device: str = "/dev/ttyUSB0") -> Dict[str, Any]:
+    return {"ts": ts.isoformat(), "device": device, "baudRate": 115200, "seconds": 5}
+
+
+def _lines(store: Any, start: int, end: int) -> Dict[int, str]:
+    return {number: record["line"] for number, record, _ in store.iter_range(start, end)}
+
+
+def test_uart_cache_write_and_range(tmp_path: Path) -> None:
+    store = server._UartCacheStore(tmp_path, segment_bytes=200)
+    now = server._utcnow()
+    first = store.append_capture(_header(now), ["boot", "kernel: ok", "login:"])
+    second = store.append_capture(_header(now, "/dev/ttyAMA0"), [f"line {n}" for n in range(10)])
+    assert (first, second) == (1, 4)
+    assert store.total_lines() == 13
+    assert _lines(store, 2, 5) == {2: "kernel: ok", 3: "login:", 4: "line 0", 5: "line 1"}
+    # Line numbers span segments once the first one rolls and is sealed.
+    third = store.append_capture(_header(now), ["after roll"])
+    assert third == 14
+    assert any(path.suffix == ".gz" for path in tmp_path.glob("seg-*"))
+    assert _lines(store, 12, 14) == {12: "line 8", 13: "line 9", 14: "after roll"}
+    assert [e["captureId"] for e in store.capture_entries("/dev/ttyAMA0")] == [4]
+
+
+def test_uart_cache_search_filters(tmp_path: Path) -> None:
+    store = server._UartCacheStore(tmp_path, segment_bytes=200)
+    now = server._utcnow()
+    store.append_capture(_header(now - dt.timedelta(hours=2)), ["panic: old", "fine"])
+    store.append_capture(_header(now, "/dev/ttyAMA0"), ["panic: new", "fine"])
+
+    def found(**kwargs: Any) -> list:
+        return [number for number, _, _ in store.search(re.compile("panic"), **kwargs)]
+
+    assert found() == [1, 3]
+    assert found(device="/dev/ttyAMA0") == [3]
+    assert found(since=now - dt.timedelta(minutes=5)) == [3]
+    assert found(capture_id=1) == [1]
+    stats: Dict[str, Any] = {}
+    assert [n for n, _, _ in store.search(re.compile("nomatch"), stats=stats)] == []
+    assert stats["prefilterLiteral"] == "nomatch"
+    assert stats["linesDecoded"] == 0
+
+
+def test_uart_cache_retention_by_size(tmp_path: Path) -> None:
+    store = server._UartCacheStore(tmp_path, segment_bytes=100, compress=False, max_total_bytes=600)
+    now = server._utcnow()
+    for n in range(20):
+        store.append_capture(_header(now), [f"capture {n} " + "x" * 40])
+    assert store.first_line() > 1
+    # Surviving line numbers are unchanged; dropped ones just read as empty.
+    assert _lines(store, 1, store.first_line() - 1) == {}
+    assert _lines(store, 20, 20) == {20: "capture 19 " + "x" * 40}
+    total = sum(path.stat().st_size for path in tmp_path.glob("seg-*") if path.suffix != ".tix")
+    assert total <= 600 + 200
+
+
+def test_uart_cache_retention_by_age(tmp_path: Path) -> None:
+    store = server._UartCacheStore(tmp_path, segment_bytes=1, max_age=dt.timedelta(days=1))
+    now = server._utcnow()
+    store.append_capture(_header(now - dt.timedelta(days=3)), ["stale"])
+    store.append_capture(_header(now), ["fresh"])
+    store.append_capture(_header(now), ["newest"])
+    assert store.first_line() == 2
+    assert _lines(store, 1, 3) == {2: "fresh", 3: "newest"}
+
+
+def test_uart_cache_migrates_legacy_log(tmp_path: Path) -> None:
+    legacy = tmp_path / "uart-cache.log"
+    ts = server._utcnow().isoformat()
+    legacy.write_text(
+        "".join(
+            f'{{"ts": "{ts}", "device": "/dev/ttyUSB0", "line": "{text}"}}\n' for text in ("one", "two")
+        ),
+        encoding="utf-8",
+    )
+    store = server._UartCacheStore(tmp_path / "cache", legacy_log=legacy)
+    assert _lines(store, 1, 2) == {1: "one", 2: "two"}
+    assert not legacy.exists()
+    assert (tmp_path / "uart-cache.log.migrated").exists()
+
+
+# Output spool ------------------------------------------------------------
+
+
+def _spool(tmp_path: Path, keep: int, max_bytes: int) -> Any:
+    spool = server._OutputSpool()
+    spool.root = tmp_path
+    spool.keep = keep
+    spool.max_bytes = max_bytes
+    return spool
+
+
+def _spill(spool: Any, size: int, age: float) -> str:
+    handle = spool.new_handle()
+    path = spool.path(handle, "stdout")
+    path.write_bytes(b"x" * size)
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return handle
+
+
+def _kept(spool: Any, *handles: str) -> list:
+    return [h for h in handles if spool.path(h, "stdout").exists()]
+
+
+def test_spool_prune_keeps_newest_handles(tmp_path: Path) -> None:
+    spool = _spool(tmp_path, keep=2, max_bytes=1 << 20)
+    old, mid, new = _spill(spool, 10, 30), _spill(spool, 10, 20), _spill(spool, 10, 10)
+    spool.prune()
+    assert _kept(spool, old, mid, new) == [mid, new]
+
+
+def test_spool_prune_byte_cap_spares_written_handle(tmp_path: Path) -> None:
+    spool = _spool(tmp_path, keep=10, max_bytes=100)
+    old, written, new = _spill(spool, 60, 30), _spill(spool, 500, 20), _spill(spool, 60, 10)
+    spool.prune(written)
+    # Over the cap even alone, but just handed out: only older handles go.
+    assert _kept(spool, old, written, new) == [written, new]
+
+
+def test_spool_prune_never_drops_newest(tmp_path: Path) -> None:
+    spool = _spool(tmp_path, keep=1, max_bytes=10)
+    old, new = _spill(spool, 50, 20), _spill(spool, 50, 10)
+    spool.prune()
+    assert _kept(spool, old, new) == [new]
+
+
+# Job manager -------------------------------------------------------------
+
+
+@pytest.fixture
+def jobs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Any:
+    monkeypatch.setattr(server._OUTPUT_SPOOL, "root", tmp_path)
+    return server._JobManager({"jobWorkers": 1}, lambda: None)
+
+
+def _blocking(release: threading.Event, calls: list) -> Any:
+    def handler(args: Dict[str, Any]) -> Dict[str, Any]:
+        calls.append(args)
+        assert release.wait(10)
+        return {"args": args}
+
+    return handler
+
+
+def test_jobs_coalesce_identical_calls(jobs: Any) -> None:
+    release, calls = threading.Event(), []
+    handler = _blocking(release, calls)
+    first, joined = jobs.submit("build_host", handler, {"host": "pix0", "timeoutSeconds": 60})
+    second, coalesced = jobs.submit("build_host", handler, {"host": "pix0", "timeoutSeconds": 900})
+    other, separate = jobs.submit("build_host", handler, {"host": "pix1"})
+    assert (joined, coalesced, separate) == (False, True, False)
+    assert second is first and other is not first
+    assert first.callers == 2
+    release.set()
+    assert first.done.wait(10) and other.done.wait(10)
+    assert first.status == "succeeded"
+    assert first.result == {"args": {"host": "pix0", "timeoutSeconds": 60}}
+    assert len(calls) == 2
+
+
+def test_jobs_never_coalesce_deploys(jobs: Any) -> None:
+    release, calls = threading.Event(), []
+    handler = _blocking(release, calls)
+    first, _ = jobs.submit("deploy_execute", handler, {"host": "pix0"})
+    second, coalesced = jobs.submit("deploy_execute", handler, {"host": "pix0"})
+    assert not coalesced and second is not first
+    release.set()
+    assert first.done.wait(10) and second.done.wait(10)
+    assert len(calls) == 2
+
+
+def test_jobs_cancel_queued_and_running(jobs: Any) -> None:
+    started = threading.Event()
+
+    def sleeper(args: Dict[str, Any]) -> Dict[str, Any]:
+        started.set()
+        return server._run_command(["sleep", "30"], cwd=os.getcwd(), timeout=60)
+
+    running, _ = jobs.submit("check_flake", sleeper, {})
+    queued, _ = jobs.submit("build_host", sleeper, {"host": "pix0"})
+    assert started.wait(10)
+    # Still waiting for the single worker: dequeued without running.
+    assert jobs.cancel(queued) == 0
+    assert queued.done.is_set() and queued.status == "cancelled"
+    # Kills the running sleep (or, if it is not spawned yet, kills it on spawn).
+    began = time.monotonic()
+    jobs.cancel(running)
+    assert running.done.wait(10)
+    assert running.status == "cancelled"
+    assert time.monotonic() - began < 10
+
+
+def test_jobs_follow_calls_back_on_finish(jobs: Any) -> None:
+    release, calls = threading.Event(), []
+    job, _ = jobs.submit("check_flake", _blocking(release, calls), {})
+    finished: list = []
+    jobs.follow(job, 1, finished.append)
+    assert finished == []
+    release.set()
+    assert job.done.wait(10)
+    assert finished == [job]
+    # Following a finished job answers at once.
+    jobs.follow(job, 2, finished.append)
+    assert finished == [job, job]